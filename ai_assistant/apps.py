@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class AiAssistantConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "ai_assistant"
+
+    def ready(self) -> None:
+        from django.conf import settings
+
+        from . import signals  # noqa: F401
+
+        if getattr(settings, "AI_WARMUP_ON_START", False):
+            from services.warmup import start_warmup_thread
+
+            start_warmup_thread()
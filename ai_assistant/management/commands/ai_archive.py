@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_assistant.models import ArchivedSession
+from services import retention
+
+
+def _size(n):
+    if n is None:
+        return "n/a"
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(n) < 1024 or unit == "GiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+class Command(BaseCommand):
+    help = "Archive idle AI chat sessions into compressed blobs and delete their hot ChatMessage rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None, help="Archive sessions idle longer than this (AI_RETENTION_DAYS).")
+        parser.add_argument("--batch-size", type=int, default=None, help="Messages deleted per transaction (AI_RETENTION_BATCH).")
+        parser.add_argument("--sessions-per-batch", type=int, default=50, help="Sessions compressed per archive transaction.")
+        parser.add_argument("--limit", type=int, default=None, help="Stop after this many sessions.")
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be archived.")
+        parser.add_argument("--vacuum", action="store_true", help="VACUUM afterwards so the database file shrinks.")
+        parser.add_argument("--rehydrate", type=int, metavar="SESSION_ID", help="Restore one archived session and exit.")
+
+    def handle(self, *args, **options):
+        session_id = options["rehydrate"]
+        if session_id:
+            if not ArchivedSession.objects.filter(session_id=session_id).exists():
+                raise CommandError(f"Session {session_id} is not archived.")
+            restored = retention.rehydrate(session_id)
+            self.stdout.write(f"Rehydrated session {session_id}: {restored} messages")
+            return
+
+        report = retention.archive_sessions(
+            days=options["days"],
+            batch_size=options["batch_size"],
+            sessions_per_batch=options["sessions_per_batch"],
+            dry_run=options["dry_run"],
+            limit=options["limit"],
+        )
+
+        if options["vacuum"] and not options["dry_run"]:
+            retention.vacuum()
+            report.table_bytes_after = retention.chat_table_bytes()
+
+        ratio = report.stored_bytes / report.raw_bytes if report.raw_bytes else 0
+        prefix = "Would archive" if options["dry_run"] else "Archived"
+        self.stdout.write(
+            f"{prefix} sessions={report.sessions} messages={report.messages} skipped={report.skipped} "
+            f"leftovers_deleted={report.leftovers}"
+        )
+        self.stdout.write(
+            f"content {_size(report.raw_bytes)} -> archive {_size(report.stored_bytes)} ({ratio:.0%})"
+        )
+        self.stdout.write(
+            f"chat table+indexes {_size(report.table_bytes_before)} -> {_size(report.table_bytes_after)} "
+            f"reclaimed {_size(report.reclaimed_bytes)}"
+        )
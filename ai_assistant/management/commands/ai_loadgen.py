@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import secrets
+import string
+import time
+from collections import Counter
+
+import httpx
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+
+QUESTIONS = (
+    "I want to gain muscle. Which program should I choose?",
+    "How much is the membership?",
+    "Which trainer is best for weight loss?",
+    "Do you have anything for beginners?",
+    "When does my membership end?",
+    "I want to improve my endurance for a half marathon.",
+    "Is there a boxing or combat class?",
+    "How do I cancel or renew my membership?",
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the AI chat endpoint of a running server and report RPS and latency percentiles. "
+        "Run the server with AI_PROVIDER=replay or OLLAMA_BASE_URL pointing at services.fake_llm_server, "
+        "and a high AI_RATE_LIMIT_PER_MIN."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000/api/ai/chat/")
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=10)
+        parser.add_argument("--users", type=int, default=1, help="Spread requests over this many loadgen users.")
+        parser.add_argument("--unique", action="store_true", help="Make every message unique to bypass the answer cache.")
+        parser.add_argument("--timeout", type=float, default=60.0)
+
+    def _cookies(self, n_users: int):
+        # Log the users in by writing their sessions directly; the CSRF cookie
+        # and header just have to carry the same 32-character secret.
+        User = get_user_model()
+        cookies = []
+        for i in range(n_users):
+            user, created = User.objects.get_or_create(username=f"loadgen-{i}", defaults={"email": f"loadgen-{i}@example.com"})
+            if created:
+                user.set_unusable_password()
+                user.save(update_fields=["password"])
+
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+
+            csrf = "".join(secrets.choice(string.ascii_letters + string.digits) for _ in range(32))
+            cookies.append({settings.SESSION_COOKIE_NAME: session.session_key, settings.CSRF_COOKIE_NAME: csrf})
+        return cookies
+
+    async def _run(self, url, total, concurrency, cookies, unique, timeout):
+        clients = [
+            httpx.AsyncClient(cookies=c, headers={"X-CSRFToken": c[settings.CSRF_COOKIE_NAME]}, timeout=timeout)
+            for c in cookies
+        ]
+        latencies, ttfbs, statuses = [], [], Counter()
+        counter = iter(range(total))
+
+        async def worker():
+            for i in counter:
+                message = QUESTIONS[i % len(QUESTIONS)] + (f" (#{i})" if unique else "")
+                client = clients[i % len(clients)]
+                started = time.perf_counter()
+                try:
+                    async with client.stream("POST", url, json={"message": message}) as r:
+                        first = None
+                        async for _ in r.aiter_bytes():
+                            if first is None:
+                                first = time.perf_counter()
+                        statuses[r.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                    continue
+                done = time.perf_counter()
+                latencies.append(done - started)
+                ttfbs.append((first or done) - started)
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        finally:
+            for c in clients:
+                await c.aclose()
+        return time.perf_counter() - started, latencies, ttfbs, statuses
+
+    def handle(self, *args, **options):
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        cookies = self._cookies(max(1, options["users"]))
+        elapsed, latencies, ttfbs, statuses = asyncio.run(
+            self._run(options["url"], options["requests"], options["concurrency"], cookies, options["unique"], options["timeout"])
+        )
+
+        ok = statuses.get(200, 0)
+        self.stdout.write(f"url={options['url']} requests={options['requests']} concurrency={options['concurrency']}")
+        self.stdout.write(f"elapsed={elapsed:.2f}s rps={len(latencies) / elapsed:.1f} ok_rps={ok / elapsed:.1f}")
+        self.stdout.write("statuses " + " ".join(f"{k}={v}" for k, v in sorted(statuses.items(), key=str)))
+
+        if latencies:
+            for label, values in (("latency", latencies), ("ttfb", ttfbs)):
+                p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+                self.stdout.write(f"{label}_ms p50={p50:.1f} p95={p95:.1f} p99={p99:.1f} max={max(values) * 1000:.1f}")
+
+        if statuses.get(429):
+            self.stdout.write(self.style.WARNING("Got 429s: raise AI_RATE_LIMIT_PER_MIN on the server or use more --users."))
@@ -0,0 +1,25 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from services.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = "Run queued AI chat generation jobs (see /api/ai/chat/jobs/)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=None, help="Jobs in flight at once (AI_JOBS_CONCURRENCY).")
+        parser.add_argument("--poll", type=float, default=None, help="Seconds between queue polls when idle.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        worker = Worker(concurrency=options["concurrency"], poll_seconds=options["poll"])
+        self.stdout.write(f"AI worker started concurrency={worker.concurrency}")
+
+        try:
+            asyncio.run(worker.serve(once=options["once"]))
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(f"AI worker stopped processed={worker.processed} failed={worker.failed}")
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_assistant", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatsession",
+            name="summary",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="chatsession",
+            name="summary_until_id",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_assistant", "0002_chatsession_summary"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RateLimitCounter",
+            fields=[
+                ("key", models.CharField(max_length=200, primary_key=True, serialize=False)),
+                ("window_start", models.BigIntegerField()),
+                ("hits", models.IntegerField(default=0)),
+                ("prev_hits", models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:02
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_assistant", "0003_ratelimitcounter"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GenerationJob",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("status", models.CharField(choices=[("queued", "Queued"), ("running", "Running"), ("done", "Done"), ("failed", "Failed")], default="queued", max_length=12)),
+                ("payload", models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ("error", models.TextField(blank=True, default="")),
+                ("attempts", models.PositiveSmallIntegerField(default=0)),
+                ("claimed_by", models.CharField(blank=True, default="", max_length=32)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("result_message", models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="ai_assistant.chatmessage")),
+                ("session", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="jobs", to="ai_assistant.chatsession")),
+                ("user_message", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="+", to="ai_assistant.chatmessage")),
+            ],
+            options={
+                "indexes": [models.Index(fields=["status", "id"], name="ai_assistan_status_6f7b7f_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_assistant", "0004_generationjob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedSession",
+            fields=[
+                ("session", models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name="archive", serialize=False, to="ai_assistant.chatsession")),
+                ("codec", models.CharField(max_length=8)),
+                ("payload", models.BinaryField()),
+                ("message_count", models.PositiveIntegerField()),
+                ("raw_bytes", models.PositiveBigIntegerField()),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="chatsession",
+            name="archived_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_assistant", "0005_chat_archive"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="generationjob",
+            name="run_after",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
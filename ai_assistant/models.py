@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
 
@@ -13,6 +14,14 @@ class ChatSession(models.Model):
     title = models.CharField(max_length=120, blank=True, default="")
     is_active = models.BooleanField(default=True)
 
+    # Rolling summary of every message up to and including summary_until_id;
+    # prompts use it plus the most recent raw turns.
+    summary = models.TextField(blank=True, default="")
+    summary_until_id = models.BigIntegerField(blank=True, null=True)
+
+    # Set while the messages live compressed in ArchivedSession (services.retention).
+    archived_at = models.DateTimeField(blank=True, null=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -57,4 +66,102 @@ class ChatMessage(models.Model):
         ordering = ["created_at"]
 
     def __str__(self) -> str:
-        return f"ChatMessage(id={self.id}, role={self.role}, session_id={self.session_id})"
\ No newline at end of file
+        return f"ChatMessage(id={self.id}, role={self.role}, session_id={self.session_id})"
+
+
+class ArchivedSession(models.Model):
+    """
+    All messages of an archived ``ChatSession`` as one compressed JSON blob,
+    written by ``services.retention`` when the hot ``ChatMessage`` rows are
+    deleted and removed again when the session is rehydrated.
+    """
+
+    CODEC_GZIP = "gzip"
+    CODEC_ZSTD = "zstd"
+
+    session = models.OneToOneField(
+        ChatSession,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="archive",
+    )
+    codec = models.CharField(max_length=8)
+    payload = models.BinaryField()
+    message_count = models.PositiveIntegerField()
+    raw_bytes = models.PositiveBigIntegerField()  # uncompressed message content + meta
+
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f"ArchivedSession(session_id={self.session_id}, messages={self.message_count})"
+
+
+class GenerationJob(models.Model):
+    """
+    A queued LLM reply for ``services.jobs``: the prompt inputs captured at
+    request time and, once a worker finishes, the assistant message.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    )
+
+    session = models.ForeignKey(
+        ChatSession,
+        on_delete=models.CASCADE,
+        related_name="jobs",
+    )
+    user_message = models.ForeignKey(
+        ChatMessage,
+        on_delete=models.CASCADE,
+        related_name="+",
+    )
+    result_message = models.ForeignKey(
+        ChatMessage,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        blank=True,
+        null=True,
+    )
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True, default="")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_by = models.CharField(max_length=32, blank=True, default="")
+    # Not claimable before this; set when a saturated model deferred the job.
+    run_after = models.DateTimeField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"]),
+        ]
+
+    def __str__(self) -> str:
+        return f"GenerationJob(id={self.id}, status={self.status}, session_id={self.session_id})"
+
+
+class RateLimitCounter(models.Model):
+    """
+    Sliding-window counter row for ``services.ratelimit.DatabaseBackend``:
+    hits in the current fixed window plus the previous window's total.
+    """
+
+    key = models.CharField(max_length=200, primary_key=True)
+    window_start = models.BigIntegerField()
+    hits = models.IntegerField(default=0)
+    prev_hits = models.IntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"RateLimitCounter(key={self.key}, hits={self.hits})"
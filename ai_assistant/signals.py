@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from gym.models import Trainer, TrainingProgram
+from services.context import bump_catalog_version
+
+
+@receiver(post_save, sender=Trainer)
+@receiver(post_delete, sender=Trainer)
+@receiver(post_save, sender=TrainingProgram)
+@receiver(post_delete, sender=TrainingProgram)
+def invalidate_catalog(sender, **kwargs) -> None:
+    # Bump after commit so no worker can rebuild the snapshot from pre-commit rows.
+    transaction.on_commit(bump_catalog_version)
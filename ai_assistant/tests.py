@@ -1,3 +1,1131 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+from asgiref.sync import sync_to_async
+
+from django.apps import apps
+from django.core.cache import caches
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ai_assistant.models import ArchivedSession, ChatMessage, ChatSession, GenerationJob
+from gym.models import Membership, Trainer, TrainingProgram, User
+from services import http_clients, intents, jobs, ratelimit, retention, router, semantic_cache, summary, usage, warmup
+from services.ai_service import FakeProvider, GeminiProvider, LLMResponse, LLMService, prompt_hash
+from services.chat_repository import ChatRepository
+from services.cacheability import classify
+from services.context import (
+    build_site_context,
+    bump_catalog_version,
+    detect_goal,
+    get_catalog_index,
+    get_catalog_snapshot,
+    get_catalog_version,
+    match_trainers_and_programs,
+    retrieve_catalog,
+)
+from services.fake_llm_server import FakeLLMServer, FakeLLMState, parse_latency
+from services.prompt import PromptBuilder
+from services.ranking import BM25Index, weighted_query
+from services.ratelimit import DatabaseBackend
+from services.replay import Cassette, ReplayMiss, ReplayProvider
+from services.router import RouterProvider, get_health
+from services.semantic_cache import HashingEmbedder
+from services.singleflight import SingleFlight, flights
+from services.vector_index import VectorIndex, get_catalog_vectors
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class PromptLayoutTests(SimpleTestCase):
+    CATALOG = {
+        "trainers": [{"id": i, "name": f"Coach {i}", "specialization": "strength", "description": "x" * 100} for i in range(1, 6)],
+        "programs": [{"id": i, "name": f"Plan {i}", "price": "10.00", "duration_min": 60, "trainer_id": i, "description": "y" * 100} for i in range(1, 6)],
+    }
+
+    def _build(self, message, membership, recommended, budget=5000, history=()):
+        site_context = {**self.CATALOG, "membership": membership}
+        suggestions = {"goal_detected": None, "recommended_trainers": recommended, "recommended_programs": [], "membership": membership}
+        return PromptBuilder("SYSTEM", budget).build(message, list(history), site_context, suggestions)
+
+    def test_prefix_is_identical_across_users_and_questions(self):
+        a = self._build("boxing?", None, [{"id": 9, "name": "Extra", "specialization": "boxing"}])
+        b = self._build("yoga?", {"status": "active", "program": {"id": 2, "name": "Plan 2"}}, [{"id": 3}])
+
+        self.assertEqual(a.messages[0], b.messages[0])
+        self.assertEqual(a.messages[-1], {"role": "user", "content": "boxing?"})
+        self.assertIn("MEMBERSHIP none", a.messages[-2]["content"])
+        self.assertIn("9|Extra|boxing|", a.messages[-2]["content"])
+        self.assertNotIn("MORE TRAINERS", b.messages[-2]["content"])
+
+    def test_over_budget_keeps_recommended_rows_in_user_block(self):
+        prompt = self._build("hi", None, [{"id": 5, "name": "Coach 5", "specialization": "strength", "description": "x" * 100}], budget=120)
+
+        self.assertGreater(prompt.dropped_rows, 0)
+        self.assertNotIn("\n5|Coach 5", prompt.messages[0]["content"])
+        self.assertIn("5|Coach 5|strength|xxx", prompt.messages[-2]["content"])
+        self.assertTrue(prompt.messages[0]["content"].startswith("SYSTEM\nSITE_CONTEXT"))
+
+    def test_retrieved_rows_go_into_user_block(self):
+        site_context = {**self.CATALOG, "membership": None, "retrieved": True}
+        prompt = PromptBuilder("SYSTEM", 5000).build("hi", [], site_context)
+
+        self.assertEqual(prompt.messages[0]["content"], "SYSTEM\nSITE_CONTEXT (authoritative, do not invent) is in the last system message.")
+        self.assertIn("\n1|Coach 1|strength|", prompt.messages[-2]["content"])
+
+
+@override_settings(AI_REPLAY_LATENCY=False, AI_REPLAY_ON_MISS="error")
+class ReplayProviderTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_records_then_replays(self):
+        recorder = ReplayProvider(upstream=FakeProvider("ollama"), cassette=Cassette(self.path))
+        recorded = recorder.chat(MESSAGES)
+        self.assertEqual(Cassette(self.path).get(prompt_hash(MESSAGES))["text"], recorded.text)
+
+        replayer = ReplayProvider(cassette=Cassette(self.path))
+        resp = asyncio.run(replayer.achat(MESSAGES))
+
+        self.assertEqual(resp.text, recorded.text)
+        self.assertEqual(resp.provider, "replay")
+
+    def test_miss_raises_or_cycles(self):
+        ReplayProvider(upstream=FakeProvider("ollama"), cassette=Cassette(self.path)).chat(MESSAGES)
+        other = [{"role": "user", "content": "something else"}]
+
+        with self.assertRaises(ReplayMiss):
+            ReplayProvider(cassette=Cassette(self.path)).chat(other)
+        with override_settings(AI_REPLAY_ON_MISS="cycle"):
+            self.assertTrue(ReplayProvider(cassette=Cassette(self.path)).chat(other).text)
+
+
+@override_settings(
+    AI_PROVIDER="ollama",
+    AI_PROVIDER_FALLBACKS=[],
+    AI_SEMANTIC_CACHE=False,
+    AI_CONTEXT_MODE="retrieval",
+    OLLAMA_API="native",
+    OLLAMA_MODEL="llama3.1:8b",
+    OLLAMA_KEEP_ALIVE="30m",
+    OLLAMA_NUM_CTX=4096,
+    OLLAMA_NUM_PREDICT=256,
+)
+class OllamaProviderTests(SimpleTestCase):
+    SITE = {"trainers": [], "programs": [], "membership": None, "retrieved": True}
+
+    def setUp(self):
+        caches["default"].clear()
+        self.requests = []
+
+        def handler(request):
+            self.requests.append((request.url.path, json.loads(request.content)))
+            return httpx.Response(200, json={"message": {"content": "ok"}, "prompt_eval_count": 12, "eval_count": 3, "load_duration": 5e6})
+
+        client = httpx.Client(transport=httpx.MockTransport(handler))
+        self.addCleanup(client.close)
+        self.enterContext(mock.patch.object(http_clients.ClientPool, "client", lambda pool: client))
+
+    def test_native_chat_payload_keeps_the_prefix_across_turns(self):
+        service = LLMService()
+        first = service.generate_response("Is boxing good cardio?", [], site_context=self.SITE)
+        history = [{"role": "user", "content": "Is boxing good cardio?"}, {"role": "assistant", "content": "ok"}]
+        service.generate_response("And how often should I train?", history, site_context=self.SITE)
+
+        (path, a), (_, b) = self.requests
+        self.assertEqual(path, "/api/chat")
+        self.assertEqual((a["model"], a["stream"], a["keep_alive"]), ("llama3.1:8b", False, "30m"))
+        self.assertEqual(a["options"], {"temperature": 0.7, "num_ctx": 4096, "num_predict": 256})
+        self.assertEqual(a["messages"][-1], {"role": "user", "content": "Is boxing good cardio?"})
+        self.assertEqual(b["messages"][0], a["messages"][0])
+        self.assertEqual(b["messages"][1:3], history)
+        self.assertEqual((first.meta["tokens_in"], first.meta["load_ms"]), (12, 5.0))
+
+        with override_settings(OLLAMA_KEEP_ALIVE="-1"):
+            self.assertEqual(service.provider._payload(MESSAGES)["keep_alive"], -1)
+
+    def test_warm_up_loads_the_chat_prefix_with_the_same_options(self):
+        self.assertTrue(LLMService().warm_up())
+        LLMService().generate_response("Is boxing good cardio?", [], site_context=self.SITE)
+
+        (path, warm), (_, chat) = self.requests
+        self.assertEqual(path, "/api/chat")
+        self.assertEqual(warm["messages"], chat["messages"][:1])
+        self.assertEqual(warm["keep_alive"], "30m")
+        # Same num_ctx, or the chat call would reload the model.
+        self.assertEqual(warm["options"], {**chat["options"], "num_predict": 1})
+
+    def test_warm_up_thread_starts_only_when_enabled(self):
+        config = apps.get_app_config("ai_assistant")
+        with mock.patch("services.warmup.start_warmup_thread") as start:
+            with override_settings(AI_WARMUP_ON_START=False):
+                config.ready()
+            start.assert_not_called()
+            with override_settings(AI_WARMUP_ON_START=True):
+                config.ready()
+            start.assert_called_once_with()
+
+        with override_settings(OLLAMA_WARMUP_SECONDS=0):
+            self.assertFalse(warmup.start_warmup_thread())
+
+
+class GeminiProviderTests(SimpleTestCase):
+    def setUp(self):
+        self.state = FakeLLMState(parse_latency("fixed:0"), 0.0, 500, 5, 0.0)
+        server = FakeLLMServer(("127.0.0.1", 0), self.state)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1beta"
+        self.enterContext(override_settings(GEMINI_BASE_URL=base_url, GEMINI_API_KEY="test", GEMINI_CONTEXT_CACHE_MIN_TOKENS=1024))
+        caches["default"].clear()
+        catalog = "\n".join(f"{i}|Program {i}|10|60|1|" + "strength and conditioning " * 8 for i in range(60))
+        self.messages = [
+            {"role": "system", "content": catalog},
+            {"role": "user", "content": "hi"},
+            {"role": "assistant", "content": "hello"},
+            {"role": "system", "content": "MEMBERSHIP none"},
+            {"role": "user", "content": "which programs?"},
+        ]
+
+    def test_native_turns_reuse_cached_prefix(self):
+        provider = GeminiProvider()
+        first = provider.chat(self.messages)
+        self.assertEqual("".join(provider.stream(self.messages)).split(), first.text.split())
+
+        payload = self.state.payloads[-1]
+        self.assertEqual(len(self.state.cached_contents), 1)
+        self.assertNotIn("systemInstruction", payload)
+        self.assertEqual([c["role"] for c in payload["contents"]], ["user", "model", "user"])
+        self.assertEqual(payload["contents"][-1]["parts"][0], {"text": "MEMBERSHIP none"})
+        self.assertGreater(first.meta["tokens_cached"], 1000)
+
+        # A new catalog replaces the handle; a handle Gemini dropped falls back to inline.
+        changed = [{"role": "system", "content": self.messages[0]["content"] + "\n60|New|10|60|1|"}] + self.messages[1:]
+        provider.chat(changed)
+        self.assertEqual(len(self.state.cached_contents), 1)
+        self.state.cached_contents.clear()
+        self.assertIsNone(provider.chat(changed).meta["tokens_cached"])
+        self.assertIn("systemInstruction", self.state.payloads[-1])
+
+
+class HttpPoolTests(SimpleTestCase):
+    def setUp(self):
+        state = FakeLLMState(parse_latency("fixed:0"), 0.0, 500, 5, 0.0)
+        server = FakeLLMServer(("127.0.0.1", 0), state)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+        self.body = {"model": "fake-1", "messages": MESSAGES}
+        self.pool = http_clients.get_pool("pool-test")
+        self.addCleanup(http_clients._pools.pop, "pool-test", None)
+        self.addCleanup(self.pool.close)
+
+    def test_sync_client_is_reused_and_counted(self):
+        client = self.pool.client()
+        for _ in range(2):
+            client.post(self.url, json=self.body).raise_for_status()
+
+        self.assertIs(self.pool.client(), client)
+        stats = http_clients.pool_stats()["pool-test"]
+        self.assertEqual((stats["requests"], stats["connections_opened"], stats["reuse_ratio"]), (2, 1, 0.5))
+
+    def test_async_clients_per_loop_are_closed_or_dropped(self):
+        async def call(close):
+            client = self.pool.async_client()
+            (await client.post(self.url, json=self.body)).raise_for_status()
+            self.assertIs(self.pool.async_client(), client)
+            if close:
+                await http_clients.aclose_pools()
+                self.assertTrue(client.is_closed)
+
+        asyncio.run(call(close=True))
+        self.assertEqual(len(self.pool._async_clients), 0)
+        # A loop that ends without closing its client leaves it behind until the next loop opens one.
+        asyncio.run(call(close=False))
+        asyncio.run(call(close=False))
+        self.assertEqual(len(self.pool._async_clients), 1)
+        self.assertEqual(self.pool.stats()["requests"], 3)
+
+
+@override_settings(AI_ROUTER_FAILURE_THRESHOLD=2, AI_ROUTER_OPEN_SECONDS=60, AI_ROUTER_HEDGE=False)
+class RouterProviderTests(SimpleTestCase):
+    def setUp(self):
+        router._health.clear()
+
+    def test_fails_over_to_next_provider(self):
+        r = RouterProvider([FakeProvider("ollama", error_rate=1.0), FakeProvider("gemini")])
+
+        resp = r.chat(MESSAGES)
+
+        self.assertEqual(resp.provider, "gemini")
+        self.assertEqual(get_health("ollama").stats()["error_rate"], 1.0)
+
+    def test_open_circuit_skips_provider(self):
+        primary = FakeProvider("ollama", error_rate=1.0)
+        r = RouterProvider([primary, FakeProvider("gemini")])
+
+        r.chat(MESSAGES)
+        r.chat(MESSAGES)
+        self.assertEqual(get_health("ollama").stats()["state"], router.OPEN)
+
+        primary.error_rate = 0.0
+        self.assertEqual(r.chat(MESSAGES).provider, "gemini")
+
+    def test_half_open_trial_closes_circuit(self):
+        primary = FakeProvider("ollama", error_rate=1.0)
+        r = RouterProvider([primary, FakeProvider("gemini")])
+        r.chat(MESSAGES)
+        r.chat(MESSAGES)
+
+        primary.error_rate = 0.0
+        get_health("ollama")._opened_at -= 61
+
+        self.assertEqual(r.chat(MESSAGES).provider, "ollama")
+        self.assertEqual(get_health("ollama").stats()["state"], router.CLOSED)
+
+    def test_raises_last_error_when_all_fail(self):
+        r = RouterProvider([FakeProvider("ollama", error_rate=1.0), FakeProvider("gemini", error_rate=1.0)])
+
+        with self.assertRaises(Exception):
+            r.chat(MESSAGES)
+
+    @override_settings(AI_ROUTER_HEDGE=True, AI_ROUTER_HEDGE_MIN_SAMPLES=1)
+    def test_hedged_request_takes_faster_provider(self):
+        primary = FakeProvider("ollama", latency=0.01)
+        r = RouterProvider([primary, FakeProvider("gemini")])
+        r.chat(MESSAGES)
+
+        primary.latency = 0.5
+        self.assertEqual(r.chat(MESSAGES).provider, "gemini")
+        self.assertEqual(asyncio.run(r.achat(MESSAGES)).provider, "gemini")
+
+    def test_stream_fails_over_before_first_delta(self):
+        r = RouterProvider([FakeProvider("ollama", error_rate=1.0), FakeProvider("gemini")])
+
+        self.assertEqual("".join(r.stream(MESSAGES)), "[gemini] You asked: hi")
+
+    @override_settings(AI_PROVIDER="ollama", AI_PROVIDER_FALLBACKS=["fake"])
+    def test_service_builds_router_from_settings(self):
+        service = LLMService()
+
+        self.assertIsInstance(service.provider, RouterProvider)
+        self.assertEqual([p.name for p in service.provider.providers], ["ollama", "fake"])
+
+
+class RateLimitTests(TestCase):
+    def test_db_backend_rolls_windows_in_one_statement(self):
+        backend = DatabaseBackend()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.hit("rl:t:u1", 120, 60), (1, 0))
+        self.assertEqual(backend.hit("rl:t:u1", 120, 60), (2, 0))
+        self.assertEqual(backend.hit("rl:t:u1", 180, 60), (1, 2))
+        self.assertEqual(backend.hit("rl:t:u1", 360, 60), (1, 0))
+
+    @override_settings(RATE_LIMIT_BACKEND="db")
+    def test_rejects_over_limit_with_retry_after(self):
+        results = [ratelimit.check("rl:t:u2", limit=2, window=60) for _ in range(3)]
+
+        self.assertEqual([r.allowed for r in results], [True, True, False])
+        self.assertGreaterEqual(results[-1].retry_after, 1)
+        self.assertLessEqual(results[-1].retry_after, 120)
+
+    def test_decorator_returns_429_with_headers(self):
+        view = ratelimit.rate_limit("t", 1)(lambda request: HttpResponse("ok"))
+        factory = RequestFactory()
+
+        first = view(factory.post("/"))
+        second = view(factory.post("/"))
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first["X-RateLimit-Remaining"], "0")
+        self.assertEqual(second.status_code, 429)
+        self.assertIn("Retry-After", second)
+        self.assertEqual(view(factory.get("/")).status_code, 200)
+
+
+@override_settings(
+    AI_PROVIDER="fake", AI_SUMMARY_ENABLED=False, RATE_LIMIT_BACKEND="memory", AI_RATE_LIMIT_PER_MIN=1000, AI_CATALOG_VECTOR_DIR=""
+)
+class ChatPersistenceTests(TestCase):
+    # Every request also pays 2 queries for the auth session and user, and 1
+    # for the membership row of the site context (the catalog is cached).
+
+    def setUp(self):
+        # Generic answers are cached across users; start every test cold.
+        caches["default"].clear()
+        self.user = User.objects.create_user("member", "member@example.com", "pw")
+        self.client.force_login(self.user)
+        get_catalog_snapshot(30)
+        get_catalog_index()
+        get_catalog_vectors(get_catalog_snapshot(None))
+
+    def _chat(self, url, message, session_id=None):
+        data = {"message": message}
+        if session_id:
+            data["session_id"] = session_id
+        return self.client.post(url, data, content_type="application/json")
+
+    def test_new_session_query_budget(self):
+        # session + user, membership, then one transaction: INSERT session, INSERT both messages.
+        with self.assertNumQueries(7):
+            resp = self._chat("/api/ai/chat/", "hello")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            list(ChatMessage.objects.values_list("role", flat=True)),
+            [ChatMessage.ROLE_USER, ChatMessage.ROLE_ASSISTANT],
+        )
+
+    def test_existing_session_query_budget(self):
+        session_id = self._chat("/api/ai/chat/", "hello").json()["session_id"]
+        before = ChatSession.objects.get(id=session_id).updated_at
+
+        # + session lookup and one history read; the write touches the session instead of inserting it.
+        with self.assertNumQueries(9):
+            resp = self._chat("/api/ai/chat/", "hello again", session_id)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(ChatSession.objects.get(id=session_id).updated_at, before)
+        self.assertEqual(ChatMessage.objects.filter(session_id=session_id).count(), 4)
+
+    def test_history_excludes_new_message(self):
+        session_id = self._chat("/api/ai/chat/", "first").json()["session_id"]
+        seen = []
+        original = FakeProvider.chat
+
+        def chat(provider, messages):
+            seen.append([m["content"] for m in messages if m["role"] != "system"])
+            return original(provider, messages)
+
+        with mock.patch.object(FakeProvider, "chat", chat):
+            self._chat("/api/ai/chat/", "second", session_id)
+
+        self.assertEqual(seen, [["first", "[fake] You asked: first", "second"]])
+
+    @override_settings(AI_METRICS_TOKEN="")
+    def test_metrics_endpoint_is_staff_only(self):
+        self._chat("/api/ai/chat/", "Is boxing good cardio?")
+        self.assertEqual(self.client.get("/api/ai/metrics/").status_code, 403)
+
+        staff = User.objects.create_user("staff", "staff@example.com", "pw", is_staff=True)
+        self.client.force_login(staff)
+        resp = self.client.get("/api/ai/metrics/")
+        body = resp.content.decode()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertRegex(body, r'ai_chat_requests_total\{endpoint="chat",status="200"\} [1-9]')
+        self.assertIn("# TYPE ai_in_flight_calls gauge", body)
+        for series in ("ai_intent_lookups_total{", "ai_coalesced_total{", 'ai_admission_slots{state="limit"}'):
+            self.assertIn(series, body)
+
+    @override_settings(AI_SUMMARY_ENABLED=True, AI_SUMMARY_ASYNC=False, AI_SUMMARY_TRIGGER=4, AI_SUMMARY_KEEP_RECENT=2)
+    def test_rolling_summary_replaces_older_turns(self):
+        session_id = self._chat("/api/ai/chat/", "first").json()["session_id"]
+        self._chat("/api/ai/chat/", "second", session_id)
+        session = ChatSession.objects.get(id=session_id)
+        self.assertEqual((session.summary, session.summary_until_id), ("", None))
+
+        # Six unsummarised messages > trigger: all but the last two are folded.
+        self._chat("/api/ai/chat/", "third", session_id)
+        session.refresh_from_db()
+        ids = list(ChatMessage.objects.filter(session_id=session_id).order_by("id").values_list("id", flat=True))
+        self.assertEqual(session.summary_until_id, ids[3])
+        self.assertIn("second", session.summary)
+
+        seen = []
+        original = FakeProvider.chat
+
+        def chat(provider, messages):
+            seen.append([m["content"] for m in messages if m["role"] != "system"])
+            return original(provider, messages)
+
+        with mock.patch.object(FakeProvider, "chat", chat):
+            self._chat("/api/ai/chat/", "fourth", session_id)
+
+        self.assertEqual(seen[0], ["third", "[fake] You asked: third", "fourth"])
+        self.assertEqual(ChatSession.objects.get(id=session_id).summary_until_id, ids[3])
+
+    def test_stream_query_budget(self):
+        session_id = self._chat("/api/ai/chat/", "hello").json()["session_id"]
+
+        with self.assertNumQueries(9):
+            resp = self._chat("/api/ai/chat/stream/", "streamed", session_id)
+            body = b"".join(resp.streaming_content)
+
+        self.assertIn(b"event: done", body)
+        self.assertEqual(ChatMessage.objects.filter(session_id=session_id).count(), 4)
+
+    def test_stream_relays_chunks_as_events(self):
+        def stream(provider, messages):
+            yield from ("Rowing ", "is great ", "cardio.")
+
+        with mock.patch.object(FakeProvider, "stream", stream):
+            resp = self._chat("/api/ai/chat/stream/", "Is rowing good cardio?")
+            body = b"".join(resp.streaming_content).decode()
+
+        self.assertEqual(resp["Content-Type"], "text/event-stream")
+        self.assertTrue(body.endswith("\n\n"))
+        events = []
+        for frame in body[:-2].split("\n\n"):
+            event, data = frame.split("\n")
+            events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+
+        session_id = ChatSession.objects.get().id
+        self.assertEqual([e for e, _ in events], ["meta", "delta", "delta", "delta", "done"])
+        self.assertEqual(events[0][1]["session_id"], session_id)
+        self.assertEqual([d["text"] for e, d in events if e == "delta"], ["Rowing ", "is great ", "cardio."])
+        done = events[-1][1]
+        self.assertEqual((done["session_id"], done["response"]), (session_id, "Rowing is great cardio."))
+        self.assertEqual(
+            list(ChatMessage.objects.filter(session_id=session_id).values_list("role", "content")),
+            [(ChatMessage.ROLE_USER, "Is rowing good cardio?"), (ChatMessage.ROLE_ASSISTANT, "Rowing is great cardio.")],
+        )
+
+    def test_navigation_question_skips_the_model(self):
+        before = intents.stats()
+        with mock.patch.object(FakeProvider, "chat") as chat:
+            resp = self._chat("/api/ai/chat/", "How do I buy a membership?")
+
+        chat.assert_not_called()
+        data = resp.json()
+        self.assertEqual((data["provider"], data["model"]), ("intent", "buy_membership"))
+        self.assertIn("/training-programs/", data["response"])
+        after = intents.stats()
+        self.assertEqual(after["requests"] - before["requests"], 1)
+        self.assertEqual(after["fast_path"] - before["fast_path"], 1)
+
+    def test_generic_answer_is_shared_across_users(self):
+        seen = []
+        original = FakeProvider.chat
+
+        def chat(provider, messages):
+            seen.append("\n".join(m["content"] for m in messages))
+            return original(provider, messages)
+
+        other = User.objects.create_user("other", "other@example.com", "pw")
+        with mock.patch.object(FakeProvider, "chat", chat):
+            first = self._chat("/api/ai/chat/", "Which programs suit strength training?").json()
+            self.client.force_login(other)
+            second = self._chat("/api/ai/chat/", "which programs suit strength training").json()
+            self._chat("/api/ai/chat/", "Which programs suit my strength training?")
+
+        self.assertEqual(second["response"], first["response"])
+        self.assertEqual(len(seen), 2)
+        self.assertNotIn("MEMBERSHIP", seen[0])
+        self.assertIn("MEMBERSHIP none", seen[1])
+
+    @override_settings(AI_MAX_CONCURRENT_PER_PROCESS=0, AI_ADMISSION_QUEUE=0)
+    def test_saturated_model_sheds_load_but_not_fast_answers(self):
+        with mock.patch.object(FakeProvider, "chat") as chat:
+            resp = self._chat("/api/ai/chat/", "Is boxing good cardio?")
+            stream = self._chat("/api/ai/chat/stream/", "Is rowing good cardio?")
+            fast = self._chat("/api/ai/chat/", "where is my profile?")
+
+        chat.assert_not_called()
+        self.assertEqual((resp.status_code, resp["Retry-After"]), (503, "5"))
+        self.assertEqual(stream.status_code, 503)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+    @override_settings(AI_TOKENS_PER_MIN=1, RATE_LIMIT_BACKEND="db")
+    def test_token_quota_counts_upstream_turns(self):
+        first = self._chat("/api/ai/chat/", "Is boxing good cardio?")
+        tokens = usage.snapshot(self.user.pk)[f"u{self.user.pk}"]["minute"]
+        second = self._chat("/api/ai/chat/", "Is rowing good cardio?")
+
+        self.assertEqual(first.status_code, 200)
+        self.assertGreater(tokens, 0)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.json()["quota"], "user_minute")
+        self.assertIn("Retry-After", second)
+
+    async def _achat(self, message, session_id=None):
+        data = {"message": message}
+        if session_id:
+            data["session_id"] = session_id
+        return await self.async_client.post("/api/ai/chat/async/", data, content_type="application/json")
+
+    async def test_async_endpoint_answers_and_saves_the_turn(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        first = await self._achat("Is boxing good cardio?")
+        session_id = first.json()["session_id"]
+        second = await self._achat("And rowing?", session_id)
+
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(second.json()["session_id"], session_id)
+        self.assertEqual(second.json()["response"], "[fake] You asked: And rowing?")
+        roles = [r async for r in ChatMessage.objects.filter(session_id=session_id).order_by("id").values_list("role", flat=True)]
+        self.assertEqual(roles, [ChatMessage.ROLE_USER, ChatMessage.ROLE_ASSISTANT] * 2)
+
+    @override_settings(AI_RATE_LIMIT_PER_MIN=1, RATE_LIMIT_BACKEND="db")
+    async def test_async_endpoint_rate_limited(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        first = await self._achat("Is boxing good cardio?")
+        second = await self._achat("Is rowing good cardio?")
+
+        self.assertEqual((first.status_code, second.status_code), (200, 429))
+        self.assertIn("Retry-After", second)
+        self.assertEqual(await ChatMessage.objects.acount(), 2)
+
+    async def test_async_endpoint_rejects_foreign_session(self):
+        other = await sync_to_async(User.objects.create_user)("other", "other@example.com", "pw")
+        foreign = await ChatSession.objects.acreate(user=other)
+        await sync_to_async(self.async_client.force_login)(self.user)
+
+        with mock.patch.object(FakeProvider, "achat") as achat:
+            resp = await self._achat("hello", foreign.id)
+            missing = await self._achat("hello", foreign.id + 1000)
+
+        achat.assert_not_called()
+        self.assertEqual((resp.status_code, missing.status_code), (404, 404))
+        self.assertEqual(await ChatMessage.objects.acount(), 0)
+
+    @override_settings(AI_MAX_CONCURRENT_PER_PROCESS=0, AI_ADMISSION_QUEUE=0)
+    async def test_async_endpoint_sheds_load_too(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        with mock.patch.object(FakeProvider, "achat") as achat:
+            resp = await self.async_client.post(
+                "/api/ai/chat/async/", {"message": "Is boxing good cardio?"}, content_type="application/json"
+            )
+
+        achat.assert_not_called()
+        self.assertEqual((resp.status_code, resp["Retry-After"]), (503, "5"))
+        self.assertEqual(await ChatMessage.objects.acount(), 0)
+
+    def test_upstream_failure_keeps_user_message(self):
+        with mock.patch.object(FakeProvider, "chat", side_effect=httpx.ConnectError("down")):
+            resp = self._chat("/api/ai/chat/", "anyone there?")
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(list(ChatMessage.objects.values_list("content", flat=True)), ["anyone there?"])
+
+
+@override_settings(
+    AI_PROVIDER="fake",
+    AI_SUMMARY_ENABLED=False,
+    RATE_LIMIT_BACKEND="memory",
+    AI_RATE_LIMIT_PER_MIN=1000,
+    AI_CATALOG_VECTOR_DIR="",
+    AI_JOBS_MAX_ATTEMPTS=2,
+    OLLAMA_WARMUP_SECONDS=0,
+)
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("queued", "queued@example.com", "pw")
+        self.client.force_login(self.user)
+
+    def _enqueue(self, message="Is boxing good cardio?"):
+        resp = self.client.post("/api/ai/chat/jobs/", {"message": message}, content_type="application/json")
+        self.assertEqual(resp.status_code, 202)
+        return resp.json()["job_id"]
+
+    def _replies(self):
+        return ChatMessage.objects.filter(role=ChatMessage.ROLE_ASSISTANT).count()
+
+    def test_enqueue_claim_complete(self):
+        job_id = self._enqueue()
+        (job,) = jobs.claim(5)
+        self.assertEqual((job.id, job.status, job.attempts), (job_id, GenerationJob.STATUS_RUNNING, 1))
+        self.assertEqual(jobs.claim(5), [])
+
+        self.assertTrue(jobs.complete(job, LLMResponse("Yes.", "fake", "fake-1", {})))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result_message.content), (GenerationJob.STATUS_DONE, "Yes."))
+
+    def test_stale_job_is_answered_once(self):
+        self._enqueue()
+        (first,) = jobs.claim(1)
+        GenerationJob.objects.filter(id=first.id).update(started_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        (second,) = jobs.claim(1)
+
+        self.assertFalse(jobs.complete(first, LLMResponse("late", "fake", "fake-1", {})))
+        self.assertTrue(jobs.complete(second, LLMResponse("on time", "fake", "fake-1", {})))
+        self.assertEqual(list(ChatMessage.objects.filter(role=ChatMessage.ROLE_ASSISTANT).values_list("content", flat=True)), ["on time"])
+
+    def test_retries_then_fails_after_max_attempts(self):
+        job_id = self._enqueue()
+        for status in (GenerationJob.STATUS_QUEUED, GenerationJob.STATUS_FAILED):
+            (job,) = jobs.claim(1)
+            jobs.fail(job, RuntimeError("upstream down"))
+            self.assertEqual(GenerationJob.objects.get(id=job_id).status, status)
+
+        self.assertEqual(jobs.claim(1), [])
+        data = self.client.get(f"/api/ai/chat/jobs/{job_id}/").json()
+        self.assertEqual(data["error"], "AI job failed: upstream down")
+        self.assertEqual(self._replies(), 0)
+
+    @override_settings(AI_MAX_CONCURRENT_PER_PROCESS=0, AI_ADMISSION_QUEUE=0, AI_ADMISSION_RETRY_AFTER=30)
+    async def test_saturated_model_defers_jobs_without_holding_slots(self):
+        ids = [await sync_to_async(self._enqueue)(m) for m in ("Is boxing good cardio?", "Is rowing good cardio?")]
+        # One slot and no sleeping in it: both jobs are handed back at once.
+        await asyncio.wait_for(jobs.Worker(concurrency=1).serve(once=True), timeout=5)
+
+        deferred = [j async for j in GenerationJob.objects.filter(id__in=ids)]
+        self.assertEqual({(j.status, j.attempts, j.claimed_by) for j in deferred}, {(GenerationJob.STATUS_QUEUED, 0, "")})
+        self.assertTrue(all(j.run_after > timezone.now() + timedelta(seconds=20) for j in deferred))
+        self.assertEqual(await sync_to_async(jobs.claim)(5), [])
+
+        await GenerationJob.objects.filter(id__in=ids).aupdate(run_after=timezone.now())
+        self.assertEqual(len(await sync_to_async(jobs.claim)(5)), 2)
+
+    async def test_worker_answers_and_long_poll_returns_it(self):
+        job_id = await sync_to_async(self._enqueue)()
+        await jobs.Worker(concurrency=2).serve(once=True)
+
+        await sync_to_async(self.async_client.force_login)(self.user)
+        data = (await self.async_client.get(f"/api/ai/chat/jobs/{job_id}/", {"wait": 1})).json()
+        self.assertEqual(data["status"], GenerationJob.STATUS_DONE)
+        self.assertIn("Is boxing good cardio?", data["response"])
+
+
+@override_settings(AI_PROVIDER="fake", AI_SEMANTIC_CACHE=True, AI_SEMANTIC_CACHE_THRESHOLD=0.85)
+class SemanticCacheTests(SimpleTestCase):
+    SITE = {"trainers": [], "programs": [{"id": 2, "name": "Boxing", "price": "30.00", "duration_min": 60, "trainer_id": 1, "description": ""}]}
+    MEMBER = {"status": "active", "program": {"id": 2, "name": "Boxing"}}
+
+    def setUp(self):
+        caches["default"].clear()
+        self.enterContext(mock.patch.object(semantic_cache, "_cache", None))
+
+    def test_hit_above_threshold_and_miss_below(self):
+        c = semantic_cache.SemanticCache(capacity=4, dim=512, ttl=60, threshold=0.85)
+        c.store("How much does the boxing program cost?", "ns", {"text": "30 EUR"})
+
+        hit = c.lookup("What is the price of the boxing program?", "ns")
+        self.assertEqual(hit.value, {"text": "30 EUR"})
+        self.assertGreaterEqual(hit.similarity, 0.85)
+        self.assertIsNone(c.lookup("How much does the yoga program cost?", "ns"))
+        self.assertIsNone(c.lookup("How much does the boxing program cost?", "other"))
+        self.assertEqual((c.stats()["hits"], c.stats()["misses"]), (1, 2))
+
+    def test_shared_answers_expire_with_the_catalog(self):
+        def ask(message, price):
+            programs = [{**self.SITE["programs"][0], "price": price}]
+            return LLMService().generate_response(message, [], site_context={"trainers": [], "programs": programs, "membership": None, "retrieved": True})
+
+        ask("How much does the boxing program cost?", "30.00")
+        self.assertIn("semantic_similarity", ask("What is the price of the boxing program?", "30.00").meta)
+
+        bump_catalog_version()
+        with mock.patch.object(FakeProvider, "chat", wraps=FakeProvider("fake").chat) as chat:
+            resp = ask("What is the price of the boxing program?", "45.00")
+
+        chat.assert_called_once()
+        self.assertIn("45.00", chat.call_args.args[0][-2]["content"])
+        self.assertNotIn("semantic_similarity", resp.meta)
+
+    def test_user_scoped_answers_are_not_shared(self):
+        calls = []
+        original = FakeProvider.chat
+
+        def chat(provider, messages):
+            calls.append(messages[-1]["content"])
+            return original(provider, messages)
+
+        def ask(message, membership):
+            return LLMService().generate_response(message, [], site_context={**self.SITE, "membership": membership})
+
+        with mock.patch.object(FakeProvider, "chat", chat):
+            first = ask("How much does my boxing program cost?", self.MEMBER)
+            paraphrase = ask("What is the price of my boxing program?", self.MEMBER)
+            other_user = ask("What is the price of my boxing program?", None)
+
+        self.assertEqual(calls, ["How much does my boxing program cost?", "What is the price of my boxing program?"])
+        self.assertEqual(paraphrase.text, first.text)
+        self.assertGreaterEqual(paraphrase.meta["semantic_similarity"], 0.85)
+        self.assertNotIn("semantic_similarity", other_user.meta)
+
+
+@override_settings(AI_PROVIDER="fake", AI_SEMANTIC_CACHE=False)
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+
+    async def test_cancelled_leader_does_not_fail_followers(self):
+        group = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(len(calls))
+            await asyncio.sleep(0 if len(calls) > 1 else 10)
+            return f"answer {len(calls)}"
+
+        leader = asyncio.ensure_future(group.ado("k", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(group.ado("k", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        # The follower takes over the call instead of inheriting the cancellation.
+        self.assertEqual(await follower, ("answer 2", False))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(group.stats()["in_flight"], 0)
+
+    def test_concurrent_identical_requests_share_one_upstream_call(self):
+        calls = []
+        original = FakeProvider.chat
+
+        def chat(provider, messages):
+            calls.append(messages[-1]["content"])
+            time.sleep(0.5)  # long enough for every follower to queue behind the leader
+            return original(provider, messages)
+
+        site_context = {"trainers": [], "programs": [], "membership": None}
+        start = threading.Barrier(4)
+        replies = []
+
+        def ask():
+            start.wait()
+            replies.append(LLMService().generate_response("Is boxing good cardio?", [], site_context=site_context))
+
+        before = flights.stats()["coalesced_process"]
+        with mock.patch.object(FakeProvider, "chat", chat):
+            threads = [threading.Thread(target=ask) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(calls, ["Is boxing good cardio?"])
+        self.assertEqual({r.text for r in replies}, {"[fake] You asked: Is boxing good cardio?"})
+        self.assertEqual(sorted(r.meta.get("coalesced", "") for r in replies), ["", "process", "process", "process"])
+        self.assertEqual(flights.stats()["coalesced_process"] - before, 3)
+
+
+class SummaryExecutorTests(SimpleTestCase):
+    def test_concurrent_first_calls_share_one_executor(self):
+        def slow_executor(**kwargs):
+            time.sleep(0.05)  # widen the window two threads could both see None
+            return mock.Mock()
+
+        start = threading.Barrier(4)
+        got = []
+
+        def get():
+            start.wait()
+            got.append(summary._get_executor())
+
+        with mock.patch.object(summary, "_executor", None), mock.patch.object(summary, "ThreadPoolExecutor", side_effect=slow_executor) as created:
+            threads = [threading.Thread(target=get) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        created.assert_called_once()
+        self.assertEqual(len({id(e) for e in got}), 1)
+
+
+class IntentMatchingTests(SimpleTestCase):
+    def test_cacheability(self):
+        self.assertTrue(classify("How do I join a boxing class?", []).shared)
+        self.assertEqual(classify("When does my membership end?", []).reason, "personal")
+        self.assertEqual(classify("what programs do you offer?", [{"role": "user", "content": "hi"}]).reason, "follow_up")
+
+    def test_whole_sentence_intents_and_goal_order(self):
+        self.assertEqual(intents.match_intent("Hi, where is my profile?"), "profile")
+        self.assertEqual(intents.match_intent("what programs do you have"), "programs")
+        self.assertIsNone(intents.match_intent("what programs do you have for bad knees?"))
+        self.assertIsNone(intents.match_intent("cancel my membership"))
+        # First goal in declaration order wins, wherever its keyword appears.
+        self.assertEqual(detect_goal("yoga to build muscle"), "muscle_gain")
+        self.assertIsNone(detect_goal("opening hours?"))
+
+
+class CatalogSnapshotTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.trainer = Trainer.objects.create(name="Ana", specialization="yoga", description="Flows.")
+        self.program = TrainingProgram.objects.create(name="Yoga", description="Flows.", duration=60, price=20, trainer=self.trainer)
+        bump_catalog_version()
+
+    def _names(self):
+        snapshot = get_catalog_snapshot(None)
+        return [t["name"] for t in snapshot.trainers], [p["name"] for p in snapshot.programs]
+
+    def test_catalog_edits_replace_the_snapshot_after_commit(self):
+        self.assertEqual(self._names(), (["Ana"], ["Yoga"]))
+        with self.assertNumQueries(0):
+            self._names()
+
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.trainer.name = "Bea"
+            self.trainer.save()
+        # Not bumped before commit: a worker must not rebuild from uncommitted rows.
+        self.assertEqual((get_catalog_version(), self._names()), (version, (["Ana"], ["Yoga"])))
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(get_catalog_version(), version)
+        self.assertEqual(self._names(), (["Bea"], ["Yoga"]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.program.delete()
+        self.assertEqual(self._names(), (["Bea"], []))
+
+    def test_membership_changes_are_read_live(self):
+        user = User.objects.create_user("member", "member@example.com", "pw")
+        self.assertIsNone(build_site_context(user.id, limit=None, user=user).membership)
+        get_catalog_snapshot(None)
+        version = get_catalog_version()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Membership.objects.create(user=user, program=self.program, start_date=date.today(), end_date=date.today(), status="active")
+        # One query: the membership. The catalog comes from the unchanged snapshot.
+        with self.assertNumQueries(1):
+            context = build_site_context(user.id, limit=None, user=user)
+
+        self.assertEqual(get_catalog_version(), version)
+        self.assertEqual((context.membership["status"], context.membership["program"]["name"]), ("active", "Yoga"))
+        self.assertEqual([p["name"] for p in context.programs], ["Yoga"])
+
+
+class RankingTests(TestCase):
+    def test_bm25_weights_fields_and_drops_non_matches(self):
+        rows = [
+            {"id": 1, "specialization": "yoga", "description": "Gentle boxing drills between stretches."},
+            {"id": 2, "specialization": "boxing", "description": "Pads and bags."},
+            {"id": 3, "specialization": "running", "description": "Cardio intervals."},
+        ]
+        index = BM25Index(rows, {"specialization": 2, "description": 1})
+
+        self.assertEqual([r["id"] for r, _ in index.search({"boxing": 1.0}, 3)], [2, 1])
+        self.assertEqual(index.search({"pilates": 1.0}, 3), [])
+        # A query term that only one row has outweighs one shared by two.
+        ranked = index.search(weighted_query((["boxing"], 1.0), (["cardio"], 1.0)), 3)
+        self.assertEqual(ranked[0][0]["id"], 3)
+
+    def test_index_is_rebuilt_after_catalog_edit(self):
+        caches["default"].clear()
+        ben = Trainer.objects.create(name="Ben", specialization="boxing", description="Pads.")
+        Trainer.objects.create(name="Ana", specialization="yoga", description="Mobility flows.")
+        bump_catalog_version()
+
+        index = get_catalog_index()
+        self.assertIs(get_catalog_index(), index)
+        self.assertEqual(match_trainers_and_programs("I want to learn boxing")[0][0]["name"], "Ben")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ben.specialization = "pilates"
+            ben.save()
+            Trainer.objects.create(name="Kim", specialization="kickboxing", description="Boxing and MMA conditioning.")
+
+        rebuilt = get_catalog_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(len(rebuilt.trainers), 3)
+        self.assertEqual([t["name"] for t in match_trainers_and_programs("I want to learn boxing")[0]], ["Kim"])
+
+
+class CatalogRetrievalTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.enterContext(override_settings(AI_CATALOG_VECTOR_DIR=tmp.name, AI_RETRIEVAL_TOP_K=2))
+        self.dir = tmp.name
+
+        specs = [("Ana", "yoga", "Mobility and flexibility flows."), ("Ben", "boxing", "Boxing and kickboxing pads."),
+                 ("Cas", "powerlifting", "Muscle gain and strength blocks.")]
+        self.trainers = [Trainer.objects.create(name=n, specialization=s, description=d) for n, s, d in specs]
+        for t in self.trainers:
+            TrainingProgram.objects.create(name=f"{t.specialization} program", description=t.description, duration=60, price=20, trainer=t)
+        bump_catalog_version()
+
+    def test_retrieves_relevant_rows_and_pads_from_catalog(self):
+        matches = retrieve_catalog("I want to get into boxing")
+        self.assertEqual(matches.goal, "combat")
+        self.assertEqual(matches.trainers[0]["name"], "Ben")
+        self.assertEqual([t["name"] for t in matches.recommended_trainers], ["Ben"])
+        self.assertEqual(matches.programs[0]["name"], "boxing program")
+        # Only one row shares a term; the second slot comes from the start of the catalog.
+        self.assertEqual(matches.trainers[1]["name"], "Ana")
+
+        general = retrieve_catalog("what are your opening hours?")
+        self.assertIsNone(general.goal)
+        self.assertEqual(len(general.trainers), 2)
+        self.assertEqual(general.recommended_trainers, [])
+
+    def test_rebuild_reuses_unchanged_rows_and_maps_files(self):
+        embedder = HashingEmbedder(64)
+        rows = [(t.id, f"{t.specialization} {t.description}") for t in self.trainers]
+        first, embedded = VectorIndex.build(rows, embedder)
+        self.assertEqual(embedded, 3)
+
+        rows[1] = (rows[1][0], "boxing conditioning")
+        rows.append((999, "running endurance"))
+        second, embedded = VectorIndex.build(rows, embedder, previous=first)
+        self.assertEqual(embedded, 2)
+        self.assertTrue((second.vectors[0] == first.vectors[0]).all())
+
+        version = get_catalog_snapshot(None).version
+        get_catalog_vectors(get_catalog_snapshot(None))
+        loaded = VectorIndex.load(self.dir, f"trainers-{version}")
+        self.assertIsInstance(loaded.vectors, np.memmap)
+        self.assertEqual(list(loaded.ids), [t.id for t in self.trainers])
+
+
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("reader", "reader@example.com", "pw")
+        self.client.force_login(self.user)
+
+    def _walk(self, url, key, limit):
+        # Returns the ids in page order and the query count of each page.
+        seen, cursor, queries = [], None, []
+        while True:
+            params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+            with CaptureQueriesContext(connection) as ctx:
+                data = self.client.get(url, params).json()
+            queries.append(len(ctx.captured_queries))
+            self.assertFalse(any("OFFSET" in q["sql"] for q in ctx.captured_queries))
+            seen.extend(item["id"] for item in data[key])
+            cursor = data["next_cursor"]
+            if not cursor:
+                return seen, queries
+
+    def test_sessions_keyset_pages_cost_the_same(self):
+        sessions = [ChatSession.objects.create(user=self.user) for _ in range(7)]
+        ChatSession.objects.create(user=User.objects.create_user("other"))
+
+        ids, queries = self._walk("/api/ai/sessions/", "sessions", 3)
+
+        self.assertEqual(ids, [s.id for s in reversed(sessions)])
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(len(set(queries)), 1)
+
+    def test_messages_page_back_in_time(self):
+        session = ChatSession.objects.create(user=self.user)
+        ChatMessage.objects.bulk_create(
+            ChatMessage(session=session, role=ChatMessage.ROLE_USER, content=str(i)) for i in range(5)
+        )
+        url = f"/api/ai/sessions/{session.id}/messages/"
+
+        first = self.client.get(url, {"limit": 2}).json()
+        self.assertEqual([m["content"] for m in first["messages"]], ["3", "4"])
+
+        ids, queries = self._walk(url, "messages", 2)
+        self.assertEqual(sorted(ids), list(ChatMessage.objects.order_by("id").values_list("id", flat=True)))
+        self.assertEqual(len(set(queries)), 1)
+
+    def test_etag_revalidation_and_bad_input(self):
+        session = ChatSession.objects.create(user=self.user)
+        url = f"/api/ai/sessions/{session.id}/messages/"
+
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        ChatSession.objects.filter(id=session.id).update(updated_at=session.updated_at + timedelta(seconds=1))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        self.assertEqual(self.client.get(url, {"cursor": "not-a-cursor"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"limit": "x"}).status_code, 400)
+        other = ChatSession.objects.create(user=User.objects.create_user("other"))
+        self.assertEqual(self.client.get(f"/api/ai/sessions/{other.id}/messages/").status_code, 404)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("archiver", "archiver@example.com", "pw")
+        self.client.force_login(self.user)
+
+    def _session(self, days_idle, n=4):
+        session = ChatSession.objects.create(user=self.user)
+        ChatMessage.objects.bulk_create(
+            ChatMessage(session=session, role=ChatMessage.ROLE_USER, content=f"message {i} " * 20, meta={"i": i})
+            for i in range(n)
+        )
+        ChatSession.objects.filter(id=session.id).update(updated_at=timezone.now() - timedelta(days=days_idle))
+        return session
+
+    def test_archives_idle_sessions_and_rehydrates_on_read(self):
+        old, recent = self._session(100), self._session(1)
+        before = list(ChatMessage.objects.filter(session=old).order_by("id").values("id", "content", "meta", "created_at"))
+
+        report = retention.archive_sessions(days=90, batch_size=3)
+
+        self.assertEqual((report.sessions, report.messages), (1, 4))
+        self.assertLess(report.stored_bytes, report.raw_bytes)
+        self.assertFalse(ChatMessage.objects.filter(session=old).exists())
+        self.assertEqual(ChatMessage.objects.filter(session=recent).count(), 4)
+
+        data = self.client.get(f"/api/ai/sessions/{old.id}/messages/").json()
+
+        self.assertEqual([m["id"] for m in data["messages"]], [m["id"] for m in before])
+        after = list(ChatMessage.objects.filter(session=old).order_by("id").values("id", "content", "meta", "created_at"))
+        self.assertEqual(after, before)
+        self.assertFalse(ArchivedSession.objects.exists())
+        self.assertIsNone(ChatSession.objects.get(id=old.id).archived_at)
+
+    def test_turn_opened_before_archiving_keeps_its_messages(self):
+        session = self._session(100)
+        turn = ChatRepository(self.user).open_turn(session.id, "still there?")
+
+        retention.archive_sessions(days=90)
+        ChatRepository(self.user).save_exchange(turn, LLMResponse("yes", "fake", "fake-1", {}))
+        report = retention.archive_sessions(days=90)
+
+        self.assertEqual(report.leftovers, 0)
+        self.assertEqual(ChatMessage.objects.filter(session=session).count(), 2)
+        data = self.client.get(f"/api/ai/sessions/{session.id}/messages/", {"limit": 10}).json()
+        self.assertEqual([m["content"] for m in data["messages"]][-2:], ["still there?", "yes"])
+        self.assertEqual(len(data["messages"]), 6)
+
+    def test_skips_sessions_with_pending_jobs(self):
+        session = self._session(100)
+        GenerationJob.objects.create(session=session, user_message=session.messages.first(), payload={})
+
+        self.assertEqual(retention.archive_sessions(days=90).sessions, 0)
+        self.assertEqual(ChatMessage.objects.filter(session=session).count(), 4)
+
+
+class TieredCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.enterContext(override_settings(CACHES={
+            "default": {"BACKEND": "services.cache_backends.TieredCache", "LOCATION": tmp.name, "OPTIONS": {"SHARED": "shared", "SYNC_INTERVAL": 0}},
+            "shared": {"BACKEND": "services.cache_backends.SQLiteCache", "LOCATION": os.path.join(tmp.name, "cache.sqlite3")},
+        }))
+        self.cache, self.shared = caches["default"], caches["shared"]
+
+    def test_write_by_another_worker_invalidates_tier_one(self):
+        self.cache.set("catalog", 1)
+        self.assertEqual(self.cache.get("catalog"), 1)
+        self.assertEqual(self.cache.get("catalog"), 1)
+
+        self.shared.set("catalog", 2)  # what another worker's write looks like from here
+        self.assertEqual(self.cache.get("catalog"), 2)
+        self.shared.delete("catalog")
+        self.assertIsNone(self.cache.get("catalog"))
+
+        stats = self.cache.stats()
+        self.assertEqual((stats["l1_hits"], stats["invalidations"]), (1, 2))
+
+    def test_counters_and_locks_are_atomic_in_the_shared_tier(self):
+        self.assertTrue(self.cache.add("lock", "a", 30))
+        self.assertFalse(self.shared.add("lock", "b", 30))
+        self.cache.set("hits", 0)
+        self.assertEqual([self.cache.incr("hits") for _ in range(3)], [1, 2, 3])
+        self.assertEqual(self.shared.get("hits"), 3)
+        self.assertTrue(self.cache.delete("lock"))
+        self.assertTrue(self.shared.add("lock", "b", 30))
+        self.assertEqual(self.cache.get("lock"), "b")
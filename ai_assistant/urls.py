@@ -1,6 +1,22 @@
 from django.urls import path
-from .views import chat_api
+from .views import (
+    chat_api,
+    chat_async_api,
+    chat_job_api,
+    chat_job_status_api,
+    chat_stream_api,
+    metrics_api,
+    session_messages_api,
+    sessions_api,
+)
 
 urlpatterns = [
     path("api/ai/chat/", chat_api, name="ai_chat_api"),
+    path("api/ai/chat/stream/", chat_stream_api, name="ai_chat_stream_api"),
+    path("api/ai/chat/async/", chat_async_api, name="ai_chat_async_api"),
+    path("api/ai/chat/jobs/", chat_job_api, name="ai_chat_job_api"),
+    path("api/ai/chat/jobs/<int:job_id>/", chat_job_status_api, name="ai_chat_job_status_api"),
+    path("api/ai/sessions/", sessions_api, name="ai_sessions_api"),
+    path("api/ai/sessions/<int:session_id>/messages/", session_messages_api, name="ai_session_messages_api"),
+    path("api/ai/metrics/", metrics_api, name="ai_metrics_api"),
 ]
\ No newline at end of file
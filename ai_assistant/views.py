@@ -1,111 +1,55 @@
+import asyncio
+import hmac
 import json
 import logging
-from typing import Dict, List, Optional
+import time
+from typing import Dict
 
 import httpx
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
-from django.http import JsonResponse
-from django.views.decorators.http import require_POST
-
-from .models import ChatMessage, ChatSession
-from services.ai_service import LLMService
-from services.context import build_site_context, match_trainers_and_programs
+from django.db import transaction
+from django.http import (
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseNotAllowed,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.utils.cache import get_conditional_response
+from django.views.decorators.http import require_GET, require_POST
+
+from .models import GenerationJob
+from services import admission, intents, jobs, metrics
+from services.ai_service import LLMResponse, LLMService, LLMStream
+from services.chat_repository import ChatRepository, ChatTurn
+from services.context import build_site_context, match_trainers_and_programs, retrieve_catalog
+from services.pagination import InvalidPage, decode_cursor, make_etag, page_etag, page_size
+from services.ratelimit import rate_limit
+from services.summary import schedule_summary
+from services.usage import token_quota
 
 logger = logging.getLogger(__name__)
 
 
-def _rate_key(user_id: int) -> str:
-    return f"ai:rl:{user_id}"
-
-
-def _allow_request(user_id: int) -> bool:
-    limit = getattr(settings, "AI_RATE_LIMIT_PER_MIN", 12)
-    key = _rate_key(user_id)
-    current = cache.get(key, 0)
-
-    if current >= limit:
-        return False
-
-    cache.set(key, current + 1, timeout=60)
-    return True
-
-
-def _get_history(session: ChatSession, limit: int = 10) -> List[Dict[str, str]]:
-    qs = session.messages.exclude(role=ChatMessage.ROLE_SYSTEM).order_by("-created_at")[:limit]
-    msgs = list(reversed(qs))
-    return [{"role": m.role, "content": m.content} for m in msgs]
-
+def _ai_rate_limit() -> int:
+    return getattr(settings, "AI_RATE_LIMIT_PER_MIN", 12)
 
-@login_required
-@require_POST
-def chat_api(request):
-    if not _allow_request(request.user.id):
-        return JsonResponse({"error": "Rate limit exceeded. Please slow down."}, status=429)
 
-    try:
-        payload = json.loads(request.body.decode("utf-8"))
-    except json.JSONDecodeError:
-        return JsonResponse({"error": "Invalid JSON"}, status=400)
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    message = (payload.get("message") or "").strip()
-    session_id = payload.get("session_id")
 
-    if not message:
-        return JsonResponse({"error": "Message is required"}, status=400)
-
-    session: Optional[ChatSession] = None
-
-    if session_id:
-        session = ChatSession.objects.filter(
-            id=session_id,
-            user=request.user,
-            is_active=True,
-        ).first()
-        if not session:
-            return JsonResponse({"error": "Session not found"}, status=404)
-    else:
-        session = ChatSession.objects.create(user=request.user, title="")
-
-    ChatMessage.objects.create(
-        session=session,
-        role=ChatMessage.ROLE_USER,
-        content=message,
-    )
-
-    history = _get_history(session, limit=10)
-
-    site = build_site_context(request.user.id)
-    best_trainers, best_programs, goal = match_trainers_and_programs(site, message, top_k=3)
-
-    suggestions = {
-        "goal_detected": goal,
-        "recommended_trainers": best_trainers,
-        "recommended_programs": best_programs,
-        "membership": site.membership,
-    }
-
-    service = LLMService()
-
-    try:
-        resp = service.generate_response(
-            user_message=message,
-            conversation_history=history[:-1],
-            site_context={
-                "trainers": site.trainers,
-                "programs": site.programs,
-                "membership": site.membership,
-            },
-            suggestions=suggestions,
-        )
-    except httpx.TimeoutException:
+def _ai_error_response(e: Exception) -> JsonResponse:
+    if isinstance(e, httpx.TimeoutException):
         logger.exception("AI timeout")
         return JsonResponse(
             {"error": "AI timeout. Please try again in a few seconds."},
             status=504,
         )
-    except httpx.HTTPStatusError as e:
+
+    if isinstance(e, httpx.HTTPStatusError):
         status_code = e.response.status_code
         body = e.response.text[:2000]
 
@@ -155,30 +99,477 @@ def chat_api(request):
             {"error": f"AI upstream service failed ({status_code}). Details: {body}"},
             status=502,
         )
+
+    logger.exception("AI chat failed: %s", str(e))
+    return JsonResponse(
+        {"error": f"AI internal error: {str(e)}"},
+        status=500,
+    )
+
+
+
+def _parse_chat(request):
+    """Returns ``(error_response, None, None)`` or ``(None, message, session_id)``."""
+    try:
+        payload = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400), None, None
+
+    message = (payload.get("message") or "").strip()
+    if not message:
+        return JsonResponse({"error": "Message is required"}, status=400), None, None
+
+    return None, message, payload.get("session_id")
+
+
+def _chat_context(user, message: str):
+    """
+    Returns ``(site_context, suggestions, fast)``. ``fast`` is the intent
+    fast path's reply (``services/intents.py``) when the message is a
+    recognised site-navigation question: no catalog ranking, no model call.
+    """
+    # "retrieval": only the catalog rows most similar to the question;
+    # "catalog": the first 30 rows in catalog order plus BM25 recommendations.
+    retrieved = getattr(settings, "AI_CONTEXT_MODE", "retrieval") == "retrieval"
+    with metrics.phase("site_context"):
+        site = build_site_context(user.id, limit=0 if retrieved else 30, user=user)
+
+    with metrics.phase("intent"):
+        answer = intents.answer(message, site.membership)
+    if answer is not None:
+        metrics.note(route="intent", intent=answer.intent)
+    else:
+        metrics.note(route="model")
+
+    trainers, programs = site.trainers, site.programs
+    best_trainers, best_programs, goal = [], [], None
+    if answer is None:
+        with metrics.phase("ranking"):
+            if retrieved:
+                matches = retrieve_catalog(message)
+                trainers, programs = matches.trainers, matches.programs
+                best_trainers, best_programs, goal = matches.recommended_trainers, matches.recommended_programs, matches.goal
+            else:
+                best_trainers, best_programs, goal = match_trainers_and_programs(message, top_k=3)
+
+    suggestions = {
+        "goal_detected": goal,
+        "recommended_trainers": best_trainers,
+        "recommended_programs": best_programs,
+        "membership": site.membership,
+    }
+
+    site_context = {
+        "trainers": trainers,
+        "programs": programs,
+        "membership": site.membership,
+        "retrieved": retrieved,
+    }
+
+    fast = None
+    if answer is not None:
+        fast = LLMResponse(text=answer.text, provider="intent", model=answer.intent, meta={"intent": answer.intent})
+    return site_context, suggestions, fast
+
+
+def _prepare_chat(request):
+    """
+    Shared request handling for the blocking, streaming and queued chat
+    endpoints. Nothing is written yet: the caller stores the turn through
+    ``ChatRepository.save_exchange`` once it has the reply.
+
+    Returns ``(error_response, None)`` on failure, otherwise
+    ``(None, (repo, turn, site_context, suggestions, fast))``.
+    """
+    error, message, session_id = _parse_chat(request)
+    if error:
+        return error, None
+
+    repo = ChatRepository(request.user)
+    with metrics.phase("history"):
+        turn = repo.open_turn(session_id, message)
+    if turn is None:
+        return JsonResponse({"error": "Session not found"}, status=404), None
+
+    site_context, suggestions, fast = _chat_context(request.user, message)
+    return None, (repo, turn, site_context, suggestions, fast)
+
+
+def _chat_payload(turn: ChatTurn, resp: LLMResponse, suggestions: Dict) -> Dict:
+    return {
+        "session_id": turn.session.id,
+        "response": resp.text,
+        "provider": resp.provider,
+        "model": resp.model,
+        "suggestions": suggestions,
+    }
+
+
+@login_required
+@require_POST
+@metrics.instrument("chat")
+@rate_limit("ai", _ai_rate_limit)
+@token_quota
+def chat_api(request):
+    error, prepared = _prepare_chat(request)
+    if error:
+        return error
+
+    repo, turn, site_context, suggestions, resp = prepared
+
+    if resp is None:
+        try:
+            resp = LLMService().generate_response(
+                user_message=turn.message,
+                conversation_history=turn.history,
+                site_context=site_context,
+                suggestions=suggestions,
+                summary=turn.session.summary,
+            )
+        except admission.Overloaded as e:
+            # Nothing saved: the client is told to retry the same message.
+            return admission.overloaded_response(e)
+        except Exception as e:
+            repo.save_exchange(turn)
+            return _ai_error_response(e)
+
+    with metrics.phase("persist"):
+        repo.save_exchange(turn, metrics.annotate(resp))
+    schedule_summary(turn.session.id)
+
+    return JsonResponse(_chat_payload(turn, resp, suggestions))
+
+
+@login_required
+@require_POST
+@metrics.instrument("stream")
+@rate_limit("ai", _ai_rate_limit)
+@token_quota
+def chat_stream_api(request):
+    """
+    Same contract as ``chat_api`` but relays the reply as Server-Sent Events:
+    ``meta`` (session id, suggestions), any number of ``delta`` events, then
+    ``done`` or ``error``. The turn is saved once the stream ends.
+    """
+    error, prepared = _prepare_chat(request)
+    if error:
+        return error
+
+    repo, turn, site_context, suggestions, fast = prepared
+
+    if fast is not None:
+        stream = LLMStream(fast.provider, fast.model, [fast.text], meta=fast.meta)
+    else:
+        stream = LLMService().stream_response(
+            user_message=turn.message,
+            conversation_history=turn.history,
+            site_context=site_context,
+            suggestions=suggestions,
+            summary=turn.session.summary,
+        )
+    chunks = iter(stream)
+
+    # Pull the first delta before committing to a 200 so upstream failures
+    # still map to the same status codes as chat_api.
+    try:
+        with metrics.phase("first_token"):
+            first = next(chunks, "")
+    except admission.Overloaded as e:
+        return admission.overloaded_response(e)
     except Exception as e:
-        logger.exception("AI chat failed: %s", str(e))
-        return JsonResponse(
-            {"error": f"AI internal error: {str(e)}"},
-            status=500,
+        repo.save_exchange(turn)
+        return _ai_error_response(e)
+
+    # The meta event carries the session id, so a new session is inserted now.
+    session = repo.ensure_session(turn)
+    # events() runs after this view returns, outside the metrics context.
+    timings = metrics.current() or metrics.Timings()
+
+    def events():
+        saved = False
+        try:
+            yield _sse("meta", {"session_id": session.id, "suggestions": suggestions})
+
+            if first:
+                yield _sse("delta", {"text": first})
+
+            try:
+                with timings.phase("stream"):
+                    for delta in chunks:
+                        yield _sse("delta", {"text": delta})
+            except Exception as e:
+                logger.exception("AI stream failed session_id=%s", session.id)
+                yield _sse("error", {"error": f"AI stream interrupted: {str(e)}"})
+                return
+
+            resp = metrics.annotate(stream.response, timings)
+            with timings.phase("persist"):
+                repo.save_exchange(turn, resp)
+            saved = True
+            schedule_summary(session.id)
+
+            yield _sse(
+                "done",
+                {
+                    "session_id": session.id,
+                    "response": resp.text,
+                    "provider": resp.provider,
+                    "model": resp.model,
+                    "ttft_ms": stream.ttft_ms,
+                },
+            )
+        finally:
+            # Broken stream or client gone: keep the user's message anyway.
+            if not saved:
+                repo.save_exchange(turn)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@metrics.instrument("async")
+@rate_limit("ai", _ai_rate_limit)
+@token_quota
+async def chat_async_api(request):
+    """
+    Async twin of ``chat_api`` for the ASGI entry point.
+
+    The provider call runs on ``httpx.AsyncClient`` so a waiting LLM reply
+    holds no worker thread; ORM access goes through the async queryset API
+    or ``sync_to_async``.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None:
+        return JsonResponse({"error": "Authentication required"}, status=401)
+
+    error, message, session_id = _parse_chat(request)
+    if error:
+        return error
+
+    repo = ChatRepository(user)
+    with metrics.phase("history"):
+        turn = await repo.aopen_turn(session_id, message)
+    if turn is None:
+        return JsonResponse({"error": "Session not found"}, status=404)
+
+    site_context, suggestions, resp = await sync_to_async(_chat_context)(user, message)
+
+    if resp is None:
+        try:
+            resp = await LLMService().agenerate_response(
+                user_message=turn.message,
+                conversation_history=turn.history,
+                site_context=site_context,
+                suggestions=suggestions,
+                summary=turn.session.summary,
+            )
+        except admission.Overloaded as e:
+            return admission.overloaded_response(e)
+        except Exception as e:
+            await repo.asave_exchange(turn)
+            return _ai_error_response(e)
+
+    with metrics.phase("persist"):
+        await repo.asave_exchange(turn, metrics.annotate(resp))
+    await sync_to_async(schedule_summary)(turn.session.id)
+
+    return JsonResponse(_chat_payload(turn, resp, suggestions))
+
+
+@login_required
+@require_POST
+@metrics.instrument("job")
+@rate_limit("ai", _ai_rate_limit)
+@token_quota
+def chat_job_api(request):
+    """
+    Queue the reply instead of waiting for it: stores the user message,
+    enqueues a ``GenerationJob`` for ``manage.py ai_worker`` and answers 202
+    with the job id to poll at ``chat_job_status_api``.
+    """
+    error, prepared = _prepare_chat(request)
+    if error:
+        return error
+
+    repo, turn, site_context, suggestions, fast = prepared
+
+    if fast is not None:
+        # Nothing to queue: answer at once, shaped like a finished job.
+        with metrics.phase("persist"):
+            repo.save_exchange(turn, metrics.annotate(fast))
+        return JsonResponse({"job_id": None, "status": GenerationJob.STATUS_DONE, **_chat_payload(turn, fast, suggestions)})
+
+    with metrics.phase("persist"), transaction.atomic():
+        (user_message,) = repo.save_exchange(turn)
+        job = jobs.enqueue(
+            turn.session,
+            user_message,
+            {
+                "message": turn.message,
+                "history": turn.history,
+                "site_context": site_context,
+                "suggestions": suggestions,
+                "summary": turn.session.summary,
+            },
         )
 
-    ChatMessage.objects.create(
-        session=session,
-        role=ChatMessage.ROLE_ASSISTANT,
-        content=resp.text,
-        meta={
-            "provider": resp.provider,
-            "model": resp.model,
-            **(resp.meta or {}),
+    return JsonResponse(
+        {
+            "job_id": job.id,
+            "session_id": turn.session.id,
+            "status": job.status,
+            "suggestions": suggestions,
         },
+        status=202,
     )
 
-    return JsonResponse(
-        {
+
+def _job_payload(job: GenerationJob) -> Dict:
+    data = {"job_id": job.id, "session_id": job.session_id, "status": job.status}
+
+    if job.status == GenerationJob.STATUS_DONE and job.result_message:
+        meta = job.result_message.meta or {}
+        data.update(
+            response=job.result_message.content,
+            provider=meta.get("provider"),
+            model=meta.get("model"),
+            suggestions=job.payload.get("suggestions"),
+        )
+    elif job.status == GenerationJob.STATUS_FAILED:
+        data["error"] = f"AI job failed: {job.error}"
+
+    return data
+
+
+async def chat_job_status_api(request, job_id: int):
+    """
+    Job status; with ``?wait=<seconds>`` (capped at ``AI_JOBS_LONGPOLL_SECONDS``)
+    the request is held until the job finishes or the wait runs out. Async so
+    a waiting client holds no worker thread under ASGI.
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None:
+        return JsonResponse({"error": "Authentication required"}, status=401)
+
+    try:
+        wait = max(0.0, float(request.GET.get("wait") or 0))
+    except ValueError:
+        return JsonResponse({"error": "wait must be a number of seconds"}, status=400)
+
+    deadline = time.monotonic() + min(wait, getattr(settings, "AI_JOBS_LONGPOLL_SECONDS", 25))
+    poll = getattr(settings, "AI_JOBS_POLL_SECONDS", 0.5)
+    qs = GenerationJob.objects.filter(id=job_id, session__user=user).select_related("result_message")
+
+    while True:
+        job = await qs.afirst()
+        if not job:
+            return JsonResponse({"error": "Job not found"}, status=404)
+        if job.status in (GenerationJob.STATUS_DONE, GenerationJob.STATUS_FAILED) or time.monotonic() >= deadline:
+            return JsonResponse(_job_payload(job))
+        await asyncio.sleep(poll)
+
+
+def _page_response(request, etag: str, build) -> HttpResponse:
+    # If-None-Match hit: 304 before the page is serialised (or, for messages, even read).
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+
+    response = JsonResponse(build())
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@login_required
+@require_GET
+def sessions_api(request):
+    """
+    The user's chat sessions, most recently used first. ``?limit=`` (capped
+    at ``AI_PAGE_SIZE_MAX``) and ``?cursor=`` from the previous page's
+    ``next_cursor``; keyset pagination, so every page costs one index seek.
+    """
+    try:
+        limit = page_size(request.GET.get("limit"))
+        page = ChatRepository(request.user).sessions_page(request.GET.get("cursor") or None, limit)
+    except InvalidPage as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    def build() -> Dict:
+        return {
+            "sessions": [
+                {
+                    "id": s.id,
+                    "title": s.title,
+                    "created_at": s.created_at.isoformat(),
+                    "updated_at": s.updated_at.isoformat(),
+                }
+                for s in page.items
+            ],
+            "next_cursor": page.next_cursor,
+        }
+
+    return _page_response(request, page_etag(page, "updated_at", "sessions", limit), build)
+
+
+@login_required
+@require_GET
+def session_messages_api(request, session_id: int):
+    """
+    A session's messages, a page at a time going back from the newest: the
+    first page is the latest ``limit`` messages and ``next_cursor`` loads the
+    ones before them. Each page lists its messages oldest first. Any new
+    message bumps the session's ``updated_at``, which keys the ETag, so a
+    revalidation that hits costs only the session lookup.
+    """
+    repo = ChatRepository(request.user)
+    session = repo.get_session(session_id)
+    if session is None:
+        return JsonResponse({"error": "Session not found"}, status=404)
+
+    cursor = request.GET.get("cursor") or None
+    try:
+        limit = page_size(request.GET.get("limit"))
+        if cursor:
+            decode_cursor(cursor)
+    except InvalidPage as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    etag = make_etag(["messages", session.id, session.updated_at.isoformat(), cursor, limit])
+
+    def build() -> Dict:
+        page = repo.messages_page(session, cursor, limit)
+        return {
             "session_id": session.id,
-            "response": resp.text,
-            "provider": resp.provider,
-            "model": resp.model,
-            "suggestions": suggestions,
+            "messages": [
+                {"id": m.id, "role": m.role, "content": m.content, "created_at": m.created_at.isoformat()}
+                for m in reversed(page.items)
+            ],
+            "next_cursor": page.next_cursor,
         }
-    )
\ No newline at end of file
+
+    return _page_response(request, etag, build)
+
+
+def metrics_api(request):
+    """
+    Prometheus text exposition of this worker's AI chat metrics. Open to
+    staff sessions, or to scrapers sending ``Authorization: Bearer
+    <AI_METRICS_TOKEN>`` when that setting is configured.
+    """
+    token = getattr(settings, "AI_METRICS_TOKEN", "")
+    auth = request.headers.get("Authorization", "")
+    bearer_ok = bool(token) and hmac.compare_digest(auth.encode(), f"Bearer {token}".encode())
+
+    if not bearer_ok and not (request.user.is_authenticated and request.user.is_staff):
+        return HttpResponseForbidden("Staff only")
+
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -31,27 +31,175 @@ PAYMENT_HOST = os.getenv("PAYMENT_HOST", "http://127.0.0.1:8000")
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY", "")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 
-AI_PROVIDER = os.getenv("AI_PROVIDER", "ollama")  # ollama | gemini
+AI_PROVIDER = os.getenv("AI_PROVIDER", "ollama")  # ollama | gemini | fake | replay
+# Ordered failover providers tried when AI_PROVIDER errors or its circuit is open, e.g. "gemini".
+AI_PROVIDER_FALLBACKS = [p.strip() for p in os.getenv("AI_PROVIDER_FALLBACKS", "").split(",") if p.strip()]
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
+OLLAMA_API = os.getenv("OLLAMA_API", "native")  # native (/api/chat) | openai (/v1/chat/completions)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # how long the model stays loaded; -1 = forever
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "4096"))  # 0 = model default
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "512"))  # max reply tokens; 0 = unlimited
+OLLAMA_WARMUP_SECONDS = int(os.getenv("OLLAMA_WARMUP_SECONDS", "600"))  # re-warm interval per process; 0 = off
+# Start the warm-up thread when the app loads. Set it only in the web server's environment:
+# every process that loads Django (migrate, shell, tests) would warm the model too.
+AI_WARMUP_ON_START = os.getenv("AI_WARMUP_ON_START", "0") == "1"
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_CONTEXT_CACHE_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_SECONDS", "3600"))  # cachedContents TTL; 0 = off
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))  # the model's caching minimum
 
 AI_RATE_LIMIT_PER_MIN = int(os.getenv("AI_RATE_LIMIT_PER_MIN", "12"))
+# Sliding-window rate limiter storage: "db" (shared, one upsert per check), "cache" or "memory" (single worker only).
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "db")
+COMMUNITY_RATE_LIMIT_PER_MIN = int(os.getenv("COMMUNITY_RATE_LIMIT_PER_MIN", "30"))
 AI_CACHE_SECONDS = int(os.getenv("AI_CACHE_SECONDS", "120"))
+# First messages that don't talk about the asker are answered without the membership and cached
+# under catalog version + normalised question, so every user shares them (services/cacheability.py).
+AI_SHARED_CACHE = os.getenv("AI_SHARED_CACHE", "1") == "1"
+AI_SHARED_CACHE_MAX_CHARS = int(os.getenv("AI_SHARED_CACHE_MAX_CHARS", "160"))
 AI_TIMEOUT_SECONDS = int(os.getenv("AI_TIMEOUT_SECONDS", "12"))
+# Admission control for upstream model calls (services/admission.py). Keep the per-process limit
+# plus the queue below the worker's thread count so non-AI requests always find a free thread.
+AI_ADMISSION_ENABLED = os.getenv("AI_ADMISSION_ENABLED", "1") == "1"
+AI_MAX_CONCURRENT_PER_PROCESS = int(os.getenv("AI_MAX_CONCURRENT_PER_PROCESS", "4"))
+AI_ADMISSION_QUEUE = int(os.getenv("AI_ADMISSION_QUEUE", "8"))  # waiters per process; beyond that: 503 at once
+AI_ADMISSION_WAIT_SECONDS = float(os.getenv("AI_ADMISSION_WAIT_SECONDS", "5"))
+AI_MAX_CONCURRENT_CLUSTER = int(os.getenv("AI_MAX_CONCURRENT_CLUSTER", "16"))  # leases in the shared cache; 0 = off
+AI_ADMISSION_RESERVED_SLOTS = int(os.getenv("AI_ADMISSION_RESERVED_SLOTS", "4"))  # cluster slots only active members get
+AI_ADMISSION_MEMBER_PRIORITY = os.getenv("AI_ADMISSION_MEMBER_PRIORITY", "1") == "1"
+AI_ADMISSION_LEASE_SECONDS = int(os.getenv("AI_ADMISSION_LEASE_SECONDS", "120"))
+AI_ADMISSION_RETRY_AFTER = int(os.getenv("AI_ADMISSION_RETRY_AFTER", "5"))
+# Token quotas over rolling windows (prompt + completion tokens of upstream calls); 0 = no quota
+AI_TOKENS_PER_MIN = int(os.getenv("AI_TOKENS_PER_MIN", "0"))
+AI_TOKENS_PER_DAY = int(os.getenv("AI_TOKENS_PER_DAY", "0"))
+AI_GLOBAL_TOKENS_PER_MIN = int(os.getenv("AI_GLOBAL_TOKENS_PER_MIN", "0"))
+AI_GLOBAL_TOKENS_PER_DAY = int(os.getenv("AI_GLOBAL_TOKENS_PER_DAY", "0"))
+AI_CATALOG_CACHE_SECONDS = int(os.getenv("AI_CATALOG_CACHE_SECONDS", "86400"))  # snapshot lifetime in the shared cache
+
+# Prompt catalog rows: "retrieval" (the AI_RETRIEVAL_TOP_K trainers/programs most similar to the question)
+# or "catalog" (the first 30 of each, same for every question).
+AI_CONTEXT_MODE = os.getenv("AI_CONTEXT_MODE", "retrieval")
+AI_RETRIEVAL_TOP_K = int(os.getenv("AI_RETRIEVAL_TOP_K", "6"))
+AI_RETRIEVAL_MIN_SIMILARITY = float(os.getenv("AI_RETRIEVAL_MIN_SIMILARITY", "0.1"))  # below this a row is not a match
+AI_CATALOG_VECTOR_DIM = int(os.getenv("AI_CATALOG_VECTOR_DIM", "256"))
+# Memory-mapped catalog vectors shared by every process on the host; empty = keep them in memory only.
+AI_CATALOG_VECTOR_DIR = os.getenv("AI_CATALOG_VECTOR_DIR", str(BASE_DIR / "var" / "ai_vectors"))
+
+# Templated answers for site-navigation questions ("how do I buy a membership?"), no model call.
+AI_INTENTS_ENABLED = os.getenv("AI_INTENTS_ENABLED", "1") == "1"
+AI_INTENT_MAX_CHARS = int(os.getenv("AI_INTENT_MAX_CHARS", "80"))  # longer questions always go to the model
+AI_INTENT_LIST_LIMIT = int(os.getenv("AI_INTENT_LIST_LIMIT", "10"))  # programs/trainers listed in an answer
+
+# Shared, keep-alive HTTP connection pools for LLM providers (one per provider per worker).
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "20"))
+AI_HTTP_MAX_KEEPALIVE = int(os.getenv("AI_HTTP_MAX_KEEPALIVE", "10"))
+AI_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AI_HTTP_KEEPALIVE_EXPIRY", "60"))
+AI_HTTP2 = os.getenv("AI_HTTP2", "1") == "1"  # used only when the `h2` package is installed
+
+# Optional near-duplicate answer cache (in-process, NumPy-backed).
+AI_SEMANTIC_CACHE = os.getenv("AI_SEMANTIC_CACHE", "0") == "1"
+AI_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("AI_SEMANTIC_CACHE_THRESHOLD", "0.85"))
+AI_SEMANTIC_CACHE_SIZE = int(os.getenv("AI_SEMANTIC_CACHE_SIZE", "2000"))
+AI_SEMANTIC_CACHE_SECONDS = int(os.getenv("AI_SEMANTIC_CACHE_SECONDS", "600"))
+AI_SEMANTIC_CACHE_DIM = int(os.getenv("AI_SEMANTIC_CACHE_DIM", "512"))
+
+# Per-provider prompt token budgets (estimated tokens for system block + history + message).
+AI_PROMPT_TOKEN_BUDGET = {
+    "ollama": int(os.getenv("AI_PROMPT_TOKENS_OLLAMA", "1800")),
+    "gemini": int(os.getenv("AI_PROMPT_TOKENS_GEMINI", "6000")),
+}
+AI_PROMPT_MIN_HISTORY = int(os.getenv("AI_PROMPT_MIN_HISTORY", "2"))
+
+# Conversation memory: recent raw turns + a rolling summary of older ones.
+AI_HISTORY_MESSAGES = int(os.getenv("AI_HISTORY_MESSAGES", "10"))
+AI_SUMMARY_ENABLED = os.getenv("AI_SUMMARY_ENABLED", "1") == "1"
+AI_SUMMARY_ASYNC = os.getenv("AI_SUMMARY_ASYNC", "1") == "1"  # summarise in a background thread
+AI_SUMMARY_TRIGGER = int(os.getenv("AI_SUMMARY_TRIGGER", "12"))  # unsummarised messages before folding
+AI_SUMMARY_KEEP_RECENT = int(os.getenv("AI_SUMMARY_KEEP_RECENT", "6"))
+AI_SUMMARY_MAX_WORDS = int(os.getenv("AI_SUMMARY_MAX_WORDS", "120"))
+AI_SUMMARY_MAX_CHARS = int(os.getenv("AI_SUMMARY_MAX_CHARS", "1200"))
+
+# Multi-provider router (active when AI_PROVIDER_FALLBACKS is set).
+AI_ROUTER_WINDOW = int(os.getenv("AI_ROUTER_WINDOW", "100"))  # rolling samples per provider
+AI_ROUTER_FAILURE_THRESHOLD = int(os.getenv("AI_ROUTER_FAILURE_THRESHOLD", "3"))  # consecutive failures to open
+AI_ROUTER_OPEN_SECONDS = int(os.getenv("AI_ROUTER_OPEN_SECONDS", "30"))
+AI_ROUTER_HEDGE = os.getenv("AI_ROUTER_HEDGE", "0") == "1"
+AI_ROUTER_HEDGE_MIN_SAMPLES = int(os.getenv("AI_ROUTER_HEDGE_MIN_SAMPLES", "20"))
+AI_ROUTER_HEDGE_MULTIPLIER = float(os.getenv("AI_ROUTER_HEDGE_MULTIPLIER", "1.0"))
+
+# Single-flight: identical in-flight prompts wait for one upstream call.
+AI_SINGLEFLIGHT_LOCK_SECONDS = int(os.getenv("AI_SINGLEFLIGHT_LOCK_SECONDS", str(AI_TIMEOUT_SECONDS + 5)))
+AI_SINGLEFLIGHT_POLL_MS = int(os.getenv("AI_SINGLEFLIGHT_POLL_MS", "100"))
+
+# Queued generation (/api/ai/chat/jobs/ + `manage.py ai_worker`).
+AI_JOBS_CONCURRENCY = int(os.getenv("AI_JOBS_CONCURRENCY", "8"))  # jobs in flight per worker process
+AI_JOBS_POLL_SECONDS = float(os.getenv("AI_JOBS_POLL_SECONDS", "0.5"))
+AI_JOBS_LONGPOLL_SECONDS = int(os.getenv("AI_JOBS_LONGPOLL_SECONDS", "25"))
+AI_JOBS_STALE_SECONDS = int(os.getenv("AI_JOBS_STALE_SECONDS", "120"))  # running longer than this = worker died
+AI_JOBS_MAX_ATTEMPTS = int(os.getenv("AI_JOBS_MAX_ATTEMPTS", "2"))
+
+# Bearer token for Prometheus scraping /api/ai/metrics/ (staff sessions can always read it).
+AI_METRICS_TOKEN = os.getenv("AI_METRICS_TOKEN", "")
+
+# Page sizes for /api/ai/sessions/ and /api/ai/sessions/<id>/messages/ (?limit= is capped at the max).
+AI_PAGE_SIZE = int(os.getenv("AI_PAGE_SIZE", "20"))
+AI_PAGE_SIZE_MAX = int(os.getenv("AI_PAGE_SIZE_MAX", "100"))
+
+# Chat retention (manage.py ai_archive): idle sessions move to compressed ArchivedSession rows.
+AI_RETENTION_DAYS = int(os.getenv("AI_RETENTION_DAYS", "90"))
+AI_RETENTION_BATCH = int(os.getenv("AI_RETENTION_BATCH", "500"))  # hot rows deleted per transaction
+AI_ARCHIVE_CODEC = os.getenv("AI_ARCHIVE_CODEC", "auto")  # auto (zstd when `zstandard` is installed) | zstd | gzip
+
+# AI_PROVIDER=replay: answer from a recorded cassette (see services/replay.py and the load-testing notes).
+AI_REPLAY_CASSETTE = os.getenv("AI_REPLAY_CASSETTE", str(BASE_DIR / "ai_cassette.jsonl"))
+AI_REPLAY_RECORD_FROM = os.getenv("AI_REPLAY_RECORD_FROM", "")  # e.g. "ollama": call it and record every reply
+AI_REPLAY_ON_MISS = os.getenv("AI_REPLAY_ON_MISS", "error")  # error | cycle (reuse some recorded reply)
+AI_REPLAY_LATENCY = os.getenv("AI_REPLAY_LATENCY", "1") == "1"  # sleep for the recorded upstream latency
 
 ALLOWED_HOSTS = [h.strip() for h in os.getenv("ALLOWED_HOSTS", "127.0.0.1,localhost").split(",") if h.strip()]
 
 CSRF_TRUSTED_ORIGINS = [o.strip() for o in os.getenv("CSRF_TRUSTED_ORIGINS", "").split(",") if o.strip()]
 
-CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "LOCATION": "roshaclub-cache",
+# CACHE_BACKEND=tiered: a per-process LRU in front of a cache every gunicorn worker shares, so
+# rate limits, single-flight locks, the catalog version and cached answers agree across workers
+# and survive restarts. The shared tier is a SQLite file on this host unless CACHE_REDIS_URL is
+# set (then tier-1 copies are trusted for CACHE_L1_TIMEOUT seconds). "locmem" is per process;
+# `manage.py test` always uses it (capstone/test_runner.py) so runs never share state through the file.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "tiered")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", str(BASE_DIR / "var" / "cache.sqlite3"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "")
+if CACHE_BACKEND == "tiered":
+    CACHES = {
+        "default": {
+            "BACKEND": "services.cache_backends.TieredCache",
+            "LOCATION": "roshaclub-cache",
+            "OPTIONS": {
+                "SHARED": "shared",
+                "L1_MAX_ENTRIES": int(os.getenv("CACHE_L1_MAX_ENTRIES", "2000")),
+                "L1_TIMEOUT": float(os.getenv("CACHE_L1_TIMEOUT", "5")),
+                "SYNC_INTERVAL": float(os.getenv("CACHE_SYNC_INTERVAL", "0.5")),  # seconds between change-feed polls
+            },
+        },
+        "shared": (
+            {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": CACHE_REDIS_URL}
+            if CACHE_REDIS_URL
+            else {
+                "BACKEND": "services.cache_backends.SQLiteCache",
+                "LOCATION": CACHE_SQLITE_PATH,
+                "OPTIONS": {"MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", "100000"))},
+            }
+        ),
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "roshaclub-cache",
+        }
     }
-}
 
 # Site ID
 
@@ -104,6 +252,8 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'capstone.wsgi.application'
 
+TEST_RUNNER = 'capstone.test_runner.TestRunner'
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
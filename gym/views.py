@@ -14,6 +14,8 @@ from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.csrf import csrf_exempt
 from django.urls import reverse
 
+from services.ratelimit import rate_limit
+
 from .models import Membership, Payment, Post, Trainer, TrainingProgram
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
@@ -390,7 +392,12 @@ def community(request):
     )
 
 
+def _community_rate_limit():
+    return getattr(settings, "COMMUNITY_RATE_LIMIT_PER_MIN", 30)
+
+
 @login_required
+@rate_limit("community", _community_rate_limit)
 def new_post(request):
     if request.method == "POST":
         content = request.POST.get("content")
@@ -400,6 +407,7 @@ def new_post(request):
 
 
 @login_required
+@rate_limit("community", _community_rate_limit)
 def edit_post(request, post_id):
     post = get_object_or_404(Post, id=post_id)
 
@@ -422,6 +430,7 @@ def edit_post(request, post_id):
 
 
 @login_required
+@rate_limit("community", _community_rate_limit)
 def like_add(request, post_id):
     if request.method != "POST":
         return JsonResponse({"error": "Invalid request method."}, status=405)
@@ -432,6 +441,7 @@ def like_add(request, post_id):
 
 
 @login_required
+@rate_limit("community", _community_rate_limit)
 def like_remove(request, post_id):
     if request.method != "POST":
         return JsonResponse({"error": "Invalid request method."}, status=405)
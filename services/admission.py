@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+SLOT_KEY = "ai:admission:slot"
+
+
+class Overloaded(Exception):
+    """The model is saturated: no slot within the deadline, or the wait queue is full."""
+
+    def __init__(self, reason: str, retry_after: int) -> None:
+        super().__init__(f"AI overloaded ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _retry_after() -> int:
+    return getattr(settings, "AI_ADMISSION_RETRY_AFTER", 5)
+
+
+class ProcessLimiter:
+    """
+    At most ``limit`` upstream calls at once in this process, plus at most
+    ``queue_size`` callers waiting for one. Waiters are served in priority
+    order, then arrival order; a full queue is rejected at once.
+    """
+
+    def __init__(self, limit: int, queue_size: int) -> None:
+        self.limit = limit
+        self.queue_size = queue_size
+        self._cond = threading.Condition()
+        self._waiting: List[Tuple[int, int]] = []  # heap of (rank, arrival)
+        self._arrivals = itertools.count()
+        self.active = 0
+        self.counts = {"admitted": 0, "queued": 0, "queue_full": 0, "timeout": 0}
+
+    def acquire(self, priority: bool, deadline: float) -> None:
+        with self._cond:
+            if self.active < self.limit and not self._waiting:
+                self.active += 1
+                self.counts["admitted"] += 1
+                return
+            if len(self._waiting) >= self.queue_size:
+                self.counts["queue_full"] += 1
+                raise Overloaded("queue_full", _retry_after())
+
+            entry = (0 if priority else 1, next(self._arrivals))
+            heapq.heappush(self._waiting, entry)
+            self.counts["queued"] += 1
+            try:
+                while self.active >= self.limit or self._waiting[0] != entry:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counts["timeout"] += 1
+                        raise Overloaded("timeout", _retry_after())
+                    self._cond.wait(remaining)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self.active += 1
+            self.counts["admitted"] += 1
+            # The next waiter may fit too.
+            self._cond.notify_all()
+
+    def release(self) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"limit": self.limit, "active": self.active, "waiting": len(self._waiting), **self.counts}
+
+
+class ClusterSlots:
+    """
+    Cluster-wide limit as ``limit`` lease keys in the shared cache; taking
+    a slot is ``cache.add`` (atomic "set if absent"). Leases expire, so a
+    crashed worker's slots come back. The last ``reserved`` slots are for
+    priority callers only. Like ``ClusterLock``, this is cluster-wide only
+    when CACHES is shared between workers.
+    """
+
+    def __init__(self, limit: int, reserved: int, lease: float) -> None:
+        self.limit = limit
+        self.reserved = min(reserved, max(0, limit - 1))
+        self.lease = lease
+
+    def _keys(self, priority: bool) -> List[str]:
+        usable = self.limit if priority else self.limit - self.reserved
+        return [f"{SLOT_KEY}:{i}" for i in range(usable)]
+
+    def try_acquire(self, priority: bool, token: str) -> Optional[str]:
+        keys = self._keys(priority)
+        # Read first (cheap, tier-1 cached), then only try to take slots that look free.
+        taken = cache.get_many(keys)
+        free = [k for k in keys if k not in taken]
+        random.shuffle(free)
+        for key in free[:2]:
+            if cache.add(key, token, timeout=self.lease):
+                return key
+        return None
+
+    def acquire(self, priority: bool, token: str, deadline: float) -> str:
+        poll = getattr(settings, "AI_ADMISSION_POLL_MS", 50) / 1000
+        while True:
+            key = self.try_acquire(priority, token)
+            if key is not None:
+                return key
+            if time.monotonic() + poll > deadline:
+                raise Overloaded("cluster_timeout", _retry_after())
+            time.sleep(poll)
+
+    def release(self, key: str, token: str) -> None:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+_limiter: Optional[ProcessLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> ProcessLimiter:
+    global _limiter
+    limit = getattr(settings, "AI_MAX_CONCURRENT_PER_PROCESS", 4)
+    queue_size = getattr(settings, "AI_ADMISSION_QUEUE", 8)
+    with _limiter_lock:
+        if _limiter is None or (_limiter.limit, _limiter.queue_size) != (limit, queue_size):
+            _limiter = ProcessLimiter(limit, queue_size)
+        return _limiter
+
+
+def is_priority(membership: Optional[Dict[str, Any]]) -> bool:
+    """Users with an active membership go first when ``AI_ADMISSION_MEMBER_PRIORITY`` is on."""
+    if not getattr(settings, "AI_ADMISSION_MEMBER_PRIORITY", True) or not membership:
+        return False
+    return membership.get("status") == "active" and (membership.get("end_date") or "") >= date.today().isoformat()
+
+
+def _enabled() -> bool:
+    return bool(getattr(settings, "AI_ADMISSION_ENABLED", True))
+
+
+def _acquire(priority: bool) -> Callable[[], None]:
+    """Take a slot as described in ``slot``; returns the function that gives it back."""
+    deadline = time.monotonic() + getattr(settings, "AI_ADMISSION_WAIT_SECONDS", 5)
+    limiter = get_limiter()
+    cluster_limit = getattr(settings, "AI_MAX_CONCURRENT_CLUSTER", 0)
+    started = time.perf_counter()
+
+    with metrics.phase("admission"):
+        try:
+            limiter.acquire(priority, deadline)
+        except Overloaded as e:
+            metrics.note(admission=e.reason)
+            logger.warning("AI request shed reason=%s priority=%s", e.reason, priority)
+            raise
+
+        key = token = slots = None
+        if cluster_limit:
+            slots = ClusterSlots(
+                cluster_limit,
+                getattr(settings, "AI_ADMISSION_RESERVED_SLOTS", 0),
+                getattr(settings, "AI_ADMISSION_LEASE_SECONDS", 120),
+            )
+            token = uuid.uuid4().hex
+            try:
+                key = slots.acquire(priority, token, deadline)
+            except BaseException as e:
+                limiter.release()
+                if isinstance(e, Overloaded):
+                    metrics.note(admission=e.reason)
+                    logger.warning("AI request shed reason=%s priority=%s", e.reason, priority)
+                raise
+
+    waited_ms = round((time.perf_counter() - started) * 1000, 1)
+    metrics.note(admission="admitted", admission_wait_ms=waited_ms)
+
+    def release() -> None:
+        if key is not None:
+            slots.release(key, token)
+        limiter.release()
+
+    return release
+
+
+@contextmanager
+def slot(priority: bool = False) -> Iterator[None]:
+    """
+    Hold one upstream-call slot: first this process's (bounded, prioritised
+    wait queue), then a cluster-wide lease, both within
+    ``AI_ADMISSION_WAIT_SECONDS``. Raises ``Overloaded`` instead of waiting
+    longer, so saturated model calls cannot tie up every worker thread.
+    """
+    if not _enabled():
+        yield
+        return
+
+    release = _acquire(priority)
+    try:
+        yield
+    finally:
+        release()
+
+
+def _release_when_acquired(task: "asyncio.Future[Callable[[], None]]") -> None:
+    if not task.cancelled() and task.exception() is None:
+        task.result()()
+
+
+@asynccontextmanager
+async def aslot(priority: bool = False) -> AsyncIterator[None]:
+    """``slot`` for the async endpoint and the job worker; the wait runs on a thread, not the event loop."""
+    if not _enabled():
+        yield
+        return
+
+    acquiring = asyncio.ensure_future(sync_to_async(_acquire, thread_sensitive=False)(priority))
+    try:
+        release = await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # The caller went away while waiting: give the slot back once the thread gets it.
+        acquiring.add_done_callback(_release_when_acquired)
+        raise
+    try:
+        yield
+    finally:
+        await sync_to_async(release, thread_sensitive=False)()
+
+
+def overloaded_response(e: Overloaded) -> JsonResponse:
+    response = JsonResponse(
+        {"error": "The AI assistant is busy right now. Please try again shortly.", "retry_after": e.retry_after},
+        status=503,
+    )
+    response["Retry-After"] = str(e.retry_after)
+    return response
+
+
+def stats() -> Dict[str, Any]:
+    return get_limiter().stats()
+
+
+def _slot_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    s = stats()
+    for state in ("limit", "active", "waiting"):
+        yield {"state": state}, s[state]
+
+
+metrics.ADMISSION_SLOTS.sources.append(_slot_series)
@@ -1,12 +1,24 @@
+import asyncio
 import hashlib
+import json
 import logging
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+import random
+import time
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import httpx
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import cache
 
+from services import admission, metrics
+from services.cacheability import Cacheability, classify
+from services.http_clients import get_pool
+from services.prompt import Prompt, PromptBuilder, estimate_tokens
+from services.summary import summary_messages
+from services.singleflight import ClusterLock, await_for, flights, wait_for
+
 logger = logging.getLogger(__name__)
 
 SYSTEM_PROMPT = (
@@ -30,6 +42,39 @@ class LLMResponse:
     meta: Dict[str, Any]
 
 
+def prompt_hash(messages: List[Dict[str, str]]) -> str:
+    """Provider-independent part of the LLMService cache key; also keys replay cassettes."""
+    raw = "|".join(f"{m.get('role')}:{m.get('content')}" for m in messages[-12:])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
+
+
+class StreamUsage(str):
+    """
+    Empty delta a provider stream yields after its text, carrying the token
+    counts (``tokens_in``/``tokens_out``, optionally ``tokens_cached``) in
+    ``usage``; joins as "".
+    """
+
+    usage: Dict[str, Any]
+
+    def __new__(cls, **usage: Any) -> "StreamUsage":
+        marker = super().__new__(cls, "")
+        marker.usage = usage
+        return marker
+
+
+def _iter_sse_data(response: httpx.Response) -> Iterator[str]:
+    for line in response.iter_lines():
+        line = line.strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        if data:
+            yield data
+
+
 class BaseProvider:
     name: str
     model: str
@@ -37,70 +82,265 @@ class BaseProvider:
     def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
         raise NotImplementedError
 
+    async def achat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        # Fallback for providers without a native async client.
+        return await sync_to_async(self.chat, thread_sensitive=False)(messages)
+
+    def stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        # Providers without native streaming deliver the whole answer as one delta.
+        resp = self.chat(messages)
+        yield resp.text
+        yield StreamUsage(tokens_in=(resp.meta or {}).get("tokens_in"), tokens_out=(resp.meta or {}).get("tokens_out"))
+
+    def warm_up(self, prefix: Optional[List[Dict[str, str]]] = None) -> bool:
+        """Preload the model upstream; False when the provider has nothing to warm."""
+        return False
+
 
 class OllamaProvider(BaseProvider):
+    """
+    ``OLLAMA_API=native`` (default) talks to ``/api/chat``, which accepts
+    ``keep_alive`` and model options (``num_ctx``, ``num_predict``) and
+    reports load/eval timings; ``OLLAMA_API=openai`` uses the
+    OpenAI-compatible ``/v1/chat/completions`` endpoint instead.
+    """
+
     def __init__(self) -> None:
         self.name = "ollama"
         self.model = getattr(settings, "OLLAMA_MODEL", "qwen2.5:7b")
         self.base_url = getattr(settings, "OLLAMA_BASE_URL", "http://127.0.0.1:11434").rstrip("/")
+        self.native = (getattr(settings, "OLLAMA_API", "native") or "native").lower() != "openai"
 
-    def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
-        timeout = httpx.Timeout(getattr(settings, "AI_TIMEOUT_SECONDS", 20))
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(getattr(settings, "AI_TIMEOUT_SECONDS", 20))
 
-        url = f"{self.base_url}/v1/chat/completions"
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "stream": False,
-            "temperature": 0.7,
-        }
+    def _url(self) -> str:
+        if self.native:
+            return f"{self.base_url}/api/chat"
+        return f"{self.base_url}/v1/chat/completions"
 
+    def _keep_alive(self) -> Any:
+        value = str(getattr(settings, "OLLAMA_KEEP_ALIVE", "30m")).strip()
+        # Ollama takes a duration ("30m") or a number of seconds (-1 keeps the model loaded).
+        return int(value) if value.lstrip("-").isdigit() else value
+
+    def _options(self, **overrides: Any) -> Dict[str, Any]:
+        # Must match between warm-up and chat calls: a different num_ctx reloads the model.
+        options: Dict[str, Any] = {"temperature": 0.7}
+        if getattr(settings, "OLLAMA_NUM_CTX", 0):
+            options["num_ctx"] = settings.OLLAMA_NUM_CTX
+        if getattr(settings, "OLLAMA_NUM_PREDICT", 0):
+            options["num_predict"] = settings.OLLAMA_NUM_PREDICT
+        options.update(overrides)
+        return options
+
+    def _payload(self, messages: List[Dict[str, str]], stream: bool = False) -> Dict[str, Any]:
         logger.info(
-            "Sending Ollama request model=%s timeout=%s messages=%s",
+            "Sending Ollama request model=%s api=%s timeout=%s messages=%s stream=%s",
             self.model,
+            "native" if self.native else "openai",
             getattr(settings, "AI_TIMEOUT_SECONDS", 20),
             len(messages),
+            stream,
         )
 
-        with httpx.Client(timeout=timeout) as client:
-            r = client.post(url, json=payload)
+        if self.native:
+            return {
+                "model": self.model,
+                "messages": messages,
+                "stream": stream,
+                "keep_alive": self._keep_alive(),
+                "options": self._options(),
+            }
 
-            if r.status_code >= 400:
-                logger.error(
-                    "Ollama API error status=%s model=%s body=%s",
-                    r.status_code,
-                    self.model,
-                    r.text[:2000],
-                )
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream,
+            "temperature": 0.7,
+        }
+        if stream:
+            # Ask for a final usage chunk so streamed replies count their tokens too.
+            payload["stream_options"] = {"include_usage": True}
+        return payload
 
-            r.raise_for_status()
-            data = r.json()
+    def _check(self, r: httpx.Response) -> None:
+        if r.status_code >= 400:
+            logger.error(
+                "Ollama API error status=%s model=%s body=%s",
+                r.status_code,
+                self.model,
+                r.text[:2000],
+            )
 
-        text = ""
-        choices = data.get("choices") or []
-        if choices:
-            msg = choices[0].get("message") or {}
-            text = (msg.get("content") or "").strip()
+        r.raise_for_status()
+
+    def _native_meta(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        # Durations are nanoseconds. prompt_eval_count only counts tokens that
+        # missed Ollama's prompt cache, so it drops when the prefix is reused.
+        return {
+            "tokens_in": data.get("prompt_eval_count"),
+            "tokens_out": data.get("eval_count"),
+            "load_ms": round((data.get("load_duration") or 0) / 1e6, 1),
+            "prompt_eval_ms": round((data.get("prompt_eval_duration") or 0) / 1e6, 1),
+        }
+
+    def _parse(self, data: Dict[str, Any], status_code: int = 200) -> LLMResponse:
+        if self.native:
+            text = ((data.get("message") or {}).get("content") or "").strip()
+            meta = {"http_status": status_code, **self._native_meta(data)}
+        else:
+            text = ""
+            choices = data.get("choices") or []
+            if choices:
+                msg = choices[0].get("message") or {}
+                text = (msg.get("content") or "").strip()
+
+            usage = data.get("usage") or {}
+            meta = {
+                "http_status": status_code,
+                "tokens_in": usage.get("prompt_tokens"),
+                "tokens_out": usage.get("completion_tokens"),
+            }
 
         if not text:
             text = "I didn't get a response. Please try again."
 
-        return LLMResponse(
-            text=text,
-            provider=self.name,
-            model=self.model,
-            meta={},
+        return LLMResponse(text=text, provider=self.name, model=self.model, meta=meta)
+
+    def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        payload = self._payload(messages)
+
+        client = get_pool(self.name).client()
+        r = client.post(self._url(), json=payload, timeout=self._timeout())
+        self._check(r)
+        data = r.json()
+
+        return self._parse(data, r.status_code)
+
+    async def achat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        payload = self._payload(messages)
+
+        client = get_pool(self.name).async_client()
+        r = await client.post(self._url(), json=payload, timeout=self._timeout())
+        self._check(r)
+        data = r.json()
+
+        return self._parse(data, r.status_code)
+
+    def stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        payload = self._payload(messages, stream=True)
+
+        client = get_pool(self.name).client()
+        with client.stream("POST", self._url(), json=payload, timeout=self._timeout()) as r:
+            if r.status_code >= 400:
+                r.read()
+            self._check(r)
+
+            if self.native:
+                yield from self._stream_native(r)
+                return
+
+            for data in _iter_sse_data(r):
+                chunk = json.loads(data)
+                usage = chunk.get("usage")
+                if usage:
+                    yield StreamUsage(tokens_in=usage.get("prompt_tokens"), tokens_out=usage.get("completion_tokens"))
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                delta = choices[0].get("delta") or {}
+                text = delta.get("content") or ""
+                if text:
+                    yield text
+
+    def _stream_native(self, r: httpx.Response) -> Iterator[str]:
+        # One JSON object per line; the last one has done=true.
+        for line in r.iter_lines():
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise RuntimeError(f"Ollama stream error: {chunk['error']}")
+            text = (chunk.get("message") or {}).get("content") or ""
+            if text:
+                yield text
+            if chunk.get("done"):
+                yield StreamUsage(**self._native_meta(chunk))
+                return
+
+    def warm_up(self, prefix: Optional[List[Dict[str, str]]] = None) -> bool:
+        """
+        Load the model (and keep it loaded for ``OLLAMA_KEEP_ALIVE``) before
+        a user needs it. With ``prefix`` messages the shared prompt prefix is
+        evaluated too, so the next chat starts from a warm KV cache.
+        """
+        payload = {
+            "model": self.model,
+            "messages": prefix or [],
+            "stream": False,
+            "keep_alive": self._keep_alive(),
+            "options": self._options(num_predict=1),
+        }
+        started = time.monotonic()
+        client = get_pool(self.name).client()
+        r = client.post(f"{self.base_url}/api/chat", json=payload, timeout=self._timeout())
+        self._check(r)
+        logger.info(
+            "Ollama warm-up model=%s prefix_messages=%s seconds=%.2f load_ms=%s",
+            self.model,
+            len(prefix or []),
+            time.monotonic() - started,
+            round((r.json().get("load_duration") or 0) / 1e6, 1),
         )
+        return True
 
 
 class GeminiProvider(BaseProvider):
+    """
+    Gemini's ``generateContent`` API with native turns: the first system
+    message (system prompt + catalog, the same for every user) is the
+    ``systemInstruction``, later system messages (summary, per-user block)
+    lead the next user turn, and assistant turns are ``model`` turns.
+
+    When the prefix is long enough for Gemini's context caching
+    (``GEMINI_CONTEXT_CACHE_MIN_TOKENS``) it is uploaded once as a
+    ``cachedContents`` handle, shared by every worker through the Django
+    cache, and requests send only the handle and the turns. A new prefix
+    (the catalog changed) gets a new handle and the old one is deleted;
+    handles are renewed before ``GEMINI_CONTEXT_CACHE_SECONDS`` runs out.
+    """
+
+    HANDLE_KEY = "ai:gemini:cached_content"
+    # Handles rejected by a generate call: 400/403 (e.g. expired) or 404 (deleted).
+    STALE_HANDLE_STATUSES = (400, 403, 404)
+
     def __init__(self) -> None:
         self.name = "gemini"
         self.model = getattr(settings, "GEMINI_MODEL", "gemini-2.5-flash")
         self.api_key = getattr(settings, "GEMINI_API_KEY", "")
+        self.base_url = getattr(settings, "GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
 
-    def _messages_to_prompt(self, messages: List[Dict[str, str]]) -> str:
-        lines: List[str] = []
+    def _split(self, messages: List[Dict[str, str]]) -> Tuple[str, List[Dict[str, Any]]]:
+        """The static prefix (first system message) and the ``contents`` turns for the rest."""
+        if not self.api_key:
+            raise RuntimeError("GEMINI_API_KEY is missing")
+
+        prefix = ""
+        if messages and messages[0].get("role") == "system":
+            prefix = (messages[0].get("content") or "").strip()
+            messages = messages[1:]
+
+        contents: List[Dict[str, Any]] = []
+        pending: List[str] = []
+
+        def add(role: str, texts: List[str]) -> None:
+            # Gemini wants user and model turns to alternate.
+            parts = [{"text": t} for t in texts]
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"].extend(parts)
+            else:
+                contents.append({"role": role, "parts": parts})
 
         for m in messages:
             role = (m.get("role") or "").strip().lower()
@@ -110,52 +350,175 @@ class GeminiProvider(BaseProvider):
                 continue
 
             if role == "system":
-                lines.append(f"System: {content}")
+                pending.append(content)
             elif role == "assistant":
-                lines.append(f"Assistant: {content}")
+                add("model", [content])
             else:
-                lines.append(f"User: {content}")
+                add("user", pending + [content])
+                pending = []
 
-        lines.append("Assistant:")
-        return "\n\n".join(lines)
+        if pending:
+            add("user", pending)
+        return prefix, contents
 
-    def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
-        if not self.api_key:
-            raise RuntimeError("GEMINI_API_KEY is missing")
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(getattr(settings, "AI_TIMEOUT_SECONDS", 30))
 
-        timeout_value = getattr(settings, "AI_TIMEOUT_SECONDS", 30)
-        timeout = httpx.Timeout(timeout_value)
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
-        params = {"key": self.api_key}
-        prompt = self._messages_to_prompt(messages)
+    def _url(self, method: str = "generateContent") -> str:
+        return f"{self.base_url}/models/{self.model}:{method}"
 
-        payload = {
-            "contents": [{"parts": [{"text": prompt}]}]
-        }
+    def _payload(self, prefix: str, contents: List[Dict[str, Any]], handle: Optional[str], stream: bool = False) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {"contents": contents}
+        if handle:
+            payload["cachedContent"] = handle
+        elif prefix:
+            payload["systemInstruction"] = {"parts": [{"text": prefix}]}
 
         logger.info(
-            "Sending Gemini request model=%s timeout=%s prompt_len=%s",
+            "Sending Gemini request model=%s timeout=%s turns=%s prefix=%s stream=%s",
             self.model,
-            timeout_value,
-            len(prompt),
+            getattr(settings, "AI_TIMEOUT_SECONDS", 30),
+            len(contents),
+            handle or f"inline:{len(prefix)}",
+            stream,
         )
+        return payload
 
-        with httpx.Client(timeout=timeout) as client:
-            r = client.post(url, params=params, json=payload)
+    # -- context cache handles -------------------------------------------------
 
-            logger.info("Gemini raw status=%s model=%s", r.status_code, self.model)
+    def _cache_seconds(self) -> int:
+        return int(getattr(settings, "GEMINI_CONTEXT_CACHE_SECONDS", 3600) or 0)
 
-            if r.status_code >= 400:
-                logger.error(
-                    "Gemini API error status=%s model=%s body=%s",
-                    r.status_code,
-                    self.model,
-                    r.text[:2000],
-                )
+    def _prefix_id(self, prefix: str) -> Optional[str]:
+        """Identity of a cacheable prefix, or None when it is not worth a handle."""
+        if not prefix or self._cache_seconds() <= 0:
+            return None
+        if estimate_tokens(prefix) < getattr(settings, "GEMINI_CONTEXT_CACHE_MIN_TOKENS", 1024):
+            return None
+        return hashlib.sha256(f"{self.model}\n{prefix}".encode("utf-8")).hexdigest()[:24]
+
+    def _handle_body(self, prefix: str, prefix_id: str) -> Dict[str, Any]:
+        return {
+            "model": f"models/{self.model}",
+            "displayName": f"roshaclub-{prefix_id}",
+            "systemInstruction": {"parts": [{"text": prefix}]},
+            "ttl": f"{self._cache_seconds()}s",
+        }
+
+    def _lookup_handle(self, prefix_id: Optional[str]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        (handle, None) when ``prefix_id`` has a stored handle (None after a
+        failed upload), else (None, the stored entry a new upload replaces).
+        """
+        if prefix_id is None:
+            return None, None
+        entry = cache.get(self.HANDLE_KEY)
+        if entry and entry.get("prefix") == prefix_id:
+            return entry.get("name"), None
+        return None, entry or {}
+
+    def _upload_lock(self, prefix_id: str) -> str:
+        return f"{self.HANDLE_KEY}:{prefix_id}:lock"
+
+    def _claim_upload(self, prefix_id: str) -> bool:
+        # One worker uploads a new prefix; the others send it inline meanwhile.
+        return cache.add(self._upload_lock(prefix_id), 1, timeout=getattr(settings, "AI_TIMEOUT_SECONDS", 30))
+
+    def _store_handle(self, prefix_id: str, r: Optional[httpx.Response]) -> Optional[str]:
+        name = None
+        if r is not None and r.status_code < 400:
+            name = r.json().get("name")
+        if name:
+            # Stop using a handle a minute before Gemini expires it.
+            timeout = max(60, self._cache_seconds() - 60)
+            logger.info("Gemini context cache created model=%s handle=%s", self.model, name)
+        else:
+            # Too short for this model, or caching unavailable: retry later, send inline until then.
+            timeout = 300
+            logger.warning(
+                "Gemini context cache not created model=%s status=%s body=%s",
+                self.model,
+                getattr(r, "status_code", None),
+                r.text[:500] if r is not None else "",
+            )
+        cache.set(self.HANDLE_KEY, {"prefix": prefix_id, "name": name}, timeout=timeout)
+        cache.delete(self._upload_lock(prefix_id))
+        return name
+
+    def _forget_handle(self, handle: str) -> None:
+        entry = cache.get(self.HANDLE_KEY)
+        if entry and entry.get("name") == handle:
+            cache.delete(self.HANDLE_KEY)
+        logger.warning("Gemini context cache rejected model=%s handle=%s", self.model, handle)
+
+    def _handle(self, prefix: str) -> Optional[str]:
+        prefix_id = self._prefix_id(prefix)
+        handle, replaced = self._lookup_handle(prefix_id)
+        if replaced is None or not self._claim_upload(prefix_id):
+            return handle
+
+        client = get_pool(self.name).client()
+        params = {"key": self.api_key}
+        try:
+            r = client.post(f"{self.base_url}/cachedContents", params=params, json=self._handle_body(prefix, prefix_id), timeout=self._timeout())
+        except httpx.HTTPError as e:
+            logger.warning("Gemini context cache upload failed model=%s error=%r", self.model, e)
+            r = None
+        handle = self._store_handle(prefix_id, r)
+        if replaced.get("name"):
+            try:
+                client.delete(f"{self.base_url}/{replaced['name']}", params=params, timeout=self._timeout())
+            except httpx.HTTPError:
+                pass  # it expires on its own
+        return handle
+
+    async def _ahandle(self, prefix: str) -> Optional[str]:
+        prefix_id = self._prefix_id(prefix)
+        handle, replaced = await sync_to_async(self._lookup_handle)(prefix_id)
+        if replaced is None or not await sync_to_async(self._claim_upload)(prefix_id):
+            return handle
+
+        client = get_pool(self.name).async_client()
+        params = {"key": self.api_key}
+        try:
+            r = await client.post(
+                f"{self.base_url}/cachedContents", params=params, json=self._handle_body(prefix, prefix_id), timeout=self._timeout()
+            )
+        except httpx.HTTPError as e:
+            logger.warning("Gemini context cache upload failed model=%s error=%r", self.model, e)
+            r = None
+        handle = await sync_to_async(self._store_handle)(prefix_id, r)
+        if replaced.get("name"):
+            try:
+                await client.delete(f"{self.base_url}/{replaced['name']}", params=params, timeout=self._timeout())
+            except httpx.HTTPError:
+                pass
+        return handle
 
-            r.raise_for_status()
-            data = r.json()
+    # -- requests --------------------------------------------------------------
 
+    def _check(self, r: httpx.Response) -> None:
+        logger.info("Gemini raw status=%s model=%s", r.status_code, self.model)
+
+        if r.status_code >= 400:
+            logger.error(
+                "Gemini API error status=%s model=%s body=%s",
+                r.status_code,
+                self.model,
+                r.text[:2000],
+            )
+
+        r.raise_for_status()
+
+    @staticmethod
+    def _usage(usage: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "tokens_in": usage.get("promptTokenCount"),
+            "tokens_out": usage.get("candidatesTokenCount"),
+            "tokens_cached": usage.get("cachedContentTokenCount"),
+        }
+
+    def _parse(self, data: Dict[str, Any], status_code: int = 200) -> LLMResponse:
         text = ""
         candidates = data.get("candidates") or []
         if candidates:
@@ -171,95 +534,574 @@ class GeminiProvider(BaseProvider):
             text=text,
             provider=self.name,
             model=self.model,
-            meta={},
+            meta={"http_status": status_code, **self._usage(data.get("usageMetadata") or {})},
+        )
+
+    def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        prefix, contents = self._split(messages)
+        handle = self._handle(prefix)
+
+        client = get_pool(self.name).client()
+        r = client.post(self._url(), params={"key": self.api_key}, json=self._payload(prefix, contents, handle), timeout=self._timeout())
+        if handle and r.status_code in self.STALE_HANDLE_STATUSES:
+            self._forget_handle(handle)
+            r = client.post(self._url(), params={"key": self.api_key}, json=self._payload(prefix, contents, None), timeout=self._timeout())
+        self._check(r)
+        data = r.json()
+
+        return self._parse(data, r.status_code)
+
+    async def achat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        prefix, contents = self._split(messages)
+        handle = await self._ahandle(prefix)
+
+        client = get_pool(self.name).async_client()
+        r = await client.post(self._url(), params={"key": self.api_key}, json=self._payload(prefix, contents, handle), timeout=self._timeout())
+        if handle and r.status_code in self.STALE_HANDLE_STATUSES:
+            await sync_to_async(self._forget_handle)(handle)
+            r = await client.post(
+                self._url(), params={"key": self.api_key}, json=self._payload(prefix, contents, None), timeout=self._timeout()
+            )
+        self._check(r)
+        data = r.json()
+
+        return self._parse(data, r.status_code)
+
+    def stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        prefix, contents = self._split(messages)
+        handle = self._handle(prefix)
+        params = {"key": self.api_key, "alt": "sse"}
+
+        client = get_pool(self.name).client()
+        url = self._url("streamGenerateContent")
+        while True:
+            payload = self._payload(prefix, contents, handle, stream=True)
+            with client.stream("POST", url, params=params, json=payload, timeout=self._timeout()) as r:
+                if r.status_code >= 400:
+                    r.read()
+                    if handle and r.status_code in self.STALE_HANDLE_STATUSES:
+                        self._forget_handle(handle)
+                        handle = None
+                        continue
+                self._check(r)
+
+                usage: Dict[str, Any] = {}
+                for data in _iter_sse_data(r):
+                    chunk = json.loads(data)
+                    # Every chunk carries the running totals; the last one is final.
+                    usage = chunk.get("usageMetadata") or usage
+                    candidates = chunk.get("candidates") or []
+                    if not candidates:
+                        continue
+                    content = candidates[0].get("content") or {}
+                    for part in content.get("parts") or []:
+                        text = part.get("text") or ""
+                        if text:
+                            yield text
+                if usage:
+                    yield StreamUsage(**self._usage(usage))
+                return
+
+    def warm_up(self, prefix: Optional[List[Dict[str, str]]] = None) -> bool:
+        """
+        Upload the shared prompt prefix as a context cache handle unless it
+        has one; False when the prefix is not cached at all, so the warm-up
+        loop keeps renewing the handle only where there is one to renew.
+        """
+        if not prefix or not self.api_key:
+            return False
+        text = self._split(prefix)[0]
+        if self._prefix_id(text) is None:
+            return False
+        self._handle(text)
+        return True
+
+
+class FakeProvider(BaseProvider):
+    """
+    Local stand-in provider (``AI_PROVIDER=fake``) for tests and load tests:
+    no network, configurable latency and failure rate.
+    """
+
+    def __init__(self, name: str = "fake", latency: Optional[float] = None, error_rate: Optional[float] = None) -> None:
+        self.name = name
+        self.model = "fake-1"
+        self.latency = latency if latency is not None else getattr(settings, "AI_FAKE_LATENCY_SECONDS", 0.0)
+        self.error_rate = error_rate if error_rate is not None else getattr(settings, "AI_FAKE_ERROR_RATE", 0.0)
+
+    def _maybe_fail(self) -> None:
+        if self.error_rate and random.random() < self.error_rate:
+            raise httpx.ConnectError(f"{self.name} provider unavailable")
+
+    def _reply(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        question = (messages[-1].get("content") or "") if messages else ""
+        return LLMResponse(
+            text=f"[{self.name}] You asked: {question[:200]}",
+            provider=self.name,
+            model=self.model,
+            meta={"http_status": 200},
+        )
+
+    def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        time.sleep(self.latency)
+        self._maybe_fail()
+        return self._reply(messages)
+
+    async def achat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        await asyncio.sleep(self.latency)
+        self._maybe_fail()
+        return self._reply(messages)
+
+
+class LLMStream:
+    """
+    Iterable of text deltas for one assistant reply.
+
+    After the iterator is exhausted, ``response`` holds the assembled
+    LLMResponse; ``ttft_ms`` is set as soon as the first delta arrives.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        chunks: Iterable[str],
+        on_complete: Optional[Callable[[LLMResponse], None]] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.provider = provider
+        self.model = model
+        self.meta = dict(meta or {})
+        self.ttft_ms: Optional[float] = None
+        self.response: Optional[LLMResponse] = None
+        self._chunks = chunks
+        self._on_complete = on_complete
+        self._on_error = on_error
+
+    @classmethod
+    def from_response(cls, resp: LLMResponse) -> "LLMStream":
+        return cls(resp.provider, resp.model, [resp.text])
+
+    def __iter__(self) -> Iterator[str]:
+        started = time.monotonic()
+        parts: List[str] = []
+
+        try:
+            for delta in self._chunks:
+                if isinstance(delta, StreamUsage):
+                    self.meta.update((k, v) for k, v in delta.usage.items() if v is not None)
+                    continue
+                if not delta:
+                    continue
+                if self.ttft_ms is None:
+                    self.ttft_ms = round((time.monotonic() - started) * 1000, 1)
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            if self._on_error:
+                self._on_error(e)
+            raise
+
+        text = "".join(parts).strip()
+        if not text:
+            text = "I didn't get a response. Please try again."
+
+        self.response = LLMResponse(
+            text=text,
+            provider=self.provider,
+            model=self.model,
+            meta={
+                **self.meta,
+                "stream": True,
+                "ttft_ms": self.ttft_ms,
+                "total_ms": round((time.monotonic() - started) * 1000, 1),
+            },
+        )
+
+        logger.info(
+            "AI stream finished provider=%s model=%s ttft_ms=%s total_ms=%s",
+            self.provider,
+            self.model,
+            self.ttft_ms,
+            self.response.meta["total_ms"],
         )
 
+        if self._on_complete:
+            self._on_complete(self.response)
+
 
 class LLMService:
     def __init__(self) -> None:
         self.provider = self._get_provider()
+        self.semantic_cache = None
 
-    def _get_provider(self) -> BaseProvider:
-        p = (getattr(settings, "AI_PROVIDER", "ollama") or "ollama").lower().strip()
-        logger.info("Selected AI provider: %s", p)
+        if getattr(settings, "AI_SEMANTIC_CACHE", False):
+            from services.semantic_cache import get_semantic_cache
+
+            self.semantic_cache = get_semantic_cache()
 
-        if p == "gemini":
+    def _make_provider(self, name: str) -> BaseProvider:
+        if name == "gemini":
             return GeminiProvider()
+        if name == "fake":
+            return FakeProvider()
+        if name == "replay":
+            from services.replay import ReplayProvider
+
+            upstream = (getattr(settings, "AI_REPLAY_RECORD_FROM", "") or "").lower().strip()
+            return ReplayProvider(self._make_provider(upstream) if upstream and upstream != "replay" else None)
 
         return OllamaProvider()
 
-    def _cache_key(self, messages: List[Dict[str, str]]) -> str:
-        raw = "|".join(f"{m.get('role')}:{m.get('content')}" for m in messages[-12:])
-        h = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:24]
-        return f"ai:resp:{self.provider.name}:{self.provider.model}:{h}"
+    def _get_provider(self) -> BaseProvider:
+        p = (getattr(settings, "AI_PROVIDER", "ollama") or "ollama").lower().strip()
+        fallbacks = [
+            f.strip().lower()
+            for f in getattr(settings, "AI_PROVIDER_FALLBACKS", [])
+            if f.strip() and f.strip().lower() != p
+        ]
+        logger.info("Selected AI provider: %s fallbacks=%s", p, fallbacks)
 
-    def generate_response(
+        if not fallbacks:
+            return self._make_provider(p)
+
+        from services.router import RouterProvider
+
+        return RouterProvider([self._make_provider(name) for name in [p] + fallbacks])
+
+    def _cache_key(self, messages: List[Dict[str, str]], scope: Optional[Cacheability] = None) -> str:
+        if scope is not None and scope.shared:
+            # Same answer for every user: catalog version, shared prefix and the
+            # normalised question, so paraphrases differing only in case,
+            # punctuation or greetings also hit.
+            from services.context import get_catalog_version
+
+            question = hashlib.sha256(scope.question.encode("utf-8")).hexdigest()[:32]
+            return (
+                f"ai:resp:shared:{self.provider.name}:{self.provider.model}:{get_catalog_version()}"
+                f":{prompt_hash(messages[:1])[:16]}:{question}"
+            )
+        return f"ai:resp:{self.provider.name}:{self.provider.model}:{prompt_hash(messages)}"
+
+    def build_prompt(
         self,
         user_message: str,
         conversation_history: List[Dict[str, str]],
         site_context: Optional[Dict[str, Any]] = None,
         suggestions: Optional[Dict[str, Any]] = None,
-    ) -> LLMResponse:
-        site_context_text = ""
-        if site_context:
-            site_context_text = f"SITE_CONTEXT (authoritative, do not invent): {site_context}"
-
-        suggestions_text = ""
-        if suggestions:
-            suggestions_text = f"SUGGESTIONS (candidates picked by backend): {suggestions}"
-
-        system_block = SYSTEM_PROMPT
-        if site_context_text:
-            system_block += " " + site_context_text
-        if suggestions_text:
-            system_block += " " + suggestions_text
-
-        messages = [{"role": "system", "content": system_block}] + conversation_history + [
-            {"role": "user", "content": user_message}
-        ]
-
-        ck = self._cache_key(messages)
-        cached = cache.get(ck)
-        if cached:
-            return LLMResponse(
-                text=cached["text"],
-                provider=cached["provider"],
-                model=cached["model"],
-                meta=cached.get("meta", {}),
+        summary: str = "",
+        personal: bool = True,
+    ) -> Prompt:
+        with metrics.phase("prompt"):
+            prompt = PromptBuilder.for_provider(SYSTEM_PROMPT, self.provider.name).build(
+                user_message,
+                conversation_history,
+                site_context,
+                suggestions,
+                summary=summary,
+                personal=personal,
             )
 
-        try:
-            resp = self.provider.chat(messages)
-        except httpx.TimeoutException:
+        logger.info(
+            "AI prompt provider=%s est_tokens=%s prefix_tokens=%s budget=%s dropped_history=%s dropped_rows=%s",
+            self.provider.name,
+            prompt.est_tokens,
+            prompt.prefix_tokens,
+            prompt.budget,
+            prompt.dropped_history,
+            prompt.dropped_rows,
+        )
+        return prompt
+
+    def build_messages(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        site_context: Optional[Dict[str, Any]] = None,
+        suggestions: Optional[Dict[str, Any]] = None,
+        summary: str = "",
+    ) -> List[Dict[str, str]]:
+        return self.build_prompt(user_message, conversation_history, site_context, suggestions, summary).messages
+
+    def warm_up(self) -> bool:
+        """Preload the model together with the shared prompt prefix (system prompt, plus the catalog in catalog mode)."""
+        from services.context import get_catalog_snapshot
+
+        if getattr(settings, "AI_CONTEXT_MODE", "retrieval") == "retrieval":
+            site_context = {"trainers": [], "programs": [], "membership": None, "retrieved": True}
+        else:
+            catalog = get_catalog_snapshot()
+            site_context = {"trainers": list(catalog.trainers), "programs": list(catalog.programs), "membership": None}
+        prefix = self.build_prompt("", [], site_context).messages[:1]
+        return self.provider.warm_up(prefix)
+
+    def _with_prompt_meta(self, resp: LLMResponse, prompt: Prompt) -> LLMResponse:
+        return replace(resp, meta={**(resp.meta or {}), "prompt_tokens_est": prompt.est_tokens})
+
+    def _semantic_namespace(self, messages: List[Dict[str, str]], scope: Optional[Cacheability] = None) -> str:
+        # Near-duplicate questions may only share an answer when everything else
+        # the model sees is identical: provider/model, the shared system block,
+        # the per-user block (membership) unless the turn is shared, and the
+        # answer the user is following up on. Shared turns leave the user block
+        # out, and in retrieval mode that is where the catalog rows are, so they
+        # are keyed on the catalog version instead (as ``_cache_key`` is).
+        system_block = messages[0]["content"] if messages and messages[0].get("role") == "system" else ""
+        user_block = ""
+        if scope is not None and scope.shared:
+            from services.context import get_catalog_version
+
+            user_block = f"catalog:{get_catalog_version()}"
+        elif len(messages) > 2 and messages[-2].get("role") == "system":
+            user_block = messages[-2]["content"]
+        last_answer = next(
+            (m.get("content") or "" for m in reversed(messages[:-1]) if m.get("role") == "assistant"),
+            "",
+        )
+        raw = f"{self.provider.name}:{self.provider.model}|{system_block}|{user_block}|{last_answer}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _get_cached(self, ck: str, messages: List[Dict[str, str]], scope: Optional[Cacheability] = None) -> Optional[LLMResponse]:
+        with metrics.phase("cache_lookup"):
+            cached = cache.get(ck)
+            result = "hit" if cached else "miss"
+
+            if not cached and self.semantic_cache is not None:
+                hit = self.semantic_cache.lookup(messages[-1]["content"], self._semantic_namespace(messages, scope))
+                if hit:
+                    logger.info("AI semantic cache hit similarity=%s", hit.similarity)
+                    cached = {**hit.value, "meta": {**hit.value.get("meta", {}), "semantic_similarity": hit.similarity}}
+                    result = "semantic"
+
+        metrics.note(cache=result, cache_scope=scope.scope if scope is not None else "user")
+        if not cached:
+            return None
+
+        return self._from_cached(cached)
+
+    def _from_cached(self, cached: Dict[str, Any]) -> LLMResponse:
+        return LLMResponse(
+            text=cached["text"],
+            provider=cached["provider"],
+            model=cached["model"],
+            meta=cached.get("meta", {}),
+        )
+
+    def _set_cached(self, ck: str, messages: List[Dict[str, str]], resp: LLMResponse, scope: Optional[Cacheability] = None) -> None:
+        value = {
+            "text": resp.text,
+            "provider": resp.provider,
+            "model": resp.model,
+            "meta": resp.meta,
+        }
+        cache.set(ck, value, timeout=getattr(settings, "AI_CACHE_SECONDS", 120))
+
+        if self.semantic_cache is not None:
+            self.semantic_cache.store(messages[-1]["content"], self._semantic_namespace(messages, scope), value)
+
+    def _log_failure(self, exc: Exception) -> None:
+        # Must be called from inside an ``except`` block.
+        metrics.note(
+            provider=self.provider.name,
+            http_status=exc.response.status_code if isinstance(exc, httpx.HTTPStatusError) else type(exc).__name__,
+        )
+
+        if isinstance(exc, httpx.TimeoutException):
             logger.warning(
                 "AI timeout provider=%s model=%s",
                 self.provider.name,
                 self.provider.model,
             )
-            raise
-        except httpx.HTTPStatusError:
+        elif isinstance(exc, httpx.HTTPStatusError):
             logger.exception(
                 "AI HTTP error provider=%s model=%s",
                 self.provider.name,
                 self.provider.model,
             )
-            raise
-        except Exception:
+        else:
             logger.exception(
                 "AI provider error provider=%s model=%s",
                 self.provider.name,
                 self.provider.model,
             )
+
+    def _flight_timeout(self) -> float:
+        return getattr(settings, "AI_SINGLEFLIGHT_LOCK_SECONDS", getattr(settings, "AI_TIMEOUT_SECONDS", 20) + 5)
+
+    def _flight_poll(self) -> float:
+        return getattr(settings, "AI_SINGLEFLIGHT_POLL_MS", 100) / 1000
+
+    def _coalesced(self, resp: LLMResponse, scope: str) -> LLMResponse:
+        logger.info("AI request coalesced scope=%s provider=%s", scope, resp.provider)
+        metrics.note(cache=f"coalesced_{scope}")
+        return replace(resp, meta={**(resp.meta or {}), "coalesced": scope})
+
+    def _upstream_info(self, resp: LLMResponse, prompt: Prompt) -> Dict[str, Any]:
+        # Providers that report usage win over the local estimates.
+        meta = resp.meta or {}
+        info = {
+            "provider": resp.provider,
+            "tokens_in": meta.get("tokens_in") or prompt.est_tokens,
+            "tokens_out": meta.get("tokens_out") or estimate_tokens(resp.text),
+        }
+        if "http_status" in meta:
+            info["http_status"] = meta["http_status"]
+        return info
+
+    def _generate(
+        self, ck: str, messages: List[Dict[str, str]], scope: Optional[Cacheability] = None, priority: bool = False
+    ) -> LLMResponse:
+        # Another worker already holds the lock for this prompt: wait for its
+        # answer to land in the cache instead of asking the model again.
+        lock = ClusterLock(ck, self._flight_timeout())
+        if not lock.acquire():
+            cached = wait_for(lambda: cache.get(ck), lock.held_elsewhere, self._flight_timeout(), self._flight_poll())
+            if cached is not None:
+                flights.count_cluster()
+                return self._coalesced(self._from_cached(cached), "cluster")
+
+        try:
+            # Only calls that really go upstream take a slot: cache hits and
+            # coalesced followers never wait or get shed.
+            with admission.slot(priority):
+                try:
+                    resp = self.provider.chat(messages)
+                except Exception as e:
+                    self._log_failure(e)
+                    raise
+
+            self._set_cached(ck, messages, resp, scope)
+            return resp
+        finally:
+            lock.release()
+
+    async def _agenerate(
+        self, ck: str, messages: List[Dict[str, str]], scope: Optional[Cacheability] = None, priority: bool = False
+    ) -> LLMResponse:
+        lock = ClusterLock(ck, self._flight_timeout())
+        if not await lock.aacquire():
+            cached = await await_for(
+                lambda: cache.aget(ck),
+                lock.aheld_elsewhere,
+                self._flight_timeout(),
+                self._flight_poll(),
+            )
+            if cached is not None:
+                flights.count_cluster()
+                return self._coalesced(self._from_cached(cached), "cluster")
+
+        try:
+            async with admission.aslot(priority):
+                try:
+                    resp = await self.provider.achat(messages)
+                except Exception as e:
+                    self._log_failure(e)
+                    raise
+
+            await sync_to_async(self._set_cached)(ck, messages, resp, scope)
+            return resp
+        finally:
+            await lock.arelease()
+
+    def generate_response(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        site_context: Optional[Dict[str, Any]] = None,
+        suggestions: Optional[Dict[str, Any]] = None,
+        summary: str = "",
+    ) -> LLMResponse:
+        scope = classify(user_message, conversation_history, summary)
+        prompt = self.build_prompt(user_message, conversation_history, site_context, suggestions, summary, personal=not scope.shared)
+        messages = prompt.messages
+
+        ck = self._cache_key(messages, scope)
+        cached = self._get_cached(ck, messages, scope)
+        if cached:
+            return cached
+
+        with metrics.phase("generate"):
+            priority = admission.is_priority((site_context or {}).get("membership"))
+            resp, shared = flights.do(ck, lambda: self._generate(ck, messages, scope, priority))
+        resp = self._with_prompt_meta(resp, prompt)
+        if shared:
+            return self._coalesced(resp, "process")
+        metrics.note(**self._upstream_info(resp, prompt))
+        return resp
+
+    async def agenerate_response(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        site_context: Optional[Dict[str, Any]] = None,
+        suggestions: Optional[Dict[str, Any]] = None,
+        summary: str = "",
+    ) -> LLMResponse:
+        scope = classify(user_message, conversation_history, summary)
+        prompt = self.build_prompt(user_message, conversation_history, site_context, suggestions, summary, personal=not scope.shared)
+        messages = prompt.messages
+
+        ck = self._cache_key(messages, scope)
+        cached = await sync_to_async(self._get_cached)(ck, messages, scope)
+        if cached:
+            return cached
+
+        with metrics.phase("generate"):
+            priority = admission.is_priority((site_context or {}).get("membership"))
+            resp, shared = await flights.ado(ck, lambda: self._agenerate(ck, messages, scope, priority))
+        resp = self._with_prompt_meta(resp, prompt)
+        if shared:
+            return self._coalesced(resp, "process")
+        metrics.note(**self._upstream_info(resp, prompt))
+        return resp
+
+    def summarize(self, previous_summary: str, messages: List[Dict[str, str]]) -> str:
+        try:
+            resp = self.provider.chat(summary_messages(previous_summary, messages))
+        except Exception as e:
+            self._log_failure(e)
             raise
+        return resp.text
 
-        cache.set(
-            ck,
-            {
-                "text": resp.text,
-                "provider": resp.provider,
-                "model": resp.model,
-                "meta": resp.meta,
-            },
-            timeout=getattr(settings, "AI_CACHE_SECONDS", 120),
+    def stream_response(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        site_context: Optional[Dict[str, Any]] = None,
+        suggestions: Optional[Dict[str, Any]] = None,
+        summary: str = "",
+    ) -> LLMStream:
+        scope = classify(user_message, conversation_history, summary)
+        prompt = self.build_prompt(user_message, conversation_history, site_context, suggestions, summary, personal=not scope.shared)
+        messages = prompt.messages
+
+        ck = self._cache_key(messages, scope)
+        cached = self._get_cached(ck, messages, scope)
+        if cached:
+            return LLMStream.from_response(cached)
+
+        # The stream is consumed after the view returns, outside the request's
+        # metrics context, so its timings object is captured here.
+        timings = metrics.current()
+
+        def on_complete(resp: LLMResponse) -> None:
+            self._set_cached(ck, messages, resp, scope)
+            if timings is not None:
+                timings.info.update(self._upstream_info(resp, prompt))
+
+        priority = admission.is_priority((site_context or {}).get("membership"))
+
+        def chunks() -> Iterator[str]:
+            # The slot is taken on the first read (before the view commits to
+            # a 200) and held until the stream ends or the client goes away.
+            with admission.slot(priority):
+                yield from self.provider.stream(messages)
+
+        return LLMStream(
+            self.provider.name,
+            self.provider.model,
+            chunks(),
+            on_complete=on_complete,
+            on_error=self._log_failure,
+            meta={"prompt_tokens_est": prompt.est_tokens},
         )
-        return resp
\ No newline at end of file
@@ -0,0 +1,410 @@
+from __future__ import annotations
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.functional import cached_property
+
+from services import metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entry (
+    key TEXT PRIMARY KEY,
+    value BLOB,
+    expires REAL,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_entry_version ON cache_entry (version);
+CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO cache_meta (name, value) VALUES ('seq', 0), ('purged', 0);
+"""
+
+_LIVE = "value IS NOT NULL AND (expires IS NULL OR expires > ?)"
+
+# One connection per (process, thread, file): Django builds cache objects per
+# thread/context, and SQLite connections must not cross a fork.
+_connections = threading.local()
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache in a local SQLite file (WAL mode), shared by every process on the
+    host and kept across restarts; needs no service.
+
+    Every write takes the next value of a global sequence as the row's
+    ``version``, and deletes leave a tombstone row, so ``changes_since``
+    can tell a ``TieredCache`` exactly which keys changed since it last
+    looked. Expired rows and tombstones older than ``FEED_RETENTION`` seconds
+    are purged every ``CULL_EVERY`` writes (host-wide); a reader whose cursor falls
+    behind a purge is told to reset.
+    """
+
+    def __init__(self, location: str, params: Dict[str, Any]) -> None:
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.path = location
+        self.feed_retention = float(options.get("FEED_RETENTION", 300))
+        self.cull_every = int(options.get("CULL_EVERY", 500))
+
+    def _conn(self) -> sqlite3.Connection:
+        key = (os.getpid(), self.path)
+        conn = getattr(_connections, "by_key", {}).get(key)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            if not hasattr(_connections, "by_key"):
+                _connections.by_key = {}
+            _connections.by_key[key] = conn
+        return conn
+
+    def _write(self, fn) -> Any:
+        """Run ``fn(conn, version, now)`` in one write transaction with a fresh version."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("UPDATE cache_meta SET value = value + 1 WHERE name = 'seq' RETURNING value").fetchone()[0]
+            result = fn(conn, version, now)
+            if version % self.cull_every == 0:  # whichever process draws the number culls
+                self._cull(conn, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def _cull(self, conn: sqlite3.Connection, now: float) -> None:
+        cutoff = now - self.feed_retention
+        purged = conn.execute("SELECT MAX(version) FROM cache_entry WHERE value IS NULL AND expires < ?", (cutoff,)).fetchone()[0]
+        conn.execute(
+            "DELETE FROM cache_entry WHERE (value IS NULL AND expires < ?) OR (value IS NOT NULL AND expires <= ?)",
+            (cutoff, now),
+        )
+        if purged:
+            conn.execute("UPDATE cache_meta SET value = MAX(value, ?) WHERE name = 'purged'", (purged,))
+
+        excess = conn.execute("SELECT COUNT(*) FROM cache_entry").fetchone()[0] - self._max_entries
+        if excess > 0:
+            # Least recently written first; tier-1 copies of them live out their L1_TIMEOUT.
+            count = excess + self._max_entries // self._cull_frequency
+            purged = conn.execute("SELECT MAX(version) FROM (SELECT version FROM cache_entry ORDER BY version LIMIT ?)", (count,)).fetchone()[0]
+            conn.execute("DELETE FROM cache_entry WHERE version <= ?", (purged,))
+            conn.execute("UPDATE cache_meta SET value = MAX(value, ?) WHERE name = 'purged'", (purged,))
+
+    def get_entry(self, key: str, version: Optional[int] = None) -> Optional[Tuple[bytes, Optional[float], int]]:
+        """``(pickled value, expiry timestamp or None, row version)`` of a live key."""
+        key = self.make_and_validate_key(key, version=version)
+        return self._conn().execute(
+            f"SELECT value, expires, version FROM cache_entry WHERE key = ? AND {_LIVE}", (key, time.time())
+        ).fetchone()
+
+    def get(self, key: str, default: Any = None, version: Optional[int] = None) -> Any:
+        entry = self.get_entry(key, version)
+        return pickle.loads(entry[0]) if entry else default
+
+    def set(self, key: str, value: Any, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None) -> None:
+        key = self.make_and_validate_key(key, version=version)
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self.get_backend_timeout(timeout)
+        self._write(
+            lambda conn, v, now: conn.execute(
+                "INSERT INTO cache_entry (key, value, expires, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, version = excluded.version",
+                (key, blob, expires, v),
+            )
+        )
+
+    def add(self, key: str, value: Any, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None) -> bool:
+        key = self.make_and_validate_key(key, version=version)
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self.get_backend_timeout(timeout)
+        return self._write(
+            lambda conn, v, now: conn.execute(
+                "INSERT INTO cache_entry (key, value, expires, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, version = excluded.version "
+                "WHERE cache_entry.value IS NULL OR cache_entry.expires <= ?",
+                (key, blob, expires, v, now),
+            ).rowcount
+            > 0
+        )
+
+    def touch(self, key: str, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None) -> bool:
+        key = self.make_and_validate_key(key, version=version)
+        expires = self.get_backend_timeout(timeout)
+        return self._write(
+            lambda conn, v, now: conn.execute(
+                f"UPDATE cache_entry SET expires = ?, version = ? WHERE key = ? AND {_LIVE}", (expires, v, key, now)
+            ).rowcount
+            > 0
+        )
+
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        key = self.make_and_validate_key(key, version=version)
+        return self._write(
+            lambda conn, v, now: conn.execute(
+                "UPDATE cache_entry SET value = NULL, expires = ?, version = ? WHERE key = ? AND value IS NOT NULL", (now, v, key)
+            ).rowcount
+            > 0
+        )
+
+    def incr(self, key: str, delta: int = 1, version: Optional[int] = None) -> Any:
+        key = self.make_and_validate_key(key, version=version)
+
+        def update(conn: sqlite3.Connection, v: int, now: float) -> Any:
+            row = conn.execute(f"SELECT value FROM cache_entry WHERE key = ? AND {_LIVE}", (key, now)).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            conn.execute(
+                "UPDATE cache_entry SET value = ?, version = ? WHERE key = ?",
+                (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), v, key),
+            )
+            return value
+
+        return self._write(update)
+
+    def has_key(self, key: str, version: Optional[int] = None) -> bool:
+        return self.get_entry(key, version) is not None
+
+    def clear(self) -> None:
+        def wipe(conn: sqlite3.Connection, v: int, now: float) -> None:
+            conn.execute("DELETE FROM cache_entry")
+            conn.execute("UPDATE cache_meta SET value = ? WHERE name = 'purged'", (v,))
+
+        self._write(wipe)
+
+    # Change feed for TieredCache.
+
+    def current_version(self) -> int:
+        return self._conn().execute("SELECT value FROM cache_meta WHERE name = 'seq'").fetchone()[0]
+
+    def changes_since(self, cursor: int, limit: int = 1000) -> Tuple[int, List[Tuple[str, int]], bool]:
+        """
+        ``(new cursor, [(key, version)], reset)``. ``reset`` means changes
+        were purged (or there are more than ``limit``) and the reader must
+        drop everything it holds.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            meta = dict(conn.execute("SELECT name, value FROM cache_meta").fetchall())
+            rows = conn.execute(
+                "SELECT key, version FROM cache_entry WHERE version > ? ORDER BY version LIMIT ?", (cursor, limit + 1)
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        if cursor < meta["purged"] or len(rows) > limit:
+            return meta["seq"], [], True
+        return (rows[-1][1] if rows else cursor), rows, False
+
+
+class _Tier1:
+    """Per-process LRU shared by every TieredCache object built for the same CACHES entry."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        # made key -> (pickled value, expiry timestamp or None, shared version or 0)
+        self.data: "OrderedDict[str, Tuple[bytes, Optional[float], int]]" = OrderedDict()
+        # Latest versions seen on the feed, so a fetch racing a change is not cached.
+        self.recent: Dict[str, int] = {}
+        self.cursor: Optional[int] = None
+        self.synced_at = 0.0
+        self.counts = {"l1_hits": 0, "l1_misses": 0, "shared_hits": 0, "shared_misses": 0, "invalidations": 0, "resets": 0}
+
+    def evict(self, key: str) -> None:
+        with self.lock:
+            self.data.pop(key, None)
+
+
+_tiers: Dict[Tuple[int, str], _Tier1] = {}
+_tiers_lock = threading.Lock()
+
+
+def _tier_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    pid = os.getpid()
+    for (owner, name), tier in list(_tiers.items()):
+        if owner != pid:
+            continue
+        with tier.lock:
+            counts = dict(tier.counts)
+        for level in ("l1", "shared"):
+            yield {"cache": name, "tier": level, "result": "hit"}, counts[f"{level}_hits"]
+            yield {"cache": name, "tier": level, "result": "miss"}, counts[f"{level}_misses"]
+
+
+metrics.CACHE_TIERS.sources.append(_tier_series)
+
+
+class TieredCache(BaseCache):
+    """
+    Bounded in-process LRU (tier 1) in front of a shared cache (tier 2),
+    configured as another ``CACHES`` entry named by ``OPTIONS["SHARED"]``.
+
+    Reads are served from tier 1 when possible; every write goes through to
+    tier 2 and drops the local copy, so counters (``incr``) and locks
+    (``add``) keep the shared tier's atomicity. When tier 2 offers a change
+    feed (``SQLiteCache``), tier 1 polls it at most every ``SYNC_INTERVAL``
+    seconds and drops the keys other processes changed, by version;
+    otherwise (e.g. Redis) staleness is bounded by ``L1_TIMEOUT``, the
+    longest any tier-1 copy is kept. ``stats()`` reports hits and misses
+    per tier.
+    """
+
+    def __init__(self, location: str, params: Dict[str, Any]) -> None:
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.shared_alias = options.get("SHARED", "shared")
+        self.l1_timeout = float(options.get("L1_TIMEOUT", 30))
+        self.sync_interval = float(options.get("SYNC_INTERVAL", 0.5))
+        self.name = location or self.shared_alias
+        with _tiers_lock:
+            self.tier = _tiers.setdefault((os.getpid(), self.name), _Tier1(int(options.get("L1_MAX_ENTRIES", 1000))))
+
+    @cached_property
+    def shared(self) -> BaseCache:
+        # Django builds one TieredCache per thread/context; the shared
+        # backend resolved here belongs to the same one.
+        return caches[self.shared_alias]
+
+    def _sync(self, shared: BaseCache) -> None:
+        changes_since = getattr(shared, "changes_since", None)
+        tier = self.tier
+        if changes_since is None or time.monotonic() - tier.synced_at < self.sync_interval:
+            return
+        if not tier.sync_lock.acquire(blocking=False):
+            return  # another thread is syncing; its result covers us
+        try:
+            if tier.cursor is None:
+                tier.cursor = shared.current_version()
+                tier.synced_at = time.monotonic()
+                return
+            cursor, changed, reset = changes_since(tier.cursor)
+            with tier.lock:
+                if reset:
+                    tier.data.clear()
+                    tier.recent.clear()
+                    tier.counts["resets"] += 1
+                for key, version in changed:
+                    entry = tier.data.get(key)
+                    if entry is not None and entry[2] < version:
+                        del tier.data[key]
+                        tier.counts["invalidations"] += 1
+                    tier.recent[key] = version
+                if len(tier.recent) > 10 * tier.max_entries:
+                    tier.recent.clear()
+                tier.cursor = cursor
+            tier.synced_at = time.monotonic()
+        finally:
+            tier.sync_lock.release()
+
+    def _fetch(self, shared: BaseCache, key: str, version: Optional[int]) -> Optional[Tuple[bytes, Optional[float], int]]:
+        cap = time.time() + self.l1_timeout
+        get_entry = getattr(shared, "get_entry", None)
+        if get_entry is not None:
+            entry = get_entry(key, version)
+            return entry and (entry[0], cap if entry[1] is None else min(entry[1], cap), entry[2])
+        value = shared.get(key, self._missing_key, version)
+        if value is self._missing_key:
+            return None
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL), cap, 0
+
+    def get(self, key: str, default: Any = None, version: Optional[int] = None) -> Any:
+        shared = self.shared
+        made = shared.make_and_validate_key(key, version=version)
+        self._sync(shared)
+        tier = self.tier
+
+        with tier.lock:
+            entry = tier.data.get(made)
+            if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                tier.data.move_to_end(made)
+                tier.counts["l1_hits"] += 1
+                blob = entry[0]
+            else:
+                if entry is not None:
+                    del tier.data[made]
+                tier.counts["l1_misses"] += 1
+                blob = None
+        if blob is not None:
+            return pickle.loads(blob)
+
+        entry = self._fetch(shared, key, version)
+        with tier.lock:
+            if entry is None:
+                tier.counts["shared_misses"] += 1
+            else:
+                tier.counts["shared_hits"] += 1
+                # Skip the copy if the feed already reported a newer write.
+                if tier.recent.get(made, 0) <= entry[2]:
+                    tier.data[made] = entry
+                    tier.data.move_to_end(made)
+                    while len(tier.data) > tier.max_entries:
+                        tier.data.popitem(last=False)
+        return default if entry is None else pickle.loads(entry[0])
+
+    def set(self, key: str, value: Any, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None) -> None:
+        shared = self.shared
+        shared.set(key, value, timeout, version)
+        self.tier.evict(shared.make_key(key, version))
+
+    def add(self, key: str, value: Any, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None) -> bool:
+        shared = self.shared
+        added = shared.add(key, value, timeout, version)
+        self.tier.evict(shared.make_key(key, version))
+        return added
+
+    def touch(self, key: str, timeout: Any = DEFAULT_TIMEOUT, version: Optional[int] = None) -> bool:
+        shared = self.shared
+        touched = shared.touch(key, timeout, version)
+        self.tier.evict(shared.make_key(key, version))
+        return touched
+
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        shared = self.shared
+        deleted = shared.delete(key, version)
+        self.tier.evict(shared.make_key(key, version))
+        return deleted
+
+    def incr(self, key: str, delta: int = 1, version: Optional[int] = None) -> Any:
+        shared = self.shared
+        try:
+            return shared.incr(key, delta, version)
+        finally:
+            self.tier.evict(shared.make_key(key, version))
+
+    def clear(self) -> None:
+        self.shared.clear()
+        with self.tier.lock:
+            self.tier.data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return _tier_stats(self.tier)
+
+
+def _tier_stats(tier: _Tier1) -> Dict[str, Any]:
+    with tier.lock:
+        counts = dict(tier.counts)
+        entries = len(tier.data)
+    l1 = counts["l1_hits"] + counts["l1_misses"]
+    shared = counts["shared_hits"] + counts["shared_misses"]
+    return {
+        **counts,
+        "l1_entries": entries,
+        "l1_hit_rate": round(counts["l1_hits"] / l1, 4) if l1 else 0.0,
+        "shared_hit_rate": round(counts["shared_hits"] / shared, 4) if shared else 0.0,
+    }
+
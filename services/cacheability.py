@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Dict, List
+
+from django.conf import settings
+
+from services.intents import normalise_question
+
+SHARED = "shared"
+USER = "user"
+
+# First person singular: the answer may depend on who is asking.
+_PERSONAL_RE = re.compile(r"\b(?:i|me|my|mine|myself|i'm|im|i've|ive|i'd|i'll)\b")
+# "how do i join?" asks how the site works, not about the asker.
+_IMPERSONAL_LEAD_RE = re.compile(r"^(?:how (?:do|can|should) i|where (?:do|can) i|can i|do i need to) ")
+
+
+@dataclass(frozen=True)
+class Cacheability:
+    scope: str
+    reason: str
+    question: str = ""  # normalised question; set for shared turns only
+
+    @property
+    def shared(self) -> bool:
+        return self.scope == SHARED
+
+
+def classify(user_message: str, conversation_history: List[Dict[str, str]], summary: str = "") -> Cacheability:
+    """
+    Decide whether a turn's answer can be shared by every user.
+
+    Shared turns are first messages of a session that do not talk about the
+    asker: the prompt is then built without the user's membership, so the
+    answer depends only on the catalog and the question and may be cached
+    under them (``LLMService._cache_key``). Follow-ups, long messages and
+    anything in the first person keep a per-user cache key.
+    """
+    if not getattr(settings, "AI_SHARED_CACHE", True):
+        return Cacheability(USER, "disabled")
+    if conversation_history or (summary or "").strip():
+        return Cacheability(USER, "follow_up")
+
+    q = normalise_question(user_message)
+    if not q or len(q) > getattr(settings, "AI_SHARED_CACHE_MAX_CHARS", 160):
+        return Cacheability(USER, "length")
+    if _PERSONAL_RE.search(_IMPERSONAL_LEAD_RE.sub("", q)):
+        return Cacheability(USER, "personal")
+    return Cacheability(SHARED, "generic", q)
@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ai_assistant.models import ChatMessage, ChatSession
+from services.pagination import Page, keyset_page
+
+
+@dataclass
+class ChatTurn:
+    """
+    One user message on its way through the assistant. ``session`` is unsaved
+    for a new conversation; ``history`` holds the earlier turns, oldest first,
+    without the new message.
+    """
+
+    session: ChatSession
+    message: str
+    history: List[Dict[str, str]]
+
+    @property
+    def is_new(self) -> bool:
+        return self.session.pk is None
+
+
+def assistant_message(session_id: int, resp: Any, **extra_meta: Any) -> ChatMessage:
+    return ChatMessage(
+        session_id=session_id,
+        role=ChatMessage.ROLE_ASSISTANT,
+        content=resp.text,
+        meta={
+            "provider": resp.provider,
+            "model": resp.model,
+            **extra_meta,
+            **(resp.meta or {}),
+        },
+    )
+
+
+def touch_session(session_id: int):
+    # update() rather than save(): one narrow UPDATE, and it leaves the
+    # summary columns alone if the background summariser wrote them meanwhile.
+    now = timezone.now()
+    ChatSession.objects.filter(id=session_id).update(updated_at=now)
+    return now
+
+
+class ChatRepository:
+    """
+    Chat persistence with a fixed query budget per request.
+
+    Reading a turn is one session lookup plus one history read (none of it
+    for a new conversation). Writing is a single transaction: the session
+    INSERT or ``updated_at`` UPDATE, then one multi-row INSERT for the user
+    message and the reply, so ``ChatSession`` ordering follows activity.
+    """
+
+    def __init__(self, user: Any, history_limit: Optional[int] = None) -> None:
+        self.user = user
+        self.history_limit = history_limit or getattr(settings, "AI_HISTORY_MESSAGES", 10)
+
+    def _session_qs(self, session_id: Any):
+        return ChatSession.objects.filter(id=session_id, user=self.user, is_active=True)
+
+    def _history_qs(self, session: ChatSession):
+        # Messages already folded into session.summary are not resent verbatim.
+        qs = ChatMessage.objects.filter(session_id=session.id).exclude(role=ChatMessage.ROLE_SYSTEM)
+        if session.summary_until_id:
+            qs = qs.filter(id__gt=session.summary_until_id)
+        # The new message takes one of the AI_HISTORY_MESSAGES slots.
+        return qs.order_by("-id").only("id", "role", "content")[: max(0, self.history_limit - 1)]
+
+    def _restore(self, session: ChatSession) -> ChatSession:
+        # Archived by services.retention: bring the messages back before anything reads them.
+        if session.archived_at is not None:
+            from services.retention import rehydrate
+
+            rehydrate(session.id)
+            session.archived_at = None
+        return session
+
+    def _new_turn(self, message: str) -> ChatTurn:
+        return ChatTurn(ChatSession(user=self.user, title=""), message, [])
+
+    def open_turn(self, session_id: Any, message: str) -> Optional[ChatTurn]:
+        """Returns None when ``session_id`` is not an active session of this user."""
+        if not session_id:
+            return self._new_turn(message)
+
+        session = self._session_qs(session_id).first()
+        if session is None:
+            return None
+
+        self._restore(session)
+        msgs = list(self._history_qs(session))
+        msgs.reverse()
+        return ChatTurn(session, message, [{"role": m.role, "content": m.content} for m in msgs])
+
+    async def aopen_turn(self, session_id: Any, message: str) -> Optional[ChatTurn]:
+        if not session_id:
+            return self._new_turn(message)
+
+        session = await self._session_qs(session_id).afirst()
+        if session is None:
+            return None
+
+        if session.archived_at is not None:
+            await sync_to_async(self._restore)(session)
+        msgs = [m async for m in self._history_qs(session)]
+        msgs.reverse()
+        return ChatTurn(session, message, [{"role": m.role, "content": m.content} for m in msgs])
+
+    def ensure_session(self, turn: ChatTurn) -> ChatSession:
+        """Insert a new conversation's session early, e.g. when its id must be sent before the reply."""
+        if turn.is_new:
+            turn.session.save()
+        return turn.session
+
+    def save_exchange(self, turn: ChatTurn, resp: Any = None) -> List[ChatMessage]:
+        """
+        Store the user message and, when given, the reply. Without ``resp``
+        (upstream failure, queued job) only the user message is written.
+        Returns the messages in order with their ids set.
+        """
+        with transaction.atomic():
+            if turn.is_new:
+                turn.session.save()
+            else:
+                turn.session.updated_at = touch_session(turn.session.id)
+
+            messages = [ChatMessage(session_id=turn.session.id, role=ChatMessage.ROLE_USER, content=turn.message)]
+            if resp is not None:
+                messages.append(assistant_message(turn.session.id, resp))
+            ChatMessage.objects.bulk_create(messages)
+
+        return messages
+
+    async def asave_exchange(self, turn: ChatTurn, resp: Any = None) -> List[ChatMessage]:
+        return await sync_to_async(self.save_exchange)(turn, resp)
+
+    def get_session(self, session_id: Any) -> Optional[ChatSession]:
+        session = self._session_qs(session_id).only("id", "title", "archived_at", "created_at", "updated_at").first()
+        return self._restore(session) if session is not None else None
+
+    def sessions_page(self, cursor: Optional[str], limit: int) -> Page:
+        """This user's active sessions, most recently used first (``(user, is_active, -updated_at)`` index)."""
+        # is_active__in: SQLite gets "is_active IN (1)", an index equality;
+        # is_active=True renders as a bare column test the planner cannot seek on.
+        qs = (
+            ChatSession.objects.filter(user=self.user, is_active__in=[True])
+            .only("id", "title", "created_at", "updated_at")
+        )
+        return keyset_page(qs, "updated_at", cursor, limit, id_desc=False)
+
+    def messages_page(self, session: ChatSession, cursor: Optional[str], limit: int) -> Page:
+        """A session's messages, newest first, paging back in time (``(session, created_at)`` index)."""
+        qs = (
+            ChatMessage.objects.filter(session_id=session.id)
+            .exclude(role=ChatMessage.ROLE_SYSTEM)
+            .only("id", "role", "content", "created_at")
+        )
+        return keyset_page(qs, "created_at", cursor, limit)
+
+
+def save_reply(session_id: int, resp: Any, **extra_meta: Any) -> ChatMessage:
+    """Store a reply whose user message is already saved (queued jobs)."""
+    with transaction.atomic():
+        message = assistant_message(session_id, resp, **extra_meta)
+        message.save()
+        touch_session(session_id)
+    return message
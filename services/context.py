@@ -1,11 +1,24 @@
 from __future__ import annotations
 
+import logging
+import re
+import threading
+import uuid
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 
 from gym.models import Trainer, TrainingProgram, Membership
+from services.ranking import BM25Index, tokenize, weighted_query
+
+logger = logging.getLogger(__name__)
+
+
+CATALOG_VERSION_KEY = "ai:catalog:version"
 
 
 @dataclass(frozen=True)
@@ -16,9 +29,99 @@ class SiteContext:
     programs: List[Dict[str, Any]]
 
 
-def build_site_context(user_id: int, limit: int = 30) -> SiteContext:
-    User = get_user_model()
-    user = User.objects.filter(id=user_id).first()
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """
+    User-independent part of the site context for one catalog version.
+    Shared by every request in the worker: treat the rows as read-only.
+    """
+
+    version: str
+    trainers: Tuple[Dict[str, Any], ...]
+    programs: Tuple[Dict[str, Any], ...]
+
+
+_snapshots: Dict[Optional[int], CatalogSnapshot] = {}
+_indexes: Dict[str, "CatalogIndex"] = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_catalog_version() -> str:
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, uuid.uuid4().hex[:12], timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version() -> str:
+    version = uuid.uuid4().hex[:12]
+    cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+    with _snapshots_lock:
+        _snapshots.clear()
+        _indexes.clear()
+    logger.info("Catalog version bumped to %s", version)
+    return version
+
+
+def _load_catalog(version: str, limit: Optional[int]) -> CatalogSnapshot:
+    trainers_qs = Trainer.objects.all().order_by("id")[:limit]
+    trainers_payload = tuple(
+        {
+            "id": t.id,
+            "name": t.name,
+            "specialization": t.specialization,
+            "description": (t.description or "")[:280],
+        }
+        for t in trainers_qs
+    )
+
+    programs_qs = TrainingProgram.objects.select_related("trainer").all().order_by("id")[:limit]
+    programs_payload = tuple(
+        {
+            "id": p.id,
+            "name": p.name,
+            "description": (p.description or "")[:280],
+            "duration_min": p.duration,
+            "price": str(p.price),
+            "trainer_id": p.trainer_id,
+            "trainer_name": p.trainer.name if p.trainer else None,
+        }
+        for p in programs_qs
+    )
+
+    return CatalogSnapshot(version=version, trainers=trainers_payload, programs=programs_payload)
+
+
+def get_catalog_snapshot(limit: Optional[int] = 30) -> CatalogSnapshot:
+    """
+    Process memory first, then the shared cache, then the database. The
+    version check is a single cache read, so a bump from any worker (via the
+    Trainer/TrainingProgram signals) is picked up on the next request.
+    """
+    version = get_catalog_version()
+
+    with _snapshots_lock:
+        snapshot = _snapshots.get(limit)
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    shared_key = f"ai:catalog:snapshot:{version}:{limit}"
+    snapshot = cache.get(shared_key)
+    if snapshot is None:
+        snapshot = _load_catalog(version, limit)
+        cache.set(shared_key, snapshot, timeout=getattr(settings, "AI_CATALOG_CACHE_SECONDS", 86400))
+
+    with _snapshots_lock:
+        _snapshots[limit] = snapshot
+    return snapshot
+
+
+def build_site_context(user_id: int, limit: Optional[int] = 30, user: Optional[Any] = None) -> SiteContext:
+    """``limit=0`` leaves the catalog out (retrieval mode fetches its own rows)."""
+    if user is None:
+        User = get_user_model()
+        user = User.objects.filter(id=user_id).first()
 
     user_payload = {
         "id": user.id if user else None,
@@ -57,57 +160,102 @@ def build_site_context(user_id: int, limit: int = 30) -> SiteContext:
             } if membership_obj.program.trainer else None,
         }
 
-    trainers_qs = Trainer.objects.all().order_by("id")[:limit]
-    trainers_payload = [
-        {
-            "id": t.id,
-            "name": t.name,
-            "specialization": t.specialization,
-            "description": (t.description or "")[:280],
-        }
-        for t in trainers_qs
-    ]
-
-    programs_qs = TrainingProgram.objects.select_related("trainer").all().order_by("id")[:limit]
-    programs_payload = [
-        {
-            "id": p.id,
-            "name": p.name,
-            "description": (p.description or "")[:280],
-            "duration_min": p.duration,
-            "price": str(p.price),
-            "trainer_id": p.trainer_id,
-            "trainer_name": p.trainer.name if p.trainer else None,
-        }
-        for p in programs_qs
-    ]
+    catalog = get_catalog_snapshot(limit) if limit != 0 else None
 
     return SiteContext(
         user=user_payload,
         membership=membership_payload,
-        trainers=trainers_payload,
-        programs=programs_payload,
+        trainers=list(catalog.trainers) if catalog else [],
+        programs=list(catalog.programs) if catalog else [],
     )
 
 
+# goal -> (detection keywords, ranking terms). Detection is checked in order;
+# extra goals can be added through settings.AI_GOALS with the same shape.
+GOALS: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {
+    "muscle_gain": (
+        ("muscle", "bulk", "mass", "strength", "hypertrophy", "gain", "big"),
+        ("muscle", "mass", "strength", "gain", "hypertrophy", "bulk"),
+    ),
+    "weight_loss": (
+        ("lose", "loss", "cut", "fat", "lean", "weight loss", "calories"),
+        ("fat", "loss", "cut", "lean", "weight", "cardio"),
+    ),
+    "endurance": (
+        ("endurance", "cardio", "stamina", "run", "running", "conditioning", "fitness"),
+        ("endurance", "cardio", "fitness", "stamina", "conditioning", "run"),
+    ),
+    "mobility": (
+        ("mobility", "flexibility", "flexible", "stretch", "yoga", "posture"),
+        ("mobility", "flexibility", "stretch", "stretching", "yoga", "posture"),
+    ),
+    "combat": (
+        ("boxing", "box", "kickbox", "martial", "mma", "fight", "self-defense"),
+        ("boxing", "kickboxing", "martial", "mma", "combat", "fight"),
+    ),
+    "beginner": (
+        ("beginner", "newbie", "first time", "start training", "never trained"),
+        ("beginner", "basic", "introduction", "start", "foundation"),
+    ),
+}
+
+_QUERY_STOPWORDS = frozenset(
+    "the and for with you your what which who how can want need like good best about from that this "
+    "have has are is was program trainer".split()
+)
+
+
+def _goals() -> Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]]:
+    return {**GOALS, **getattr(settings, "AI_GOALS", {})}
+
+
+@lru_cache(maxsize=8)
+def _goal_matcher(goals: Tuple[Tuple[str, Tuple[str, ...]], ...]) -> "re.Pattern[str]":
+    # One branch per goal, each an anchored lookahead for any of its keywords
+    # at the start of a word ("gain" matches "gains", not "again"): the first
+    # goal in declaration order with a keyword anywhere in the text wins.
+    branches = ("|".join(re.escape(k) for k in keywords) for _, keywords in goals)
+    return re.compile("|".join(rf"^(?=.*?\b({b}))" for b in branches), re.S)
+
+
 def detect_goal(text: str) -> Optional[str]:
-    q = (text or "").lower()
+    goals = tuple((goal, keywords) for goal, (keywords, _) in _goals().items())
+    m = _goal_matcher(goals).match((text or "").lower())
+    return goals[m.lastindex - 1][0] if m else None
 
-    gain_kw = ["muscle", "bulk", "mass", "strength", "hypertrophy", "gain", "big"]
-    loss_kw = ["lose", "loss", "cut", "fat", "lean", "weight loss", "calories"]
-    endurance_kw = ["endurance", "cardio", "stamina", "run", "running", "conditioning", "fitness"]
 
-    if any(k in q for k in gain_kw):
-        return "muscle_gain"
-    if any(k in q for k in loss_kw):
-        return "weight_loss"
-    if any(k in q for k in endurance_kw):
-        return "endurance"
-    return None
+@dataclass(frozen=True)
+class CatalogIndex:
+    version: str
+    trainers: BM25Index
+    programs: BM25Index
+
+
+def get_catalog_index() -> CatalogIndex:
+    """
+    BM25 indexes over the whole catalog (not just the rows sent in the
+    prompt), built once per catalog version and kept in process memory.
+    """
+    snapshot = get_catalog_snapshot(limit=None)
+
+    with _snapshots_lock:
+        index = _indexes.get(snapshot.version)
+    if index is not None:
+        return index
+
+    index = CatalogIndex(
+        version=snapshot.version,
+        trainers=BM25Index(snapshot.trainers, {"specialization": 2, "name": 1, "description": 1}),
+        programs=BM25Index(snapshot.programs, {"name": 2, "description": 1}),
+    )
+
+    with _snapshots_lock:
+        _indexes.clear()
+        _indexes[snapshot.version] = index
+    return index
 
 
 def match_trainers_and_programs(
-    site: SiteContext,
     user_message: str,
     top_k: int = 3,
 ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Optional[str]]:
@@ -115,38 +263,67 @@ def match_trainers_and_programs(
     if not goal:
         return [], [], None
 
-    def score_trainer(t: Dict[str, Any]) -> int:
-        s = (t.get("specialization") or "").lower()
-        d = (t.get("description") or "").lower()
-        hay = f"{s} {d}"
+    _, goal_terms = _goals()[goal]
+    message_terms = [w for w in tokenize(user_message) if len(w) > 2 and w not in _QUERY_STOPWORDS]
+    query = weighted_query((goal_terms, 1.0), (message_terms, 0.5))
+
+    index = get_catalog_index()
+    best_trainers = [t for t, _ in index.trainers.search(query, top_k)]
+    best_programs = [p for p, _ in index.programs.search(query, top_k)]
+
+    return best_trainers, best_programs, goal
+
 
-        if goal == "muscle_gain":
-            keys = ["muscle", "mass", "strength", "gain", "hypertrophy", "bulk"]
-        elif goal == "weight_loss":
-            keys = ["fat", "loss", "cut", "lean", "weight", "cardio"]
-        else:
-            keys = ["endurance", "cardio", "fitness", "stamina", "conditioning", "run"]
+@dataclass(frozen=True)
+class CatalogMatches:
+    trainers: List[Dict[str, Any]]
+    programs: List[Dict[str, Any]]
+    recommended_trainers: List[Dict[str, Any]]
+    recommended_programs: List[Dict[str, Any]]
+    goal: Optional[str]
 
-        return sum(2 for k in keys if k in hay)
 
-    def score_program(p: Dict[str, Any]) -> int:
-        n = (p.get("name") or "").lower()
-        d = (p.get("description") or "").lower()
-        hay = f"{n} {d}"
+def retrieve_catalog(user_message: str, top_k: Optional[int] = None, suggest_k: int = 3) -> CatalogMatches:
+    """
+    The ``top_k`` (``AI_RETRIEVAL_TOP_K``) trainers and programs most similar
+    to the question, by cosine similarity against the catalog vectors in
+    ``services/vector_index.py``. A detected goal adds its ranking terms to
+    the query and turns the best ``suggest_k`` rows into recommendations.
+    Rows at or below ``AI_RETRIEVAL_MIN_SIMILARITY`` (hash collisions alone
+    score up to ~0.05) do not count as matches; when fewer rows match, the
+    rest are filled from the start of the catalog so the model always has
+    something to cite.
+    """
+    from services.vector_index import get_catalog_vectors
 
-        if goal == "muscle_gain":
-            keys = ["mass", "muscle", "strength", "bulk", "hypertrophy"]
-        elif goal == "weight_loss":
-            keys = ["fat", "loss", "cut", "lean", "weight"]
-        else:
-            keys = ["endurance", "cardio", "fitness", "conditioning", "stamina"]
+    top_k = top_k if top_k is not None else getattr(settings, "AI_RETRIEVAL_TOP_K", 6)
+    goal = detect_goal(user_message)
+    query_text = user_message
+    if goal:
+        query_text = f"{user_message} {' '.join(_goals()[goal][1])}"
 
-        return sum(2 for k in keys if k in hay)
+    snapshot = get_catalog_snapshot(limit=None)
+    vectors = get_catalog_vectors(snapshot)
+    q = vectors.embed(query_text)
+    min_score = getattr(settings, "AI_RETRIEVAL_MIN_SIMILARITY", 0.1)
 
-    ranked_trainers = sorted(site.trainers, key=score_trainer, reverse=True)
-    ranked_programs = sorted(site.programs, key=score_program, reverse=True)
+    def pick(rows: Tuple[Dict[str, Any], ...], index: Any) -> Tuple[List[Dict[str, Any]], int]:
+        hits = [i for i, _ in index.search(q, top_k, min_score)]
+        matched = len(hits)
+        for i in range(len(rows)):
+            if len(hits) >= top_k:
+                break
+            if i not in hits:
+                hits.append(i)
+        return [rows[i] for i in hits], matched
 
-    best_trainers = [t for t in ranked_trainers if score_trainer(t) > 0][:top_k]
-    best_programs = [p for p in ranked_programs if score_program(p) > 0][:top_k]
+    trainers, trainer_hits = pick(snapshot.trainers, vectors.trainers)
+    programs, program_hits = pick(snapshot.programs, vectors.programs)
 
-    return best_trainers, best_programs, goal
\ No newline at end of file
+    return CatalogMatches(
+        trainers=trainers,
+        programs=programs,
+        recommended_trainers=trainers[: min(suggest_k, trainer_hits)] if goal else [],
+        recommended_programs=programs[: min(suggest_k, program_hits)] if goal else [],
+        goal=goal,
+    )
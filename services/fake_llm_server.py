@@ -0,0 +1,371 @@
+"""
+Stand-alone fake of Ollama's chat APIs (native ``/api/chat`` and the
+OpenAI-compatible ``/v1/chat/completions``) for load tests; needs only the
+standard library (no Django):
+
+    python -m services.fake_llm_server --port 11435 --latency lognormal:-0.7,0.5 --error-rate 0.01
+
+then point the app at it with ``OLLAMA_BASE_URL=http://127.0.0.1:11435``.
+
+It also fakes Gemini's ``generateContent``/``streamGenerateContent`` and
+``cachedContents`` under ``/v1beta`` (``GEMINI_BASE_URL=http://127.0.0.1:11435/v1beta``,
+any ``GEMINI_API_KEY``), reporting cached prefix tokens the way Gemini does.
+
+Latency specs (seconds): ``fixed:0.5``, ``uniform:0.2,1.5``,
+``normal:0.8,0.2``, ``lognormal:mu,sigma`` (of the underlying normal) and
+``exp:0.6`` (mean).
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+WORDS = (
+    "train consistently focus on form progressive overload rest well hydrate "
+    "our programs trainers membership schedule strength cardio mobility recovery"
+).split()
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    kind, _, raw = spec.partition(":")
+    args = [float(a) for a in raw.split(",") if a]
+
+    samplers: Dict[str, Callable[[], float]] = {
+        "fixed": lambda: args[0],
+        "uniform": lambda: random.uniform(args[0], args[1]),
+        "normal": lambda: random.gauss(args[0], args[1]),
+        "lognormal": lambda: random.lognormvariate(args[0], args[1]),
+        "exp": lambda: random.expovariate(1 / args[0]),
+    }
+    if kind not in samplers:
+        raise argparse.ArgumentTypeError(f"unknown latency distribution {kind!r}")
+
+    sample = samplers[kind]
+    sample()  # fail fast on missing arguments
+    return lambda: max(0.0, sample())
+
+
+class FakeLLMState:
+    def __init__(self, latency: Callable[[], float], error_rate: float, error_status: int, reply_words: int, tokens_per_sec: float) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reply_words = reply_words
+        self.tokens_per_sec = tokens_per_sec
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.cached_contents: Dict[str, int] = {}  # Gemini handle -> prefix tokens
+        self.payloads: List[Dict[str, Any]] = []  # last Gemini request bodies, newest last
+
+    def reply(self, messages: List[Dict[str, Any]]) -> List[str]:
+        question = str(messages[-1].get("content") or "") if messages else ""
+        rnd = random.Random(question)
+        return [rnd.choice(WORDS) for _ in range(self.reply_words)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeLLMServer"
+
+    def log_message(self, fmt: str, *args: Any) -> None:
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def _json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        state = self.server.state
+        if self.path in ("/", "/health"):
+            self._json(200, {"status": "ok", "requests": state.requests, "errors": state.errors})
+        elif self.path == "/v1/models":
+            self._json(200, {"object": "list", "data": [{"id": self.server.model, "object": "model"}]})
+        elif self.path == "/api/tags":
+            self._json(200, {"models": [{"name": self.server.model}]})
+        else:
+            self._json(404, {"error": "not found"})
+
+    def _failed(self) -> bool:
+        state = self.server.state
+        with state.lock:
+            state.requests += 1
+            failed = random.random() < state.error_rate
+            if failed:
+                state.errors += 1
+        return failed
+
+    def do_DELETE(self) -> None:
+        path = urlsplit(self.path).path
+        name = path[len("/v1beta/"):] if path.startswith("/v1beta/cachedContents/") else ""
+        with self.server.state.lock:
+            found = self.server.state.cached_contents.pop(name, None) is not None
+        if found:
+            self._json(200, {})
+        else:
+            self._json(404, {"error": {"code": 404, "message": "CachedContent not found", "status": "NOT_FOUND"}})
+
+    def do_POST(self) -> None:
+        state = self.server.state
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        path = urlsplit(self.path).path
+        gemini = path.startswith("/v1beta/")
+        native = path == "/api/chat"
+        if not (gemini or native or path == "/v1/chat/completions"):
+            self._json(404, {"error": "not found"})
+            return
+
+        try:
+            payload = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            self._json(400, {"error": {"message": "invalid JSON"}})
+            return
+
+        if gemini:
+            self._gemini(path, payload)
+            return
+
+        failed = self._failed()
+
+        messages = payload.get("messages") or []
+        model = payload.get("model") or self.server.model
+        if native and not messages:
+            # Ollama loads the model and returns at once for an empty chat (warm-up).
+            self._json(200, {"model": model, "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "load"})
+            return
+
+        time.sleep(state.latency())
+        if failed:
+            self._json(state.error_status, {"error": {"message": "injected failure", "type": "server_error"}})
+            return
+
+        words = state.reply(messages)
+        num_predict = (payload.get("options") or {}).get("num_predict")
+        if native and num_predict and num_predict > 0:
+            words = words[:num_predict]
+        usage = {
+            "prompt_tokens": (sum(len(str(m.get("content") or "")) for m in messages) + 3) // 4,
+            "completion_tokens": len(words),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        if native:
+            self._native(payload, model, words, usage)
+            return
+
+        if payload.get("stream"):
+            include_usage = bool((payload.get("stream_options") or {}).get("include_usage"))
+            self._stream(completion_id, model, words, usage if include_usage else None)
+            return
+
+        self._json(
+            200,
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}
+                ],
+                "usage": usage,
+            },
+        )
+
+    def _native(self, payload: Dict[str, Any], model: str, words: List[str], usage: Dict[str, int]) -> None:
+        final = {
+            "model": model,
+            "message": {"role": "assistant", "content": ""},
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": usage["prompt_tokens"],
+            "eval_count": usage["completion_tokens"],
+            "load_duration": 0,
+        }
+        if not payload.get("stream", True):
+            final["message"]["content"] = " ".join(words)
+            self._json(200, final)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        delay = 1 / self.server.state.tokens_per_sec if self.server.state.tokens_per_sec else 0.0
+        try:
+            for i, word in enumerate(words):
+                chunk = {"model": model, "message": {"role": "assistant", "content": word if i == 0 else " " + word}, "done": False}
+                self.wfile.write((json.dumps(chunk) + "\n").encode())
+                self.wfile.flush()
+                if delay:
+                    time.sleep(delay)
+            self.wfile.write((json.dumps(final) + "\n").encode())
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _stream(self, completion_id: str, model: str, words: List[str], usage: Optional[Dict[str, int]] = None) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        delay = 1 / self.server.state.tokens_per_sec if self.server.state.tokens_per_sec else 0.0
+        try:
+            for i, word in enumerate(words):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                if delay:
+                    time.sleep(delay)
+            if usage:
+                # stream_options.include_usage: one last chunk with no choices.
+                final = {"id": completion_id, "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+                self.wfile.write(f"data: {json.dumps(final)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Client stopped reading mid-stream; nothing left to do.
+            pass
+
+
+    def _gemini(self, path: str, payload: Dict[str, Any]) -> None:
+        state = self.server.state
+
+        def text_tokens(content: Optional[Dict[str, Any]]) -> int:
+            chars = sum(len(str(p.get("text") or "")) for p in (content or {}).get("parts") or [])
+            return (chars + 3) // 4
+
+        if path == "/v1beta/cachedContents":
+            tokens = text_tokens(payload.get("systemInstruction")) + sum(text_tokens(c) for c in payload.get("contents") or [])
+            if tokens < 1024:
+                self._json(400, {"error": {"code": 400, "message": "Cached content is too small.", "status": "INVALID_ARGUMENT"}})
+                return
+            name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+            with state.lock:
+                state.cached_contents[name] = tokens
+            self._json(200, {"name": name, "model": payload.get("model"), "usageMetadata": {"totalTokenCount": tokens}})
+            return
+
+        model, _, method = path[len("/v1beta/models/"):].partition(":")
+        if not path.startswith("/v1beta/models/") or method not in ("generateContent", "streamGenerateContent"):
+            self._json(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+            return
+
+        with state.lock:
+            state.payloads = (state.payloads + [payload])[-20:]
+        handle = payload.get("cachedContent")
+        if handle and payload.get("systemInstruction"):
+            self._json(400, {"error": {"code": 400, "message": "CachedContent can not be used with system_instruction", "status": "INVALID_ARGUMENT"}})
+            return
+        cached = state.cached_contents.get(handle, 0) if handle else 0
+        if handle and not cached:
+            self._json(403, {"error": {"code": 403, "message": "CachedContent not found (or permission denied)", "status": "PERMISSION_DENIED"}})
+            return
+
+        failed = self._failed()
+        time.sleep(state.latency())
+        if failed:
+            self._json(state.error_status, {"error": {"code": state.error_status, "message": "injected failure", "status": "INTERNAL"}})
+            return
+
+        contents = payload.get("contents") or []
+        last = contents[-1] if contents else {}
+        question = " ".join(str(p.get("text") or "") for p in last.get("parts") or [])
+        words = state.reply([{"content": question}])
+        usage = {
+            "promptTokenCount": cached + text_tokens(payload.get("systemInstruction")) + sum(text_tokens(c) for c in contents),
+            "candidatesTokenCount": len(words),
+        }
+        if cached:
+            usage["cachedContentTokenCount"] = cached
+        usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+
+        def candidate(text: str) -> Dict[str, Any]:
+            return {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+
+        if method == "generateContent":
+            self._json(200, {"candidates": [{**candidate(" ".join(words)), "finishReason": "STOP"}], "usageMetadata": usage, "modelVersion": model})
+            return
+
+        alt = parse_qs(urlsplit(self.path).query).get("alt", [""])[0]
+        if alt != "sse":
+            self._json(400, {"error": {"code": 400, "message": "this fake streams with alt=sse only", "status": "INVALID_ARGUMENT"}})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        delay = 1 / state.tokens_per_sec if state.tokens_per_sec else 0.0
+        try:
+            for i, word in enumerate(words):
+                chunk = {"candidates": [candidate(word if i == 0 else " " + word)], "usageMetadata": {**usage, "candidatesTokenCount": i + 1}}
+                self.wfile.write(f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+                self.wfile.flush()
+                if delay:
+                    time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state: FakeLLMState, model: str = "fake-llm", verbose: bool = False) -> None:
+        super().__init__(address, Handler)
+        self.state = state
+        self.model = model
+        self.verbose = verbose
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Fake Ollama (/api/chat, /v1) and Gemini (/v1beta) chat server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--model", default="fake-llm")
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("fixed:0.3"))
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0, help="stream pacing; 0 sends all chunks at once")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    state = FakeLLMState(args.latency, args.error_rate, args.error_status, args.reply_words, args.tokens_per_sec)
+    server = FakeLLMServer((args.host, args.port), state, model=args.model, verbose=args.verbose)
+    print(f"Fake LLM server on http://{args.host}:{args.port} (OLLAMA_BASE_URL)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"requests={state.requests} errors={state.errors}")
+
+
+if __name__ == "__main__":
+    main()
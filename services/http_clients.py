@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
+import logging
+import threading
+import weakref
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import httpx
+from django.conf import settings
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ClientPool:
+    """
+    Long-lived httpx clients for one upstream (one pool per provider).
+
+    The sync client is shared by every thread in the worker; async clients are
+    bound to an event loop, so one is kept per running loop. Connection reuse is
+    measured through httpcore's ``trace`` extension: every request counts, and
+    every TCP connect counts as a newly opened connection.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.limits = httpx.Limits(
+            max_connections=getattr(settings, "AI_HTTP_MAX_CONNECTIONS", 20),
+            max_keepalive_connections=getattr(settings, "AI_HTTP_MAX_KEEPALIVE", 10),
+            keepalive_expiry=getattr(settings, "AI_HTTP_KEEPALIVE_EXPIRY", 60),
+        )
+        self.http2 = bool(getattr(settings, "AI_HTTP2", True)) and _http2_available()
+
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+        self._requests = 0
+        self._connects = 0
+
+    def _count_request(self) -> None:
+        with self._lock:
+            self._requests += 1
+
+    def _count_connect(self) -> None:
+        with self._lock:
+            self._connects += 1
+
+    def _trace(self, event: str, info: Dict[str, Any]) -> None:
+        if event == "connection.connect_tcp.complete":
+            self._count_connect()
+
+    async def _atrace(self, event: str, info: Dict[str, Any]) -> None:
+        self._trace(event, info)
+
+    def _on_request(self, request: httpx.Request) -> None:
+        self._count_request()
+        request.extensions["trace"] = self._trace
+
+    async def _aon_request(self, request: httpx.Request) -> None:
+        self._count_request()
+        request.extensions["trace"] = self._atrace
+
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None or self._client.is_closed:
+                self._client = httpx.Client(
+                    limits=self.limits,
+                    http2=self.http2,
+                    event_hooks={"request": [self._on_request]},
+                )
+                logger.info("Opened HTTP client pool provider=%s http2=%s", self.name, self.http2)
+            return self._client
+
+    def async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None or client.is_closed:
+                # Clients of loops that have finished (asyncio.run, async_to_sync)
+                # can no longer be closed gracefully; drop them so their pools go.
+                for finished in [lp for lp in self._async_clients if lp.is_closed()]:
+                    del self._async_clients[finished]
+                client = httpx.AsyncClient(
+                    limits=self.limits,
+                    http2=self.http2,
+                    event_hooks={"request": [self._aon_request]},
+                )
+                self._async_clients[loop] = client
+                logger.info("Opened async HTTP client pool provider=%s http2=%s", self.name, self.http2)
+            return client
+
+    def _open_connections(self) -> int:
+        clients = [self._client] + list(self._async_clients.values())
+        total = 0
+        for c in clients:
+            if c is None or c.is_closed:
+                continue
+            # httpx keeps the httpcore pool on the transport; fall back to 0 if
+            # the internals ever change rather than breaking stats.
+            pool = getattr(getattr(c, "_transport", None), "_pool", None)
+            total += len(getattr(pool, "connections", []) or [])
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests, connects = self._requests, self._connects
+
+        reused = max(requests - connects, 0)
+        return {
+            "provider": self.name,
+            "http2": self.http2,
+            "requests": requests,
+            "connections_opened": connects,
+            "connections_open": self._open_connections(),
+            "reuse_ratio": round(reused / requests, 3) if requests else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+    async def aclose(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+
+_pools: Dict[str, ClientPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name: str) -> ClientPool:
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = ClientPool(name)
+            _pools[name] = pool
+        return pool
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {p.name: p.stats() for p in pools}
+
+
+def _series(field: str):
+    def collect() -> Iterator[Tuple[Dict[str, Any], float]]:
+        for name, s in pool_stats().items():
+            yield {"provider": name}, s[field]
+
+    return collect
+
+
+metrics.HTTP_REQUESTS.sources.append(_series("requests"))
+metrics.HTTP_CONNECTS.sources.append(_series("connections_opened"))
+metrics.HTTP_OPEN.sources.append(_series("connections_open"))
+
+
+def close_pools() -> None:
+    with _pools_lock:
+        pools = list(_pools.values())
+    for p in pools:
+        p.close()
+
+
+async def aclose_pools() -> None:
+    """Close the running loop's async clients; call before a long-lived loop (the job worker's) ends."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for p in pools:
+        await p.aclose()
+
+
+atexit.register(close_pools)
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import logging
+import re
+import threading
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.urls import reverse
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Full-sentence patterns over ``normalise_question`` output. Anything longer
+# or more specific ("what programs do you have for bad knees?") is the
+# model's job; so are requests that need a human decision.
+INTENTS: Tuple[Tuple[str, str], ...] = (
+    (
+        "buy_membership",
+        r"(?:how (?:do|can|to) (?:i )?|where (?:do|can) i |i (?:want|would like|d like) to |can i )"
+        r"(?:buy|purchase|get|order|pay for|sign up for|subscribe to)(?: a| an| the)?(?: new)?(?: gym)? (?:membership|subscription)"
+        r"(?: online| here)?"
+        r"|how (?:do|can) i (?:join|sign up|become a member)(?: the gym)?",
+    ),
+    (
+        "membership_status",
+        r"(?:what is|whats|what's|check|show)(?: me)? my (?:membership|subscription)(?: status)?"
+        r"|(?:when|what day) (?:does|will) my (?:membership|subscription) (?:end|expire|run out)"
+        r"|(?:do i have|is my) (?:an? )?(?:active )?(?:membership|subscription)(?: still)?(?: active| valid)?"
+        r"|am i (?:a )?member",
+    ),
+    (
+        "membership_history",
+        r"(?:where|how) (?:can|do) i (?:see|find|view) my (?:payments|payment history|purchases|memberships|membership history)",
+    ),
+    (
+        "profile",
+        r"(?:where|how) (?:is|can i (?:see|find|view|open)|do i (?:see|find|open)) (?:my )?(?:profile|account)(?: page)?"
+        r"|(?:how (?:do|can) i )?(?:edit|update|change) my (?:profile|account|name|email)(?: details)?",
+    ),
+    (
+        "programs",
+        r"(?:what|which) (?:training )?(?:programs|classes)(?: do you| does the gym| you)? (?:have|offer|got|run)(?: here| available)?"
+        r"|(?:what|which) (?:training )?(?:programs|classes) (?:are|is) (?:there|available)"
+        r"|(?:list|show me)(?: all)?(?: the| your)? (?:training )?(?:programs|classes)",
+    ),
+    (
+        "trainers",
+        r"(?:who are|list|show me)(?: all)?(?: the| your)? (?:trainers|coaches)"
+        r"|(?:what|which) (?:trainers|coaches)(?: do you)? (?:have|are there|work here)",
+    ),
+    (
+        "community",
+        r"(?:where|how) (?:is|can i (?:find|see)|do i find) (?:the )?(?:community|feed|forum)(?: page)?"
+        r"|how (?:do|can) i (?:write|create|make|add|publish) (?:a )?post",
+    ),
+)
+
+_INTENT_NAMES = tuple(name for name, _ in INTENTS)
+# One compiled alternation; every branch must span the whole question, so
+# the first intent listed wins and ``lastindex`` says which one it was.
+_INTENT_RE = re.compile("|".join(f"((?:{pattern})$)" for _, pattern in INTENTS))
+_GREETING_RE = re.compile(r"^(?:(?:hi|hello|hey)(?: there)? )?(?:please )?(?:can you tell me )?")
+_NON_WORD_RE = re.compile(r"[^a-z0-9' ]+")
+
+
+def normalise_question(text: str) -> str:
+    q = _NON_WORD_RE.sub(" ", (text or "").lower())
+    q = " ".join(q.split())
+    q = _GREETING_RE.sub("", q)
+    return q.removesuffix(" please")
+
+
+def match_intent(text: str) -> Optional[str]:
+    q = normalise_question(text)
+    if not q or len(q) > getattr(settings, "AI_INTENT_MAX_CHARS", 80):
+        return None
+    m = _INTENT_RE.match(q)
+    return _INTENT_NAMES[m.lastindex - 1] if m else None
+
+
+def _active(membership: Optional[Dict[str, Any]]) -> bool:
+    return bool(membership) and membership.get("status") == "active" and (membership.get("end_date") or "") >= date.today().isoformat()
+
+
+def _listing(rows: Sequence[str]) -> str:
+    limit = getattr(settings, "AI_INTENT_LIST_LIMIT", 10)
+    lines = [f"- {row}" for row in rows[:limit]]
+    if len(rows) > limit:
+        lines.append(f"- ...and {len(rows) - limit} more")
+    return "\n".join(lines)
+
+
+def _buy_membership(membership: Optional[Dict[str, Any]], catalog: Any) -> str:
+    if _active(membership):
+        return (
+            f"You already have an active membership ({membership['program']['name']}) until {membership['end_date']}. "
+            f"A new one can be bought after it expires; your memberships are listed at {reverse('memberships_list')}."
+        )
+    return (
+        f"Open Training Programs ({reverse('training_programs')}), pick a program and press \"Pay for <program>\". "
+        "You can pay by card or Google Pay, and the membership is active for 30 days from the day you pay."
+    )
+
+
+def _membership_status(membership: Optional[Dict[str, Any]], catalog: Any) -> str:
+    if not membership:
+        return f"You don't have a membership yet. You can get one from Training Programs ({reverse('training_programs')})."
+    program = membership["program"]["name"]
+    if _active(membership):
+        return f"Your {program} membership is active until {membership['end_date']}. Details are on your profile ({reverse('profile')})."
+    return (
+        f"Your last membership ({program}) ended on {membership['end_date']}. "
+        f"You can get a new one from Training Programs ({reverse('training_programs')})."
+    )
+
+
+def _membership_history(membership: Optional[Dict[str, Any]], catalog: Any) -> str:
+    return f"All your memberships, current and past, are listed at {reverse('memberships_list')}."
+
+
+def _profile(membership: Optional[Dict[str, Any]], catalog: Any) -> str:
+    return f"Your profile is at {reverse('profile')}; to change your name or email use {reverse('edit_profile')}."
+
+
+def _programs(membership: Optional[Dict[str, Any]], catalog: Any) -> str:
+    if not catalog.programs:
+        return f"There are no programs listed right now; check Training Programs ({reverse('training_programs')}) later."
+    rows = [
+        f"{p['name']}: {p['price']}, {p['duration_min']} min" + (f", with {p['trainer_name']}" if p.get("trainer_name") else "")
+        for p in catalog.programs
+    ]
+    return (
+        f"We offer {len(rows)} program{'s' if len(rows) != 1 else ''}:\n{_listing(rows)}\n"
+        f"See them all and sign up at {reverse('training_programs')}."
+    )
+
+
+def _trainers(membership: Optional[Dict[str, Any]], catalog: Any) -> str:
+    if not catalog.trainers:
+        return f"No trainers are listed right now; check About Us ({reverse('about_us')}) later."
+    rows = [f"{t['name']} ({t['specialization']}): {reverse('trainer_detail', args=[t['id']])}" for t in catalog.trainers]
+    return f"Our trainers:\n{_listing(rows)}\nMore about the team at {reverse('about_us')}."
+
+
+def _community(membership: Optional[Dict[str, Any]], catalog: Any) -> str:
+    return f"The community feed is at {reverse('community')}; write your post in the box at the top of that page."
+
+
+ANSWERS: Dict[str, Callable[[Optional[Dict[str, Any]], Any], str]] = {
+    "buy_membership": _buy_membership,
+    "membership_status": _membership_status,
+    "membership_history": _membership_history,
+    "profile": _profile,
+    "programs": _programs,
+    "trainers": _trainers,
+    "community": _community,
+}
+
+
+@dataclass(frozen=True)
+class IntentAnswer:
+    intent: str
+    text: str
+
+
+class IntentStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.by_intent: Dict[str, int] = {}
+
+    def record(self, intent: Optional[str]) -> None:
+        with self._lock:
+            self.requests += 1
+            if intent:
+                self.by_intent[intent] = self.by_intent.get(intent, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            served = sum(self.by_intent.values())
+            return {
+                "requests": self.requests,
+                "fast_path": served,
+                "share": round(served / self.requests, 4) if self.requests else 0.0,
+                "by_intent": dict(self.by_intent),
+            }
+
+
+_stats = IntentStats()
+
+
+def stats() -> Dict[str, Any]:
+    """Chat requests seen by this process and the share answered without the model."""
+    return _stats.snapshot()
+
+
+def _lookup_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    s = stats()
+    yield {"intent": "none"}, s["requests"] - s["fast_path"]
+    for intent, n in s["by_intent"].items():
+        yield {"intent": intent}, n
+
+
+metrics.INTENT_LOOKUPS.sources.append(_lookup_series)
+
+
+def answer(message: str, membership: Optional[Dict[str, Any]]) -> Optional[IntentAnswer]:
+    """
+    Templated answer for a recognised site-navigation question, built from
+    the live catalog snapshot, the user's membership and the URL map; None
+    sends the question to the model. Every call is counted in ``stats()``.
+    """
+    intent = match_intent(message) if getattr(settings, "AI_INTENTS_ENABLED", True) else None
+    if intent is not None:
+        from services.context import get_catalog_snapshot
+
+        text = ANSWERS[intent](membership, get_catalog_snapshot(limit=None))
+    _stats.record(intent)
+    if intent is None:
+        return None
+    logger.info("AI intent fast path intent=%s", intent)
+    return IntentAnswer(intent=intent, text=text)
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from services import admission, metrics, usage, warmup
+from services.http_clients import aclose_pools
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(session, user_message, payload: Dict[str, Any]):
+    """
+    ``payload`` holds the ``generate_response`` inputs captured at request
+    time: ``message``, ``history``, ``site_context``, ``suggestions`` and
+    ``summary``.
+    """
+    from ai_assistant.models import GenerationJob
+
+    job = GenerationJob.objects.create(session=session, user_message=user_message, payload=payload)
+    logger.info("AI job queued job_id=%s session_id=%s", job.id, session.id)
+    return job
+
+
+def requeue_stale() -> int:
+    """Give jobs whose worker died mid-run back to the queue, or fail them after the last attempt."""
+    from ai_assistant.models import GenerationJob
+
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, "AI_JOBS_STALE_SECONDS", 120))
+    stale = GenerationJob.objects.filter(status=GenerationJob.STATUS_RUNNING, started_at__lt=cutoff)
+    max_attempts = getattr(settings, "AI_JOBS_MAX_ATTEMPTS", 2)
+
+    failed = stale.filter(attempts__gte=max_attempts).update(
+        status=GenerationJob.STATUS_FAILED,
+        error="Worker did not finish the job.",
+        finished_at=timezone.now(),
+    )
+    requeued = stale.update(status=GenerationJob.STATUS_QUEUED, claimed_by="")
+    if failed or requeued:
+        logger.warning("AI jobs recovered requeued=%s failed=%s", requeued, failed)
+    return requeued
+
+
+def claim(limit: int) -> List[Any]:
+    """
+    Claim up to ``limit`` queued jobs, oldest first. The conditional UPDATE
+    is the lock: a job another worker claimed in between no longer matches
+    ``status=queued``, so every job goes to exactly one worker without
+    needing ``SKIP LOCKED``.
+    """
+    from ai_assistant.models import GenerationJob
+
+    ids = list(
+        GenerationJob.objects.filter(status=GenerationJob.STATUS_QUEUED)
+        .filter(Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()))
+        .order_by("id")
+        .values_list("id", flat=True)[:limit]
+    )
+    if not ids:
+        return []
+
+    token = uuid.uuid4().hex
+    GenerationJob.objects.filter(id__in=ids, status=GenerationJob.STATUS_QUEUED).update(
+        status=GenerationJob.STATUS_RUNNING,
+        claimed_by=token,
+        started_at=timezone.now(),
+        attempts=F("attempts") + 1,
+    )
+    return list(
+        GenerationJob.objects.filter(claimed_by=token, status=GenerationJob.STATUS_RUNNING).select_related("session").order_by("id")
+    )
+
+
+def complete(job, resp) -> bool:
+    """
+    Store the reply, unless the job is no longer this worker's: when
+    ``requeue_stale`` gave it to another worker meanwhile, that worker
+    answers it. The claim-checked UPDATE comes first, so a stale worker
+    never stores a second reply. Returns whether the reply was stored.
+    """
+    from ai_assistant.models import GenerationJob
+    from services.chat_repository import save_reply
+    from services.summary import schedule_summary
+
+    with transaction.atomic():
+        claimed = GenerationJob.objects.filter(
+            id=job.id, claimed_by=job.claimed_by, status=GenerationJob.STATUS_RUNNING
+        ).update(status=GenerationJob.STATUS_DONE, finished_at=timezone.now())
+        if not claimed:
+            logger.warning("AI job reply dropped, job was reclaimed job_id=%s", job.id)
+            return False
+        message = save_reply(job.session_id, resp, job_id=job.id)
+        GenerationJob.objects.filter(id=job.id).update(result_message=message)
+    schedule_summary(job.session_id)
+    return True
+
+
+def fail(job, error: BaseException) -> None:
+    from ai_assistant.models import GenerationJob
+
+    retry = job.attempts < getattr(settings, "AI_JOBS_MAX_ATTEMPTS", 2)
+    GenerationJob.objects.filter(id=job.id, claimed_by=job.claimed_by).update(
+        status=GenerationJob.STATUS_QUEUED if retry else GenerationJob.STATUS_FAILED,
+        claimed_by="",
+        error=str(error)[:2000],
+        finished_at=None if retry else timezone.now(),
+    )
+
+
+def defer(job, seconds: float) -> None:
+    """
+    Give a job back to the queue without spending an attempt (the model was
+    saturated, not failing), claimable again after ``seconds``. The back-off
+    lives in the row, so the worker's slot is free for other jobs meanwhile.
+    """
+    from ai_assistant.models import GenerationJob
+
+    GenerationJob.objects.filter(id=job.id, claimed_by=job.claimed_by).update(
+        status=GenerationJob.STATUS_QUEUED,
+        claimed_by="",
+        attempts=F("attempts") - 1,
+        run_after=timezone.now() + timedelta(seconds=seconds),
+    )
+
+
+class Worker:
+    """
+    Runs queued generation jobs. Up to ``concurrency`` jobs are in flight at
+    once on one event loop (``LLMService.agenerate_response``), and a free
+    slot is refilled as soon as a job finishes rather than when the whole
+    batch does, so the upstream model is kept busy.
+    """
+
+    def __init__(self, concurrency: Optional[int] = None, poll_seconds: Optional[float] = None) -> None:
+        from services.ai_service import LLMService
+
+        self.concurrency = concurrency or getattr(settings, "AI_JOBS_CONCURRENCY", 8)
+        self.poll_seconds = poll_seconds or getattr(settings, "AI_JOBS_POLL_SECONDS", 0.5)
+        self.service = LLMService()
+        self.processed = 0
+        self.failed = 0
+
+    async def _run_job(self, job) -> None:
+        # Each job runs in its own task, so its timings stay separate.
+        metrics.start()
+        metrics.note(queue_ms=round((job.started_at - job.created_at).total_seconds() * 1000, 1))
+        p = job.payload
+        try:
+            resp = await self.service.agenerate_response(
+                user_message=p["message"],
+                conversation_history=p.get("history") or [],
+                site_context=p.get("site_context"),
+                suggestions=p.get("suggestions"),
+                summary=p.get("summary") or "",
+            )
+        except admission.Overloaded as e:
+            logger.info("AI job deferred job_id=%s reason=%s retry_after=%s", job.id, e.reason, e.retry_after)
+            await sync_to_async(defer)(job, e.retry_after)
+            return
+        except Exception as e:
+            logger.warning("AI job failed job_id=%s attempt=%s error=%r", job.id, job.attempts, e)
+            self.failed += 1
+            await sync_to_async(fail)(job, e)
+            return
+
+        stored = await sync_to_async(complete)(job, metrics.annotate(resp))
+        # The model did the work either way.
+        await sync_to_async(usage.record_turn)(job.session.user_id, metrics.current().info)
+        if stored:
+            self.processed += 1
+            logger.info("AI job done job_id=%s provider=%s", job.id, resp.provider)
+
+    async def serve(self, once: bool = False) -> None:
+        """Process jobs until cancelled; with ``once`` stop when the queue is drained."""
+        running: Set[asyncio.Task] = set()
+        last_recovery = 0.0
+
+        if warmup.interval() > 0:
+            # Load the model before claiming anything, then keep it loaded.
+            await sync_to_async(warmup.warm_up, thread_sensitive=False)()
+            if not once:
+                warmup.start_warmup_thread(delay=True)
+
+        try:
+            while True:
+                if time.monotonic() - last_recovery > getattr(settings, "AI_JOBS_STALE_SECONDS", 120) / 2:
+                    await sync_to_async(requeue_stale)()
+                    last_recovery = time.monotonic()
+
+                free = self.concurrency - len(running)
+                if free > 0:
+                    for job in await sync_to_async(claim)(free):
+                        running.add(asyncio.ensure_future(self._run_job(job)))
+
+                if not running:
+                    if once:
+                        return
+                    await asyncio.sleep(self.poll_seconds)
+                    continue
+
+                done, _ = await asyncio.wait(running, timeout=self.poll_seconds, return_when=asyncio.FIRST_COMPLETED)
+                running -= done
+        finally:
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+            await aclose_pools()
+            await sync_to_async(close_old_connections)()
@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import replace
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    inner = ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in items)
+    return "{" + inner + "}"
+
+
+def _fmt_value(v: float) -> str:
+    return "+Inf" if v == float("inf") else repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in items)
+        return lines
+
+
+class CollectedCounter:
+    """
+    Counter kept by its owner (e.g. under a lock it already holds) and read
+    when scraped: the owning module appends a ``sources`` callable yielding
+    ``(labels, value)`` pairs, usually from its ``stats()``.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help = help_text
+        self.sources: List[Callable[[], Iterator[Tuple[Dict[str, Any], float]]]] = []
+
+    def render(self) -> List[str]:
+        items = sorted((_labels(labels), v) for source in self.sources for labels, v in source())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in items)
+        return lines
+
+
+class CollectedGauge(CollectedCounter):
+    """Current value (pool size, queue length) read from its owner when scraped."""
+
+    kind = "gauge"
+
+
+class Histogram:
+    """Fixed-bucket histogram; ``observe`` is a bisect plus a few additions under a lock."""
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> [per-bucket counts (last slot is +Inf), sum]
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][i] += 1
+            series[1][0] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(c), s[0])) for k, (c, s) in self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, (('le', _fmt_value(float(bound))),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {_fmt_value(total)}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {cumulative}")
+        return lines
+
+
+# Per-process registry: each worker exposes its own series. The Collected*
+# metrics are filled by the modules that own the numbers, once imported.
+REQUESTS = Counter("ai_chat_requests_total", "AI chat requests by endpoint and HTTP status.")
+REQUEST_SECONDS = Histogram("ai_chat_request_seconds", "AI chat request wall time by endpoint.")
+PHASE_SECONDS = Histogram("ai_chat_phase_seconds", "Time spent per AI chat pipeline phase.")
+ROUTES = Counter("ai_chat_routes_total", "AI chat requests by route: intent fast path or model.")
+INTENT_LOOKUPS = CollectedCounter("ai_intent_lookups_total", "Messages checked for a site-navigation intent, by intent matched (none: sent on).")
+CACHE_LOOKUPS = Counter("ai_cache_lookups_total", "AI answer cache lookups by result and key scope (shared/user).")
+SEMANTIC_LOOKUPS = CollectedCounter("ai_semantic_cache_lookups_total", "Semantic cache lookups by result.")
+SEMANTIC_ENTRIES = CollectedGauge("ai_semantic_cache_entries", "Answers held by the semantic cache.")
+CACHE_TIERS = CollectedCounter("cache_tier_lookups_total", "Tiered cache lookups by tier (l1/shared) and result.")
+COALESCED = CollectedCounter("ai_coalesced_total", "Replies that waited for an identical in-flight call, by scope (process/cluster).")
+IN_FLIGHT = CollectedGauge("ai_in_flight_calls", "Distinct upstream calls in flight in this process.")
+ADMISSIONS = Counter("ai_admission_total", "Upstream-call admission decisions: admitted, or shed (queue_full/timeout/cluster_timeout).")
+ADMISSION_SLOTS = CollectedGauge("ai_admission_slots", "Per-process upstream-call slots: limit, active and waiting.")
+PROVIDER_RESPONSES = Counter("ai_provider_responses_total", "Upstream LLM responses by provider and HTTP status.")
+PROVIDER_HEALTH = CollectedGauge("ai_provider_health", "Router window per provider: error_ratio, p95_seconds and circuit_open (0/1).")
+HEDGES = Counter("ai_router_hedges_total", "Hedged upstream calls by primary provider and the side that answered first (primary/backup).")
+HTTP_REQUESTS = CollectedCounter("ai_http_requests_total", "Requests sent through the pooled upstream HTTP client, by provider.")
+HTTP_CONNECTS = CollectedCounter("ai_http_connections_opened_total", "Upstream connections opened, by provider; requests minus these reused one.")
+HTTP_OPEN = CollectedGauge("ai_http_connections_open", "Upstream connections currently open, by provider.")
+TOKENS = Histogram("ai_tokens", "Tokens per upstream LLM call by direction (in/out).", TOKEN_BUCKETS)
+
+REGISTRY = (
+    REQUESTS,
+    REQUEST_SECONDS,
+    PHASE_SECONDS,
+    ROUTES,
+    INTENT_LOOKUPS,
+    CACHE_LOOKUPS,
+    SEMANTIC_LOOKUPS,
+    SEMANTIC_ENTRIES,
+    CACHE_TIERS,
+    COALESCED,
+    IN_FLIGHT,
+    ADMISSIONS,
+    ADMISSION_SLOTS,
+    PROVIDER_RESPONSES,
+    PROVIDER_HEALTH,
+    HEDGES,
+    HTTP_REQUESTS,
+    HTTP_CONNECTS,
+    HTTP_OPEN,
+    TOKENS,
+)
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class Timings:
+    """
+    Phase timers and facts (cache result, provider status, tokens) for one
+    chat request. Phases with the same name accumulate.
+    """
+
+    __slots__ = ("phases", "info", "started")
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = {}
+        self.info: Dict[str, Any] = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - t0
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def as_meta(self) -> Dict[str, Any]:
+        return {
+            **self.info,
+            "timings_ms": {k: round(v * 1000, 3) for k, v in self.phases.items()},
+        }
+
+
+_current: ContextVar[Optional[Timings]] = ContextVar("ai_timings", default=None)
+
+
+def current() -> Optional[Timings]:
+    return _current.get()
+
+
+def start() -> Timings:
+    """Begin timings for the current context (a task, or the job being run)."""
+    timings = Timings()
+    _current.set(timings)
+    return timings
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time a block into the current request's timings; a no-op outside one."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    with timings.phase(name):
+        yield
+
+
+def note(**info: Any) -> None:
+    timings = _current.get()
+    if timings is not None:
+        timings.info.update(info)
+
+
+def annotate(resp: Any, timings: Optional[Timings] = None) -> Any:
+    """Copy of ``resp`` (an LLMResponse) with the request's timings merged into its meta."""
+    timings = timings or _current.get()
+    if timings is None:
+        return resp
+    return replace(resp, meta={**(resp.meta or {}), **timings.as_meta()})
+
+
+def observe(endpoint: str, timings: Timings, status: int) -> None:
+    total = time.perf_counter() - timings.started
+    REQUESTS.inc(endpoint=endpoint, status=status)
+    REQUEST_SECONDS.observe(total, endpoint=endpoint)
+    for name, seconds in timings.phases.items():
+        PHASE_SECONDS.observe(seconds, phase=name)
+
+    info = timings.info
+    if info.get("route") == "intent":
+        ROUTES.inc(route="intent", intent=info.get("intent", ""))
+    elif "route" in info:
+        ROUTES.inc(route=info["route"])
+    if "admission" in info:
+        ADMISSIONS.inc(result=info["admission"])
+    if "cache" in info:
+        CACHE_LOOKUPS.inc(result=info["cache"], scope=info.get("cache_scope", "user"))
+    # Only requests that went upstream themselves; hits and coalesced replies reuse another call.
+    if info.get("cache") == "miss":
+        if "http_status" in info:
+            PROVIDER_RESPONSES.inc(provider=info.get("provider", ""), status=info["http_status"])
+        if info.get("tokens_in"):
+            TOKENS.observe(info["tokens_in"], direction="in")
+        if info.get("tokens_out"):
+            TOKENS.observe(info["tokens_out"], direction="out")
+
+
+def _finish_after(content: Iterator[bytes], endpoint: str, timings: Timings, status: int) -> Iterator[bytes]:
+    try:
+        yield from content
+    finally:
+        observe(endpoint, timings, status)
+
+
+def _finish(endpoint: str, timings: Timings, response: Any) -> Any:
+    if getattr(response, "streaming", False):
+        # Streaming views keep working after they return; record when the body is done.
+        response.streaming_content = _finish_after(response.streaming_content, endpoint, timings, response.status_code)
+    else:
+        observe(endpoint, timings, response.status_code)
+    return response
+
+
+def instrument(endpoint: str):
+    """
+    View decorator: collect phase timings for the request (see ``phase`` /
+    ``note``) and fold them into the histograms once the response is done.
+    Put it outside ``rate_limit`` so the limiter check is timed too.
+    """
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+
+            @wraps(view)
+            async def _async_wrapped(request, *args, **kwargs):
+                timings = Timings()
+                token = _current.set(timings)
+                try:
+                    response = await view(request, *args, **kwargs)
+                finally:
+                    _current.reset(token)
+                return _finish(endpoint, timings, response)
+
+            return _async_wrapped
+
+        @wraps(view)
+        def _wrapped(request, *args, **kwargs):
+            timings = Timings()
+            token = _current.set(timings)
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                _current.reset(token)
+            return _finish(endpoint, timings, response)
+
+        return _wrapped
+
+    return decorator
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Page:
+    items: List[Any]
+    next_cursor: Optional[str]
+
+
+def page_size(raw: Optional[str]) -> int:
+    """``?limit=`` clamped to ``1..AI_PAGE_SIZE_MAX``; empty means ``AI_PAGE_SIZE``."""
+    if not raw:
+        return getattr(settings, "AI_PAGE_SIZE", 20)
+    try:
+        n = int(raw)
+    except ValueError:
+        raise InvalidPage("limit must be an integer")
+    return max(1, min(n, getattr(settings, "AI_PAGE_SIZE_MAX", 100)))
+
+
+def encode_cursor(ts: datetime, pk: int) -> str:
+    raw = json.dumps([ts.isoformat(), pk], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts_raw, pk = json.loads(raw)
+        ts = parse_datetime(ts_raw)
+    except (ValueError, TypeError):
+        raise InvalidPage("invalid cursor")
+    if ts is None or not isinstance(pk, int):
+        raise InvalidPage("invalid cursor")
+    return ts, pk
+
+
+def keyset_page(qs: QuerySet, ts_field: str, cursor: Optional[str], limit: int, id_desc: bool = True) -> Page:
+    """
+    Newest-first page of ``qs`` ordered by ``ts_field`` descending, ties
+    broken by ``id`` (descending unless ``id_desc`` is False).
+
+    The cursor is the last row's ``(ts_field, id)``, and the next page is
+    "at or before that timestamp, minus the rows already served at it"
+    instead of an ``OFFSET``: the database seeks straight to that point in
+    the ``ts_field`` index, so page 100 costs what page 1 does and rows
+    inserted meanwhile neither shift nor repeat a page. Pick the tie-break
+    direction the index already stores ids in (SQLite appends the rowid
+    ascending), or the database sorts the rows instead of walking the index.
+    One extra row is fetched to know whether there is a next page.
+    """
+    if cursor:
+        ts, pk = decode_cursor(cursor)
+        seen = {"id__gte": pk} if id_desc else {"id__lte": pk}
+        qs = qs.filter(**{f"{ts_field}__lte": ts}).exclude(**{ts_field: ts, **seen})
+
+    rows = list(qs.order_by(f"-{ts_field}", "-id" if id_desc else "id")[: limit + 1])
+    items = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, ts_field), last.id)
+    return Page(items=items, next_cursor=next_cursor)
+
+
+def make_etag(parts: Iterable[Any]) -> str:
+    digest = hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def page_etag(page: Page, ts_field: str, *extra: Any) -> str:
+    parts: List[Any] = list(extra) + [page.next_cursor]
+    parts.extend(f"{item.id}:{getattr(item, ts_field).isoformat()}" for item in page.items)
+    return make_etag(parts)
+
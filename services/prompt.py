@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+DEFAULT_TOKEN_BUDGETS = {
+    "ollama": 1800,
+    "gemini": 6000,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English BPE vocabularies; good enough for budgeting.
+    return (len(text) + 3) // 4
+
+
+def _clean(value: Any) -> str:
+    return " ".join(str(value if value is not None else "").replace("|", "/").split())
+
+
+@dataclass(frozen=True)
+class Prompt:
+    messages: List[Dict[str, str]]
+    est_tokens: int
+    budget: int
+    dropped_history: int
+    dropped_rows: int
+    prefix_tokens: int = 0
+
+
+class PromptBuilder:
+    """
+    Assemble the chat prompt in a compact, pipe-separated format under a
+    token budget.
+
+    The first system message (system prompt + catalog rows in catalog order)
+    depends only on the catalog, so it is byte-identical for every user and
+    question and Ollama can reuse its KV cache across requests. Everything
+    per-user or per-question (membership, recommended rows missing from that
+    block, suggestions) goes into a second system message right before the
+    user's message; the rolling summary and history sit in between.
+
+    Reduction order when the estimate is over budget: drop the oldest
+    history beyond the last ``min_history`` messages, trim catalog
+    descriptions, drop catalog rows from the end, and finally drop the
+    remaining history. Each step applies to every request alike, so
+    over-budget prompts still share a prefix. Recommended rows and the
+    rolling conversation summary are never dropped: a recommended row that
+    lost its description or its catalog slot is repeated in full in the
+    per-user block.
+
+    With ``site_context["retrieved"]`` the rows were picked for this
+    question (``services.context.retrieve_catalog``), so they move into the
+    per-question block, best match first, and the first system message is
+    the system prompt alone; dropping rows then drops the weakest matches.
+    ``personal=False`` leaves the membership out for turns whose answer is
+    shared across users (``services.cacheability``).
+    """
+
+    def __init__(self, system_prompt: str, budget: int, min_history: int = 2, description_chars: int = 160) -> None:
+        self.system_prompt = system_prompt
+        self.budget = budget
+        self.min_history = min_history
+        self.description_chars = description_chars
+
+    @classmethod
+    def for_provider(cls, system_prompt: str, provider: str) -> "PromptBuilder":
+        budgets = {**DEFAULT_TOKEN_BUDGETS, **getattr(settings, "AI_PROMPT_TOKEN_BUDGET", {})}
+        return cls(
+            system_prompt,
+            budget=budgets.get(provider, DEFAULT_TOKEN_BUDGETS["ollama"]),
+            min_history=getattr(settings, "AI_PROMPT_MIN_HISTORY", 2),
+        )
+
+    def _trainer_row(self, t: Dict[str, Any], full: bool) -> str:
+        desc = _clean(t.get("description"))[: self.description_chars] if full else ""
+        return f"{t.get('id')}|{_clean(t.get('name'))}|{_clean(t.get('specialization'))}|{desc}"
+
+    def _program_row(self, p: Dict[str, Any], full: bool) -> str:
+        desc = _clean(p.get("description"))[: self.description_chars] if full else ""
+        return (
+            f"{p.get('id')}|{_clean(p.get('name'))}|{p.get('price')}|{p.get('duration_min')}"
+            f"|{_clean(p.get('trainer_id'))}|{desc}"
+        )
+
+    def _membership_line(self, m: Optional[Dict[str, Any]]) -> str:
+        if not m:
+            return "MEMBERSHIP none"
+
+        program = m.get("program") or {}
+        trainer = m.get("trainer") or {}
+        line = (
+            f"MEMBERSHIP status={m.get('status')} start={m.get('start_date')} end={m.get('end_date')}"
+            f" program={program.get('id')}:{_clean(program.get('name'))}"
+        )
+        if trainer:
+            line += f" trainer={trainer.get('id')}:{_clean(trainer.get('name'))}"
+        return line
+
+    def _suggestions_line(self, s: Optional[Dict[str, Any]]) -> str:
+        if not s:
+            return ""
+
+        trainer_ids = ",".join(str(t.get("id")) for t in s.get("recommended_trainers") or [])
+        program_ids = ",".join(str(p.get("id")) for p in s.get("recommended_programs") or [])
+        return (
+            f"SUGGESTIONS (picked by backend, ids refer to TRAINERS/PROGRAMS rows) "
+            f"goal={s.get('goal_detected') or 'none'} trainers={trainer_ids or '-'} programs={program_ids or '-'}"
+        )
+
+    def _context_rows(self, title: str, trainers: Sequence[Dict[str, Any]], programs: Sequence[Dict[str, Any]], full: bool) -> List[str]:
+        return (
+            [f"SITE_CONTEXT ({title}):", "TRAINERS id|name|specialization|description"]
+            + [self._trainer_row(t, full) for t in trainers]
+            + ["PROGRAMS id|name|price|duration_min|trainer_id|description"]
+            + [self._program_row(p, full) for p in programs]
+        )
+
+    def _catalog_block(
+        self,
+        trainers: Sequence[Dict[str, Any]],
+        programs: Sequence[Dict[str, Any]],
+        full: bool,
+        has_context: bool,
+        retrieved: bool = False,
+    ) -> str:
+        parts = [self.system_prompt]
+
+        if has_context and retrieved:
+            parts.append("SITE_CONTEXT (authoritative, do not invent) is in the last system message.")
+        elif has_context:
+            parts.extend(self._context_rows("authoritative, do not invent", trainers, programs, full))
+
+        return "\n".join(parts)
+
+    def _user_block(
+        self,
+        trainers: Sequence[Dict[str, Any]],
+        programs: Sequence[Dict[str, Any]],
+        membership_line: str,
+        suggestions_line: str,
+        has_context: bool,
+        context_rows: Sequence[str] = (),
+    ) -> str:
+        parts: List[str] = list(context_rows)
+
+        if has_context and membership_line:
+            parts.append(membership_line)
+        if trainers:
+            parts.append("MORE TRAINERS id|name|specialization|description")
+            parts.extend(self._trainer_row(t, True) for t in trainers)
+        if programs:
+            parts.append("MORE PROGRAMS id|name|price|duration_min|trainer_id|description")
+            parts.extend(self._program_row(p, True) for p in programs)
+        if suggestions_line:
+            parts.append(suggestions_line)
+
+        return "\n".join(parts)
+
+    def build(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        site_context: Optional[Dict[str, Any]] = None,
+        suggestions: Optional[Dict[str, Any]] = None,
+        summary: str = "",
+        personal: bool = True,
+    ) -> Prompt:
+        site_context = site_context or {}
+
+        recommended_trainers = (suggestions or {}).get("recommended_trainers") or []
+        recommended_programs = (suggestions or {}).get("recommended_programs") or []
+
+        # Catalog order, never relevance order, unless retrieved: the first
+        # block must not depend on the question.
+        retrieved = bool(site_context.get("retrieved"))
+        trainers = list(site_context.get("trainers") or [])
+        programs = list(site_context.get("programs") or [])
+        full = True
+
+        membership = site_context.get("membership")
+        if membership is None and suggestions:
+            membership = suggestions.get("membership")
+
+        # Impersonal turns leave the membership out, so their answer can be shared.
+        membership_line = self._membership_line(membership) if personal else ""
+        suggestions_line = self._suggestions_line(suggestions)
+        has_context = bool(site_context)
+        history = list(conversation_history)
+        summary_message = (
+            [{"role": "system", "content": f"CONVERSATION_SUMMARY (earlier turns): {summary.strip()}"}]
+            if summary and summary.strip()
+            else []
+        )
+        user_tokens = estimate_tokens(user_message) + sum(estimate_tokens(m["content"]) for m in summary_message)
+        dropped_history = dropped_rows = 0
+
+        def detail_rows(rows: Sequence[Dict[str, Any]], recommended: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            # Recommended rows the catalog block does not show in full.
+            shown = {r.get("id") for r in rows} if full else set()
+            return [r for r in recommended if r.get("id") not in shown]
+
+        def blocks() -> Tuple[str, str]:
+            context_rows = (
+                self._context_rows("authoritative, do not invent; rows relevant to this question", trainers, programs, full)
+                if retrieved and has_context
+                else []
+            )
+            return (
+                self._catalog_block(trainers, programs, full, has_context, retrieved),
+                self._user_block(
+                    detail_rows(trainers, recommended_trainers),
+                    detail_rows(programs, recommended_programs),
+                    membership_line,
+                    suggestions_line,
+                    has_context,
+                    context_rows,
+                ),
+            )
+
+        def total() -> int:
+            catalog_block, user_block = blocks()
+            return (
+                estimate_tokens(catalog_block)
+                + estimate_tokens(user_block)
+                + sum(estimate_tokens(m.get("content") or "") for m in history)
+                + user_tokens
+            )
+
+        est = total()
+
+        while est > self.budget and len(history) > self.min_history:
+            history.pop(0)
+            dropped_history += 1
+            est = total()
+
+        if est > self.budget:
+            full = False
+            est = total()
+
+        while est > self.budget and (trainers or programs):
+            # Drop from the tail of whichever list is longer: lower ids stay in the
+            # shared prefix, retrieved rows lose their weakest matches.
+            max((trainers, programs), key=len).pop()
+            dropped_rows += 1
+            est = total()
+
+        while est > self.budget and history:
+            history.pop(0)
+            dropped_history += 1
+            est = total()
+
+        catalog_block, user_block = blocks()
+        messages = [{"role": "system", "content": catalog_block}] + summary_message + history
+        if user_block:
+            messages.append({"role": "system", "content": user_block})
+        messages.append({"role": "user", "content": user_message})
+
+        return Prompt(
+            messages=messages,
+            est_tokens=est,
+            budget=self.budget,
+            dropped_history=dropped_history,
+            dropped_rows=dropped_rows,
+            prefix_tokens=estimate_tokens(catalog_block),
+        )
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import math
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Mapping, Sequence, Tuple
+
+import numpy as np
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for w in _WORD_RE.findall((text or "").lower()):
+        # Cheap plural folding so "programs"/"program" and "trainers"/"trainer" meet.
+        if len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+            w = w[:-1]
+        tokens.append(w)
+    return tokens
+
+
+@dataclass(frozen=True)
+class _Postings:
+    rows: np.ndarray
+    weights: np.ndarray
+
+
+class BM25Index:
+    """
+    Inverted index over a fixed set of rows with BM25 weights precomputed per
+    (term, row). Postings are NumPy arrays, so a query is one vectorised
+    scatter-add per query term plus a partial sort for the top k.
+
+    ``fields`` maps a row key to its weight (term frequency multiplier), e.g.
+    ``{"specialization": 2, "description": 1}``.
+    """
+
+    def __init__(
+        self,
+        rows: Sequence[Mapping[str, Any]],
+        fields: Mapping[str, float],
+        k1: float = 1.2,
+        b: float = 0.75,
+    ) -> None:
+        self.rows = list(rows)
+
+        docs: List[Counter] = []
+        for row in self.rows:
+            tf: Counter = Counter()
+            for field, weight in fields.items():
+                for tok in tokenize(str(row.get(field) or "")):
+                    tf[tok] += weight
+            docs.append(tf)
+
+        n = len(docs)
+        lengths = [sum(tf.values()) for tf in docs]
+        avg_len = (sum(lengths) / n) if n else 0.0
+
+        df: Counter = Counter()
+        for tf in docs:
+            df.update(tf.keys())
+
+        postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        for i, tf in enumerate(docs):
+            norm = k1 * (1 - b + b * (lengths[i] / avg_len)) if avg_len else k1
+            for term, f in tf.items():
+                idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+                postings[term].append((i, idf * f * (k1 + 1) / (f + norm)))
+
+        self._postings: Dict[str, _Postings] = {
+            term: _Postings(
+                np.fromiter((i for i, _ in items), dtype=np.int32, count=len(items)),
+                np.fromiter((w for _, w in items), dtype=np.float32, count=len(items)),
+            )
+            for term, items in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def search(self, query: Mapping[str, float], top_k: int) -> List[Tuple[Dict[str, Any], float]]:
+        """
+        ``query`` maps terms (already tokenized) to query weights. Returns
+        ``(row, score)`` pairs with a positive score, best first.
+        """
+        if not self.rows or top_k <= 0:
+            return []
+
+        scores = np.zeros(len(self.rows), dtype=np.float32)
+        for term, qw in query.items():
+            p = self._postings.get(term)
+            if p is not None:
+                # Row ids are unique within a posting list, so plain fancy-index add is safe.
+                scores[p.rows] += np.float32(qw) * p.weights
+
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        # Best first; ties broken by row order so results are deterministic.
+        top = top[np.lexsort((top, -scores[top]))]
+        return [(self.rows[i], round(float(scores[i]), 4)) for i in top if scores[i] > 0]
+
+
+def weighted_query(*parts: Tuple[Iterable[str], float]) -> Dict[str, float]:
+    q: Dict[str, float] = defaultdict(float)
+    for texts, weight in parts:
+        for text in texts:
+            for tok in tokenize(text):
+                q[tok] = max(q[tok], weight)
+    return dict(q)
@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from functools import wraps
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import JsonResponse
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+Limit = Union[int, Callable[[], int]]
+
+
+@dataclass(frozen=True)
+class RateLimitResult:
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: int
+
+
+class MemoryBackend:
+    """Process-local counters. Only correct with a single worker; meant for tests and dev."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._rows: Dict[str, Tuple[int, int, int]] = {}
+
+    def hit(self, key: str, window_start: int, window: int, amount: int = 1) -> Tuple[int, int]:
+        with self._lock:
+            start, hits, prev = self._rows.get(key, (window_start, 0, 0))
+            if start != window_start:
+                prev = hits if start == window_start - window else 0
+                hits = 0
+            hits += amount
+            self._rows[key] = (window_start, hits, prev)
+            return hits, prev
+
+    def peek(self, key: str, window_start: int, window: int) -> Tuple[int, int]:
+        with self._lock:
+            row = self._rows.get(key)
+        return _rolled(row, window_start, window)
+
+
+class CacheBackend:
+    """
+    One counter per fixed window in the Django cache, bumped with ``incr``
+    (atomic on Redis and Memcached). Shared across workers only when the
+    cache is; two round trips per check (incr + previous window read).
+    """
+
+    def hit(self, key: str, window_start: int, window: int, amount: int = 1) -> Tuple[int, int]:
+        current = f"{key}:{window_start}"
+        try:
+            hits = cache.incr(current, amount)
+        except ValueError:
+            # First hit in this window; add() loses to a concurrent first hit cleanly.
+            if cache.add(current, amount, timeout=window * 2):
+                hits = amount
+            else:
+                hits = cache.incr(current, amount)
+        prev = cache.get(f"{key}:{window_start - window}", 0)
+        return hits, prev
+
+    def peek(self, key: str, window_start: int, window: int) -> Tuple[int, int]:
+        values = cache.get_many([f"{key}:{window_start}", f"{key}:{window_start - window}"])
+        return values.get(f"{key}:{window_start}", 0), values.get(f"{key}:{window_start - window}", 0)
+
+
+class DatabaseBackend:
+    """
+    Counters in ``ai_assistant.RateLimitCounter``, updated with a single
+    ``INSERT ... ON CONFLICT DO UPDATE ... RETURNING`` statement, so the
+    increment, the window roll-over and the read are one atomic round trip
+    shared by every worker. Backends without upsert-returning fall back to a
+    row lock.
+    """
+
+    def _table(self) -> str:
+        from ai_assistant.models import RateLimitCounter
+
+        return connection.ops.quote_name(RateLimitCounter._meta.db_table)
+
+    def hit(self, key: str, window_start: int, window: int, amount: int = 1) -> Tuple[int, int]:
+        if connection.vendor not in ("sqlite", "postgresql"):
+            return self._hit_locked(key, window_start, window, amount)
+
+        t = self._table()
+        # SET expressions all see the pre-update row, so prev_hits reads the old hits.
+        sql = (
+            f"INSERT INTO {t} (key, window_start, hits, prev_hits) VALUES (%s, %s, %s, 0) "
+            f"ON CONFLICT (key) DO UPDATE SET "
+            f"prev_hits = CASE WHEN {t}.window_start = excluded.window_start THEN {t}.prev_hits "
+            f"WHEN {t}.window_start = excluded.window_start - %s THEN {t}.hits ELSE 0 END, "
+            f"hits = CASE WHEN {t}.window_start = excluded.window_start THEN {t}.hits + excluded.hits ELSE excluded.hits END, "
+            f"window_start = excluded.window_start "
+            f"RETURNING hits, prev_hits"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [key, window_start, amount, window])
+            hits, prev = cursor.fetchone()
+        return hits, prev
+
+    def _hit_locked(self, key: str, window_start: int, window: int, amount: int = 1) -> Tuple[int, int]:
+        from ai_assistant.models import RateLimitCounter
+
+        with transaction.atomic():
+            row, created = RateLimitCounter.objects.select_for_update().get_or_create(
+                key=key,
+                defaults={"window_start": window_start, "hits": amount},
+            )
+            if created:
+                return amount, 0
+            if row.window_start != window_start:
+                row.prev_hits = row.hits if row.window_start == window_start - window else 0
+                row.hits = 0
+                row.window_start = window_start
+            row.hits += amount
+            row.save(update_fields=["window_start", "hits", "prev_hits"])
+            return row.hits, row.prev_hits
+
+    def peek(self, key: str, window_start: int, window: int) -> Tuple[int, int]:
+        from ai_assistant.models import RateLimitCounter
+
+        row = RateLimitCounter.objects.filter(key=key).values_list("window_start", "hits", "prev_hits").first()
+        return _rolled(row, window_start, window)
+
+
+def _rolled(row: Optional[Tuple[int, int, int]], window_start: int, window: int) -> Tuple[int, int]:
+    # (hits, prev) as of ``window_start`` for a stored (window_start, hits, prev) row.
+    if row is None:
+        return 0, 0
+    start, hits, prev = row
+    if start == window_start:
+        return hits, prev
+    return 0, hits if start == window_start - window else 0
+
+
+_BACKENDS = {
+    "db": DatabaseBackend,
+    "cache": CacheBackend,
+    "memory": MemoryBackend,
+}
+_instances: Dict[str, object] = {}
+_instances_lock = threading.Lock()
+
+
+def get_backend(name: Optional[str] = None):
+    name = name or getattr(settings, "RATE_LIMIT_BACKEND", "db")
+    with _instances_lock:
+        backend = _instances.get(name)
+        if backend is None:
+            backend = _BACKENDS[name]()
+            _instances[name] = backend
+        return backend
+
+
+def _retry_after(hits: int, prev: int, limit: int, window: int, elapsed: float, cost: int = 1) -> int:
+    # Earliest point where ``cost`` more fits: later in this window while the
+    # previous window's weight decays, or else partway into the next window.
+    if hits + cost <= limit and prev:
+        wait = window * (1 - (limit - hits - cost) / prev) - elapsed
+    else:
+        wait = (window - elapsed) + (window * max(0.0, 1 - (limit - cost) / hits) if hits else 0.0)
+    return max(1, math.ceil(wait))
+
+
+def check(key: str, limit: int, window: int = 60) -> RateLimitResult:
+    """
+    Sliding-window counter: the estimate is this window's hits plus the
+    previous window's hits weighted by how much of it still overlaps the
+    last ``window`` seconds. Rejected attempts are counted as well, so a
+    client that keeps retrying stays limited.
+
+    Backend errors fail open: the limiter never takes an endpoint down.
+    """
+    now = time.time()
+    window_start = int(now // window) * window
+    elapsed = now - window_start
+
+    try:
+        hits, prev = get_backend().hit(key, window_start, window)
+    except Exception:
+        logger.exception("Rate limit backend failed key=%s", key)
+        return RateLimitResult(allowed=True, limit=limit, remaining=limit, retry_after=0)
+
+    estimate = prev * (1 - elapsed / window) + hits
+    if estimate <= limit:
+        return RateLimitResult(allowed=True, limit=limit, remaining=int(limit - estimate), retry_after=0)
+
+    return RateLimitResult(
+        allowed=False,
+        limit=limit,
+        remaining=0,
+        retry_after=_retry_after(hits, prev, limit, window, elapsed),
+    )
+
+
+def consume(key: str, amount: int, window: int = 60) -> None:
+    """Add ``amount`` to ``key``'s sliding window (e.g. tokens spent); fails open like ``check``."""
+    if amount <= 0:
+        return
+    window_start = int(time.time() // window) * window
+    try:
+        get_backend().hit(key, window_start, window, amount)
+    except Exception:
+        logger.exception("Rate limit backend failed key=%s", key)
+
+
+def peek(key: str, limit: int, window: int = 60) -> RateLimitResult:
+    """
+    ``check`` for amounts only known afterwards (tokens): allowed while the
+    sliding-window estimate is still under ``limit``; nothing is counted.
+    """
+    now = time.time()
+    window_start = int(now // window) * window
+    elapsed = now - window_start
+
+    try:
+        hits, prev = get_backend().peek(key, window_start, window)
+    except Exception:
+        logger.exception("Rate limit backend failed key=%s", key)
+        return RateLimitResult(allowed=True, limit=limit, remaining=limit, retry_after=0)
+
+    estimate = prev * (1 - elapsed / window) + hits
+    if estimate < limit:
+        return RateLimitResult(allowed=True, limit=limit, remaining=int(limit - estimate), retry_after=0)
+
+    return RateLimitResult(
+        allowed=False,
+        limit=limit,
+        remaining=0,
+        retry_after=_retry_after(hits, prev, limit, window, elapsed, cost=0),
+    )
+
+
+def _client_key(request) -> str:
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return f"u{user.pk}"
+    return f"ip{request.META.get('REMOTE_ADDR', '')}"
+
+
+def _limited_response(result: RateLimitResult) -> JsonResponse:
+    response = JsonResponse(
+        {"error": "Rate limit exceeded. Please slow down.", "retry_after": result.retry_after},
+        status=429,
+    )
+    response["Retry-After"] = str(result.retry_after)
+    return _with_headers(response, result)
+
+
+def _with_headers(response, result: RateLimitResult):
+    response["X-RateLimit-Limit"] = str(result.limit)
+    response["X-RateLimit-Remaining"] = str(result.remaining)
+    return response
+
+
+def rate_limit(
+    scope: str,
+    limit: Limit,
+    window: int = 60,
+    key: Optional[Callable] = None,
+    methods: Sequence[str] = ("POST",),
+):
+    """
+    View decorator: at most ``limit`` requests per ``window`` seconds per
+    client (user id, or remote address when anonymous) for ``scope``.
+    Requests with other methods pass through uncounted. ``limit`` may be a
+    callable so settings are read per request. Works on sync and async views;
+    place it under ``login_required`` so anonymous redirects are not counted.
+    """
+    key_func = key or _client_key
+
+    def _check(request) -> RateLimitResult:
+        n = limit() if callable(limit) else limit
+        with metrics.phase("rate_limit"):
+            return check(f"rl:{scope}:{key_func(request)}", n, window)
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+
+            @wraps(view)
+            async def _async_wrapped(request, *args, **kwargs):
+                if request.method not in methods:
+                    return await view(request, *args, **kwargs)
+                result = await sync_to_async(_check)(request)
+                if not result.allowed:
+                    return _limited_response(result)
+                return _with_headers(await view(request, *args, **kwargs), result)
+
+            return _async_wrapped
+
+        @wraps(view)
+        def _wrapped(request, *args, **kwargs):
+            if request.method not in methods:
+                return view(request, *args, **kwargs)
+            result = _check(request)
+            if not result.allowed:
+                return _limited_response(result)
+            return _with_headers(view(request, *args, **kwargs), result)
+
+        return _wrapped
+
+    return decorator
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+from services.ai_service import BaseProvider, LLMResponse, prompt_hash
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayMiss(LookupError):
+    pass
+
+
+class Cassette:
+    """
+    Recorded replies in a JSON Lines file, one ``{"key", "text", "provider",
+    "model", "latency_ms"}`` object per line, keyed by ``prompt_hash``.
+    Appending is safe across threads; re-recording a key keeps the last line.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._keys: List[str] = []
+
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._add(json.loads(line))
+        logger.info("AI replay cassette loaded path=%s entries=%s", path, len(self._keys))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _add(self, entry: Dict[str, Any]) -> None:
+        if entry["key"] not in self._entries:
+            self._keys.append(entry["key"])
+        self._entries[entry["key"]] = entry
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get(key)
+
+    def pick(self, key: str) -> Optional[Dict[str, Any]]:
+        """Some recorded entry for an unknown key, the same one every time for a given key."""
+        if not self._keys:
+            return None
+        return self._entries[self._keys[int(key[:8], 16) % len(self._keys)]]
+
+    def record(self, key: str, resp: LLMResponse, latency_ms: float) -> None:
+        entry = {
+            "key": key,
+            "text": resp.text,
+            "provider": resp.provider,
+            "model": resp.model,
+            "latency_ms": round(latency_ms, 1),
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+            self._add(entry)
+
+
+_cassettes: Dict[str, Cassette] = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(path: Optional[str] = None) -> Cassette:
+    path = str(path or getattr(settings, "AI_REPLAY_CASSETTE", "ai_cassette.jsonl"))
+    with _cassettes_lock:
+        cassette = _cassettes.get(path)
+        if cassette is None:
+            cassette = _cassettes[path] = Cassette(path)
+        return cassette
+
+
+class ReplayProvider(BaseProvider):
+    """
+    ``AI_PROVIDER=replay``: answers from a cassette instead of a model, for
+    load tests and reproducible debugging.
+
+    With an ``upstream`` provider (``AI_REPLAY_RECORD_FROM``) every call goes
+    to it and the reply is recorded. Otherwise replies are replayed, sleeping
+    for the recorded latency when ``AI_REPLAY_LATENCY`` is on. Prompts that
+    were never recorded raise ``ReplayMiss``, or with ``AI_REPLAY_ON_MISS=cycle``
+    get a recorded reply chosen by hash, which keeps varied load-test traffic
+    flowing.
+
+    The provider is named ``replay`` in both modes so prompt budgets, and
+    therefore the hashed prompts, match between recording and replaying.
+    """
+
+    def __init__(self, upstream: Optional[BaseProvider] = None, cassette: Optional[Cassette] = None) -> None:
+        self.name = "replay"
+        self.model = "replay"
+        self.upstream = upstream
+        # Not ``cassette or ...``: an empty cassette is falsy.
+        self.cassette = cassette if cassette is not None else get_cassette()
+        self.on_miss = getattr(settings, "AI_REPLAY_ON_MISS", "error")
+        self.latency = bool(getattr(settings, "AI_REPLAY_LATENCY", True))
+
+    def _lookup(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        key = prompt_hash(messages)
+        entry = self.cassette.get(key)
+        if entry is None and self.on_miss == "cycle":
+            entry = self.cassette.pick(key)
+        if entry is None:
+            raise ReplayMiss(f"No recorded reply for prompt {key} in {self.cassette.path}")
+        return entry
+
+    def _response(self, entry: Dict[str, Any]) -> LLMResponse:
+        return LLMResponse(
+            text=entry["text"],
+            provider=self.name,
+            model=entry.get("model") or self.model,
+            meta={"http_status": 200, "replay_key": entry["key"]},
+        )
+
+    def _delay(self, entry: Dict[str, Any]) -> float:
+        return (entry.get("latency_ms") or 0) / 1000 if self.latency else 0.0
+
+    def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        if self.upstream is not None:
+            started = time.monotonic()
+            resp = self.upstream.chat(messages)
+            self.cassette.record(prompt_hash(messages), resp, (time.monotonic() - started) * 1000)
+            return resp
+
+        entry = self._lookup(messages)
+        time.sleep(self._delay(entry))
+        return self._response(entry)
+
+    async def achat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        if self.upstream is not None:
+            started = time.monotonic()
+            resp = await self.upstream.achat(messages)
+            self.cassette.record(prompt_hash(messages), resp, (time.monotonic() - started) * 1000)
+            return resp
+
+        entry = self._lookup(messages)
+        await asyncio.sleep(self._delay(entry))
+        return self._response(entry)
+
+    def warm_up(self, prefix: Optional[List[Dict[str, str]]] = None) -> bool:
+        return self.upstream.warm_up(prefix) if self.upstream is not None else False
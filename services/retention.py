@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import gzip
+import json
+import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ai_assistant.models import ArchivedSession, ChatMessage, ChatSession, GenerationJob
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def _codec() -> str:
+    wanted = getattr(settings, "AI_ARCHIVE_CODEC", "auto")
+    if wanted == ArchivedSession.CODEC_GZIP:
+        return ArchivedSession.CODEC_GZIP
+    if _zstd() is not None:
+        return ArchivedSession.CODEC_ZSTD
+    if wanted == ArchivedSession.CODEC_ZSTD:
+        logger.warning("AI_ARCHIVE_CODEC=zstd but the zstandard package is missing; using gzip")
+    return ArchivedSession.CODEC_GZIP
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == ArchivedSession.CODEC_ZSTD:
+        return _zstd().ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(blob: bytes, codec: str) -> bytes:
+    if codec == ArchivedSession.CODEC_ZSTD:
+        zstd = _zstd()
+        if zstd is None:
+            raise RuntimeError("Archive is zstd-compressed but the zstandard package is not installed")
+        return zstd.ZstdDecompressor().decompress(blob)
+    return gzip.decompress(blob)
+
+
+@dataclass
+class RetentionReport:
+    sessions: int = 0
+    messages: int = 0
+    raw_bytes: int = 0  # message content + meta moved out of the hot table
+    stored_bytes: int = 0  # compressed blobs written to the archive table
+    skipped: int = 0  # touched while being archived; left for the next run
+    leftovers: int = 0  # hot rows of already archived sessions deleted by this run
+    table_bytes_before: Optional[int] = None
+    table_bytes_after: Optional[int] = None
+
+    @property
+    def reclaimed_bytes(self) -> Optional[int]:
+        """Hot table + index bytes freed, as measured by the database (None when it cannot tell)."""
+        if self.table_bytes_before is None or self.table_bytes_after is None:
+            return None
+        return self.table_bytes_before - self.table_bytes_after
+
+
+def chat_table_bytes() -> Optional[int]:
+    """On-disk size of ``ChatMessage`` and its indexes; None on backends we cannot measure."""
+    table = ChatMessage._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+            return cursor.fetchone()[0]
+        if connection.vendor == "sqlite":
+            try:
+                cursor.execute(
+                    "SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name = %s OR name IN "
+                    "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)",
+                    [table, table],
+                )
+            except Exception:
+                # SQLite built without SQLITE_ENABLE_DBSTAT_VTAB.
+                return None
+            return cursor.fetchone()[0]
+    return None
+
+
+def _message_bytes(content: str, meta: Any) -> int:
+    return len(content.encode("utf-8")) + (len(json.dumps(meta, cls=DjangoJSONEncoder)) if meta else 0)
+
+
+def _pack(rows: List[Dict[str, Any]]) -> Tuple[bytes, int]:
+    messages = [[r["id"], r["role"], r["content"], r["meta"], r["created_at"].isoformat()] for r in rows]
+    raw = sum(_message_bytes(r["content"], r["meta"]) for r in rows)
+    data = json.dumps({"v": FORMAT_VERSION, "messages": messages}, cls=DjangoJSONEncoder, separators=(",", ":"))
+    return data.encode("utf-8"), raw
+
+
+def _unpack(archive: ArchivedSession) -> List[List[Any]]:
+    return json.loads(decompress(bytes(archive.payload), archive.codec))["messages"]
+
+
+def _delete_messages(message_ids: List[int], batch_size: int) -> int:
+    """
+    Delete archived hot rows ``batch_size`` at a time, each batch its own
+    short transaction, so no single statement holds write locks for long.
+    Only ids that are in the archive blob are passed in: a turn that was
+    already open when its session got archived may still add messages,
+    and those stay (``rehydrate`` merges them with the archive).
+    Jobs pointing at these messages go with them (they are finished: sessions
+    with pending jobs are never archived).
+    """
+    deleted = 0
+    for start in range(0, len(message_ids), batch_size):
+        ids = message_ids[start : start + batch_size]
+        with transaction.atomic():
+            GenerationJob.objects.filter(user_message_id__in=ids).delete()
+            deleted += ChatMessage.objects.filter(id__in=ids).delete()[1].get(ChatMessage._meta.label, 0)
+    return deleted
+
+
+def sweep_leftovers(batch_size: int) -> int:
+    """Hot rows of sessions already archived that are in their archive, left behind by an interrupted run."""
+    archives = ArchivedSession.objects.filter(
+        session__archived_at__isnull=False, session__messages__isnull=False
+    ).distinct()
+    message_ids: List[int] = []
+    for archive in archives:
+        archived = {m[0] for m in _unpack(archive)}
+        hot = ChatMessage.objects.filter(session_id=archive.session_id).values_list("id", flat=True)
+        message_ids.extend(i for i in hot if i in archived)
+    return _delete_messages(sorted(message_ids), batch_size) if message_ids else 0
+
+
+def archive_sessions(
+    days: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    sessions_per_batch: int = 50,
+    dry_run: bool = False,
+    limit: Optional[int] = None,
+) -> RetentionReport:
+    """
+    Move every session idle for more than ``days`` (``AI_RETENTION_DAYS``)
+    into ``ArchivedSession`` and delete its ``ChatMessage`` rows.
+
+    Sessions are handled ``sessions_per_batch`` at a time: their messages are
+    read and compressed, then one short transaction writes the archive rows
+    and stamps ``archived_at`` only on sessions still idle (a chat turn bumps
+    ``updated_at`` in the same transaction as its messages, so a session
+    written to meanwhile is skipped, not archived without its new messages),
+    and finally the hot rows that went into the archive are deleted in
+    batches of ``batch_size``.
+    """
+    days = days if days is not None else getattr(settings, "AI_RETENTION_DAYS", 90)
+    batch_size = batch_size or getattr(settings, "AI_RETENTION_BATCH", 500)
+    cutoff = timezone.now() - timedelta(days=days)
+    codec = _codec()
+    report = RetentionReport(table_bytes_before=chat_table_bytes())
+
+    if not dry_run:
+        report.leftovers = sweep_leftovers(batch_size)
+
+    pending = GenerationJob.objects.filter(
+        status__in=(GenerationJob.STATUS_QUEUED, GenerationJob.STATUS_RUNNING)
+    ).values("session_id")
+    candidates = (
+        ChatSession.objects.filter(archived_at__isnull=True, updated_at__lt=cutoff)
+        .exclude(id__in=pending)
+        .order_by("id")
+    )
+
+    last_id = 0
+    while limit is None or report.sessions < limit:
+        take = sessions_per_batch if limit is None else min(sessions_per_batch, limit - report.sessions)
+        ids = list(candidates.filter(id__gt=last_id).values_list("id", flat=True)[:take])
+        if not ids:
+            break
+        last_id = ids[-1]
+
+        grouped: Dict[int, List[Dict[str, Any]]] = {i: [] for i in ids}
+        rows = (
+            ChatMessage.objects.filter(session_id__in=ids)
+            .order_by("session_id", "id")
+            .values("id", "session_id", "role", "content", "meta", "created_at")
+        )
+        for row in rows:
+            grouped[row["session_id"]].append(row)
+
+        archives: Dict[int, ArchivedSession] = {}
+        for session_id, msgs in grouped.items():
+            data, raw = _pack(msgs)
+            archives[session_id] = ArchivedSession(
+                session_id=session_id,
+                codec=codec,
+                payload=compress(data, codec),
+                message_count=len(msgs),
+                raw_bytes=raw,
+            )
+
+        if dry_run:
+            report.sessions += len(archives)
+            report.messages += sum(a.message_count for a in archives.values())
+            report.raw_bytes += sum(a.raw_bytes for a in archives.values())
+            report.stored_bytes += sum(len(a.payload) for a in archives.values())
+            continue
+
+        now = timezone.now()
+        with transaction.atomic():
+            ChatSession.objects.filter(id__in=ids, archived_at__isnull=True, updated_at__lt=cutoff).update(archived_at=now)
+            archived_ids = list(ChatSession.objects.filter(id__in=ids, archived_at=now).values_list("id", flat=True))
+            ArchivedSession.objects.bulk_create([archives[i] for i in archived_ids])
+
+        _delete_messages([row["id"] for i in archived_ids for row in grouped[i]], batch_size)
+
+        report.sessions += len(archived_ids)
+        report.skipped += len(ids) - len(archived_ids)
+        for i in archived_ids:
+            report.messages += archives[i].message_count
+            report.raw_bytes += archives[i].raw_bytes
+            report.stored_bytes += len(archives[i].payload)
+
+    report.table_bytes_after = chat_table_bytes()
+    logger.info(
+        "AI archive sessions=%s messages=%s raw_bytes=%s stored_bytes=%s skipped=%s reclaimed_bytes=%s dry_run=%s",
+        report.sessions,
+        report.messages,
+        report.raw_bytes,
+        report.stored_bytes,
+        report.skipped,
+        report.reclaimed_bytes,
+        dry_run,
+    )
+    return report
+
+
+def rehydrate(session_id: int) -> int:
+    """
+    Put an archived session's messages back into ``ChatMessage`` with their
+    original ids and timestamps (so ``summary_until_id`` and pagination
+    cursors stay valid) and drop the archive row. Returns the number of
+    messages restored; 0 when the session is not archived.
+    """
+    with transaction.atomic():
+        archive = ArchivedSession.objects.select_for_update().filter(session_id=session_id).first()
+        if archive is None:
+            return 0
+
+        packed = _unpack(archive)
+        messages = [
+            ChatMessage(id=mid, session_id=session_id, role=role, content=content, meta=meta)
+            for mid, role, content, meta, _ in packed
+        ]
+        # Rows an interrupted archive run left behind are already there.
+        ChatMessage.objects.bulk_create(messages, batch_size=500, ignore_conflicts=True)
+        # auto_now_add stamped "now" on insert; put the original times back.
+        for message, (*_, created_at) in zip(messages, packed):
+            message.created_at = parse_datetime(created_at)
+        ChatMessage.objects.bulk_update(messages, ["created_at"], batch_size=500)
+
+        archive.delete()
+        ChatSession.objects.filter(id=session_id).update(archived_at=None)
+
+    logger.info("AI archive rehydrated session_id=%s messages=%s", session_id, len(messages))
+    return len(messages)
+
+
+def vacuum() -> None:
+    """Give freed pages back to the OS (SQLite VACUUM rewrites the whole file; run it off-peak)."""
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("VACUUM")
+        elif connection.vendor == "postgresql":
+            cursor.execute(f"VACUUM ANALYZE {connection.ops.quote_name(ChatMessage._meta.db_table)}")
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+
+from services import metrics
+from services.ai_service import BaseProvider, LLMResponse
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProviderHealth:
+    """
+    Rolling latency/error window plus a circuit breaker for one provider.
+
+    The breaker opens after ``failure_threshold`` consecutive failures and
+    stays open for ``open_seconds``; after that a single trial request is let
+    through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, window: int, failure_threshold: int, open_seconds: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+
+        self._lock = threading.Lock()
+        # (latency or None, ok); latency is None for outcomes that are not a
+        # full request/response time, e.g. stream time-to-first-token.
+        self._samples: Deque[Tuple[Optional[float], bool]] = deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record(self, latency: Optional[float], ok: bool) -> None:
+        with self._lock:
+            self._samples.append((latency, ok))
+
+            if ok:
+                self._consecutive_failures = 0
+                if self._state != CLOSED:
+                    logger.info("AI circuit closed provider=%s", self.name)
+                self._state = CLOSED
+                return
+
+            self._consecutive_failures += 1
+            if self._state == HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    logger.warning(
+                        "AI circuit opened provider=%s consecutive_failures=%s",
+                        self.name,
+                        self._consecutive_failures,
+                    )
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def p95(self, min_samples: int) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(lat for lat, ok in self._samples if ok and lat is not None)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples)
+            state = self._state
+        errors = sum(1 for _, ok in samples if not ok)
+        return {
+            "state": state,
+            "samples": len(samples),
+            "error_rate": round(errors / len(samples), 3) if samples else 0.0,
+            "p95_ms": round((self.p95(1) or 0.0) * 1000, 1),
+        }
+
+
+_health: Dict[str, ProviderHealth] = {}
+_health_lock = threading.Lock()
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_health(name: str) -> ProviderHealth:
+    with _health_lock:
+        h = _health.get(name)
+        if h is None:
+            h = ProviderHealth(
+                name,
+                window=getattr(settings, "AI_ROUTER_WINDOW", 100),
+                failure_threshold=getattr(settings, "AI_ROUTER_FAILURE_THRESHOLD", 3),
+                open_seconds=getattr(settings, "AI_ROUTER_OPEN_SECONDS", 30),
+            )
+            _health[name] = h
+        return h
+
+
+def router_stats() -> Dict[str, Dict[str, Any]]:
+    with _health_lock:
+        items = list(_health.items())
+    return {name: h.stats() for name, h in items}
+
+
+def _health_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    for name, s in router_stats().items():
+        yield {"provider": name, "stat": "error_ratio"}, s["error_rate"]
+        yield {"provider": name, "stat": "p95_seconds"}, s["p95_ms"] / 1000
+        yield {"provider": name, "stat": "circuit_open"}, int(s["state"] != CLOSED)
+
+
+metrics.PROVIDER_HEALTH.sources.append(_health_series)
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    with _health_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "AI_ROUTER_HEDGE_WORKERS", 8),
+                thread_name_prefix="ai-hedge",
+            )
+        return _hedge_executor
+
+
+def _count_hedge(primary: BaseProvider, winner: BaseProvider) -> None:
+    metrics.HEDGES.inc(primary=primary.name, winner="primary" if winner is primary else "backup")
+
+
+class RouterProvider(BaseProvider):
+    """
+    Provider facade over an ordered list of providers (primary first).
+
+    Each call goes to the first provider whose circuit allows it and fails over
+    down the list on error. With hedging enabled, if the chosen provider has
+    not answered by its p95 latency (times ``AI_ROUTER_HEDGE_MULTIPLIER``), the
+    next provider is asked as well and the first success wins. In ``chat``
+    the losing call is left to finish on its thread and only its outcome is
+    recorded; ``achat`` cancels it. Which side won is counted in
+    ``ai_router_hedges_total``.
+    """
+
+    def __init__(self, providers: List[BaseProvider]) -> None:
+        self.providers = providers
+        primary = providers[0]
+        # Cache keys and prompt budgets follow the primary provider.
+        self.name = primary.name
+        self.model = primary.model
+        self.hedge = bool(getattr(settings, "AI_ROUTER_HEDGE", False))
+        self.hedge_min_samples = getattr(settings, "AI_ROUTER_HEDGE_MIN_SAMPLES", 20)
+        self.hedge_multiplier = getattr(settings, "AI_ROUTER_HEDGE_MULTIPLIER", 1.0)
+
+    def _next(self, queue: List[BaseProvider], tried: List[BaseProvider]) -> Optional[BaseProvider]:
+        # Circuits are only asked when a provider is about to be used, so a
+        # half-open trial slot is never claimed by a provider we skip.
+        while queue:
+            provider = queue.pop(0)
+            if get_health(provider.name).allow():
+                tried.append(provider)
+                return provider
+        if not tried:
+            # Every circuit open: fail open on the primary rather than refusing outright.
+            tried.append(self.providers[0])
+            return self.providers[0]
+        return None
+
+    def _hedge_delay(self, provider: BaseProvider) -> Optional[float]:
+        if not self.hedge:
+            return None
+        p95 = get_health(provider.name).p95(self.hedge_min_samples)
+        return p95 * self.hedge_multiplier if p95 is not None else None
+
+    def _timed(self, provider: BaseProvider, messages: List[Dict[str, str]]) -> LLMResponse:
+        started = time.monotonic()
+        try:
+            resp = provider.chat(messages)
+        except Exception:
+            get_health(provider.name).record(time.monotonic() - started, False)
+            raise
+        get_health(provider.name).record(time.monotonic() - started, True)
+        return resp
+
+    def chat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        queue, tried = list(self.providers), []
+        last_error: Optional[BaseException] = None
+        executor = _get_hedge_executor() if self.hedge else None
+
+        while True:
+            provider = self._next(queue, tried)
+            if provider is None:
+                break
+            delay = self._hedge_delay(provider) if queue else None
+
+            if executor is None or delay is None:
+                try:
+                    return self._timed(provider, messages)
+                except Exception as e:
+                    logger.warning("AI provider failed, failing over provider=%s error=%r", provider.name, e)
+                    last_error = e
+                    continue
+
+            pending: Dict[Future, BaseProvider] = {executor.submit(self._timed, provider, messages): provider}
+            done, _ = wait(pending, timeout=delay)
+            backup = self._next(queue, tried) if not done else None
+            if backup is not None:
+                logger.info("AI hedging provider=%s backup=%s after=%.0fms", provider.name, backup.name, delay * 1000)
+                pending[executor.submit(self._timed, backup, messages)] = backup
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    p = pending.pop(fut)
+                    try:
+                        resp = fut.result()
+                    except Exception as e:
+                        logger.warning("AI provider failed, failing over provider=%s error=%r", p.name, e)
+                        last_error = e
+                        continue
+                    if backup is not None:
+                        _count_hedge(provider, p)
+                    return resp
+
+        assert last_error is not None
+        raise last_error
+
+    async def _atimed(self, provider: BaseProvider, messages: List[Dict[str, str]]) -> LLMResponse:
+        started = time.monotonic()
+        try:
+            resp = await provider.achat(messages)
+        except Exception:
+            get_health(provider.name).record(time.monotonic() - started, False)
+            raise
+        get_health(provider.name).record(time.monotonic() - started, True)
+        return resp
+
+    async def achat(self, messages: List[Dict[str, str]]) -> LLMResponse:
+        queue, tried = list(self.providers), []
+        last_error: Optional[BaseException] = None
+
+        while True:
+            provider = self._next(queue, tried)
+            if provider is None:
+                break
+            delay = self._hedge_delay(provider) if queue else None
+
+            tasks: Dict[asyncio.Task, BaseProvider] = {asyncio.ensure_future(self._atimed(provider, messages)): provider}
+            backup: Optional[BaseProvider] = None
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                backup = self._next(queue, tried) if not done else None
+                if backup is not None:
+                    logger.info("AI hedging provider=%s backup=%s after=%.0fms", provider.name, backup.name, delay * 1000)
+                    tasks[asyncio.ensure_future(self._atimed(backup, messages))] = backup
+
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    p = tasks.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        logger.warning("AI provider failed, failing over provider=%s error=%r", p.name, e)
+                        last_error = e
+                        continue
+                    for other in tasks:
+                        other.cancel()
+                    if backup is not None:
+                        _count_hedge(provider, p)
+                    return result
+
+        assert last_error is not None
+        raise last_error
+
+    def stream(self, messages: List[Dict[str, str]]) -> Iterator[str]:
+        # Fail over only until the first delta; once text reached the client we
+        # cannot switch providers mid-answer.
+        queue, tried = list(self.providers), []
+        last_error: Optional[BaseException] = None
+
+        while True:
+            provider = self._next(queue, tried)
+            if provider is None:
+                break
+            chunks = provider.stream(messages)
+            try:
+                first = next(chunks, "")
+            except Exception as e:
+                get_health(provider.name).record(None, False)
+                logger.warning("AI provider failed, failing over provider=%s error=%r", provider.name, e)
+                last_error = e
+                continue
+
+            get_health(provider.name).record(None, True)
+            if first:
+                yield first
+            yield from chunks
+            return
+
+        assert last_error is not None
+        raise last_error
+
+    def warm_up(self, prefix: Optional[List[Dict[str, str]]] = None) -> bool:
+        warmed = False
+        for provider in self.providers:
+            try:
+                warmed = provider.warm_up(prefix) or warmed
+            except Exception as e:
+                logger.warning("AI provider warm-up failed provider=%s error=%r", provider.name, e)
+        return warmed
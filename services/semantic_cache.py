@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+# Phrases rewritten before tokenising so common paraphrases land on the same terms.
+_PHRASES = [
+    ("how much", "price"),
+    ("what's", "what is"),
+    ("whats", "what is"),
+    ("sign up", "join"),
+    ("signup", "join"),
+    ("work out", "workout"),
+]
+
+_SYNONYMS = {
+    "cost": "price",
+    "costs": "price",
+    "prices": "price",
+    "pricing": "price",
+    "fee": "price",
+    "fees": "price",
+    "programs": "program",
+    "programme": "program",
+    "plans": "program",
+    "plan": "program",
+    "trainers": "trainer",
+    "coach": "trainer",
+    "coaches": "trainer",
+    "memberships": "membership",
+    "subscription": "membership",
+    "buy": "purchase",
+    "pay": "purchase",
+}
+
+_STOPWORDS = frozenset(
+    "a an the is are was were be been of for to in on at by with and or do does did "
+    "i me my you your we our it its this that what which who whom how can could would "
+    "should please tell about there any some".split()
+)
+
+
+def normalise(text: str) -> List[str]:
+    q = (text or "").lower()
+    for phrase, repl in _PHRASES:
+        q = q.replace(phrase, repl)
+
+    terms = []
+    for w in _WORD_RE.findall(q):
+        w = _SYNONYMS.get(w, w)
+        if w not in _STOPWORDS:
+            terms.append(w)
+    return terms
+
+
+class HashingEmbedder:
+    """
+    CPU-only text embedding: signed feature hashing of unigrams and bigrams
+    into a fixed-size, L2-normalised float32 vector. No model files needed.
+    """
+
+    def __init__(self, dim: int = 512) -> None:
+        self.dim = dim
+
+    def embed(self, text: str) -> np.ndarray:
+        terms = normalise(text)
+        features = terms + [f"{a}_{b}" for a, b in zip(terms, terms[1:])]
+
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for f in features:
+            h = zlib.crc32(f.encode("utf-8"))
+            sign = 1.0 if (h >> 31) & 1 else -1.0
+            vec[h % self.dim] += sign
+
+        norm = float(np.linalg.norm(vec))
+        if norm:
+            vec /= norm
+        return vec
+
+
+@dataclass(frozen=True)
+class SemanticHit:
+    value: Dict[str, Any]
+    similarity: float
+
+
+class SemanticCache:
+    """
+    Fixed-capacity vector index of past answers, one row per cached question.
+
+    Rows live in a preallocated ``(capacity, dim)`` float32 matrix; lookups are
+    a single matrix-vector product masked to the caller's namespace and to
+    unexpired rows. When full, expired rows are reused first, then the least
+    recently used one.
+    """
+
+    def __init__(self, capacity: int, dim: int, ttl: float, threshold: float) -> None:
+        self.capacity = capacity
+        self.ttl = ttl
+        self.threshold = threshold
+        self.embedder = HashingEmbedder(dim)
+
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._namespaces = np.zeros(capacity, dtype=np.int64)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._values: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self._lookup_seconds = 0.0
+
+    @staticmethod
+    def namespace_id(namespace: str) -> int:
+        return int.from_bytes(hashlib.blake2b(namespace.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+    def lookup(self, question: str, namespace: str) -> Optional[SemanticHit]:
+        started = time.perf_counter()
+        q = self.embedder.embed(question)
+        ns = self.namespace_id(namespace)
+
+        with self._lock:
+            hit = None
+            n = self._size
+            if n and q.any():
+                now = time.time()
+                sims = self._vectors[:n] @ q
+                valid = (self._namespaces[:n] == ns) & (self._expires[:n] > now)
+                sims = np.where(valid, sims, -1.0)
+                i = int(np.argmax(sims))
+                if sims[i] >= self.threshold:
+                    self._last_used[i] = now
+                    hit = SemanticHit(value=self._values[i], similarity=round(float(sims[i]), 4))
+
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._lookup_seconds += time.perf_counter() - started
+
+        return hit
+
+    def store(self, question: str, namespace: str, value: Dict[str, Any]) -> None:
+        q = self.embedder.embed(question)
+        if not q.any():
+            return
+
+        now = time.time()
+        with self._lock:
+            if self._size < self.capacity:
+                i = self._size
+                self._size += 1
+            else:
+                expired = np.flatnonzero(self._expires <= now)
+                i = int(expired[0]) if expired.size else int(np.argmin(self._last_used))
+
+            self._vectors[i] = q
+            self._namespaces[i] = self.namespace_id(namespace)
+            self._expires[i] = now + self.ttl
+            self._last_used[i] = now
+            self._values[i] = value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "avg_lookup_ms": round(self._lookup_seconds * 1000 / lookups, 4) if lookups else 0.0,
+            }
+
+
+_cache: Optional[SemanticCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> SemanticCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SemanticCache(
+                capacity=getattr(settings, "AI_SEMANTIC_CACHE_SIZE", 2000),
+                dim=getattr(settings, "AI_SEMANTIC_CACHE_DIM", 512),
+                ttl=getattr(settings, "AI_SEMANTIC_CACHE_SECONDS", 600),
+                threshold=getattr(settings, "AI_SEMANTIC_CACHE_THRESHOLD", 0.85),
+            )
+        return _cache
+
+
+def _lookup_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    if _cache is not None:
+        s = _cache.stats()
+        yield {"result": "hit"}, s["hits"]
+        yield {"result": "miss"}, s["misses"]
+
+
+def _entries_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    if _cache is not None:
+        yield {}, _cache.stats()["entries"]
+
+
+metrics.SEMANTIC_LOOKUPS.sources.append(_lookup_series)
+metrics.SEMANTIC_ENTRIES.sources.append(_entries_series)
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+from django.core.cache import cache
+
+from services import metrics
+
+T = TypeVar("T")
+
+# Result handed to async followers when the leader was cancelled: they retry.
+_LEADER_CANCELLED = object()
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    In-process de-duplication: while one thread runs ``fn`` for a key, other
+    threads asking for the same key wait and receive the same result (or error).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._async_calls: Dict[Tuple[int, str], "asyncio.Future[Any]"] = {}
+        self.coalesced = 0
+        self.coalesced_cluster = 0
+
+    def count_cluster(self) -> None:
+        with self._lock:
+            self.coalesced_cluster += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "coalesced_process": self.coalesced,
+                "coalesced_cluster": self.coalesced_cluster,
+                "in_flight": len(self._calls) + len(self._async_calls),
+            }
+
+    def do(self, key: str, fn: Callable[[], T]) -> Tuple[T, bool]:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+        return call.result, False
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        loop = asyncio.get_running_loop()
+        fkey = (id(loop), key)
+
+        while True:
+            with self._lock:
+                fut = self._async_calls.get(fkey)
+                leader = fut is None
+                if leader:
+                    fut = loop.create_future()
+                    self._async_calls[fkey] = fut
+                else:
+                    self.coalesced += 1
+
+            if leader:
+                break
+            result = await asyncio.shield(fut)
+            if result is not _LEADER_CANCELLED:
+                return result, True
+            # The leader's caller went away; the first waiter to get here runs fn itself.
+
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            # One client disconnecting must not fail the others waiting on the call.
+            with self._lock:
+                self._async_calls.pop(fkey, None)
+            fut.set_result(_LEADER_CANCELLED)
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # Mark retrieved so a leader-only failure is not reported as unhandled.
+            fut.exception()
+            raise
+        else:
+            fut.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                if self._async_calls.get(fkey) is fut:
+                    del self._async_calls[fkey]
+
+
+class ClusterLock:
+    """
+    Cross-worker lock on top of the shared Django cache (``cache.add`` is the
+    atomic "set if absent"). Only meaningful when CACHES points at a backend
+    that workers actually share.
+    """
+
+    def __init__(self, key: str, timeout: float) -> None:
+        self.key = f"{key}:lock"
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+
+    def acquire(self) -> bool:
+        return cache.add(self.key, self.token, timeout=self.timeout)
+
+    async def aacquire(self) -> bool:
+        return await cache.aadd(self.key, self.token, timeout=self.timeout)
+
+    def held_elsewhere(self) -> bool:
+        return cache.get(self.key) is not None
+
+    async def aheld_elsewhere(self) -> bool:
+        return await cache.aget(self.key) is not None
+
+    def release(self) -> None:
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+    async def arelease(self) -> None:
+        if await cache.aget(self.key) == self.token:
+            await cache.adelete(self.key)
+
+
+def wait_for(
+    probe: Callable[[], Optional[T]],
+    still_running: Callable[[], bool],
+    timeout: float,
+    poll: float,
+) -> Optional[T]:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(poll)
+        value = probe()
+        if value is not None:
+            return value
+        if not still_running():
+            return None
+    return None
+
+
+async def await_for(
+    probe: Callable[[], Awaitable[Optional[T]]],
+    still_running: Callable[[], Awaitable[bool]],
+    timeout: float,
+    poll: float,
+) -> Optional[T]:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(poll)
+        value = await probe()
+        if value is not None:
+            return value
+        if not await still_running():
+            return None
+    return None
+
+
+flights = SingleFlight()
+
+
+def _coalesced_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    s = flights.stats()
+    yield {"scope": "process"}, s["coalesced_process"]
+    yield {"scope": "cluster"}, s["coalesced_cluster"]
+
+
+def _in_flight_series() -> Iterator[Tuple[Dict[str, Any], float]]:
+    yield {}, flights.stats()["in_flight"]
+
+
+metrics.COALESCED.sources.append(_coalesced_series)
+metrics.IN_FLIGHT.sources.append(_in_flight_series)
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a chat between a RoshaClub gym member and the RoshaClub AI assistant. "
+    "Merge the previous summary with the new messages into one updated summary. "
+    "Keep only what the assistant may need later: the user's goals and constraints, programs, trainers "
+    "or prices already discussed, decisions made, and open questions. "
+    "Write plain text, third person, at most {words} words. Do not add anything that was not said."
+)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "AI_SUMMARY_WORKERS", 1),
+                thread_name_prefix="ai-summary",
+            )
+        return _executor
+
+
+def summary_messages(previous: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    words = getattr(settings, "AI_SUMMARY_MAX_WORDS", 120)
+    transcript = "\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT.format(words=words)},
+        {
+            "role": "user",
+            "content": f"PREVIOUS SUMMARY:\n{previous or '(none)'}\n\nNEW MESSAGES:\n{transcript}",
+        },
+    ]
+
+
+def summarize_session(session_id: int) -> bool:
+    """
+    Fold every message older than the most recent ``AI_SUMMARY_KEEP_RECENT``
+    into ``ChatSession.summary`` once more than ``AI_SUMMARY_TRIGGER``
+    messages are unsummarised. Returns True when the summary was updated.
+    """
+    from ai_assistant.models import ChatMessage, ChatSession
+    from services.ai_service import LLMService
+
+    lock_key = f"ai:summary:lock:{session_id}"
+    if not cache.add(lock_key, 1, timeout=getattr(settings, "AI_TIMEOUT_SECONDS", 20) * 2):
+        return False
+
+    try:
+        session = ChatSession.objects.filter(id=session_id).only("id", "summary", "summary_until_id").first()
+        if not session:
+            return False
+
+        pending_qs = session.messages.exclude(role=ChatMessage.ROLE_SYSTEM)
+        if session.summary_until_id:
+            pending_qs = pending_qs.filter(id__gt=session.summary_until_id)
+
+        trigger = getattr(settings, "AI_SUMMARY_TRIGGER", 12)
+        keep = getattr(settings, "AI_SUMMARY_KEEP_RECENT", 6)
+
+        pending = list(pending_qs.order_by("id").only("id", "role", "content"))
+        if len(pending) <= trigger:
+            return False
+
+        to_fold = pending[:-keep] if keep else pending
+        summary = LLMService().summarize(
+            session.summary,
+            [{"role": m.role, "content": m.content} for m in to_fold],
+        )
+
+        # update() leaves updated_at alone: summarising is not user activity.
+        ChatSession.objects.filter(id=session_id).update(
+            summary=summary[: getattr(settings, "AI_SUMMARY_MAX_CHARS", 1200)],
+            summary_until_id=to_fold[-1].id,
+        )
+        logger.info(
+            "AI session summarised session_id=%s folded=%s until_id=%s",
+            session_id,
+            len(to_fold),
+            to_fold[-1].id,
+        )
+        return True
+    finally:
+        cache.delete(lock_key)
+
+
+def _run(session_id: int) -> None:
+    try:
+        summarize_session(session_id)
+    except Exception:
+        logger.exception("AI session summary failed session_id=%s", session_id)
+
+
+def _run_in_background(session_id: int) -> None:
+    close_old_connections()
+    try:
+        _run(session_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_summary(session_id: int) -> None:
+    if not getattr(settings, "AI_SUMMARY_ENABLED", True):
+        return
+
+    if getattr(settings, "AI_SUMMARY_ASYNC", True):
+        _get_executor().submit(_run_in_background, session_id)
+    else:
+        _run(session_id)
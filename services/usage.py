@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from functools import wraps
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from services import metrics, ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Rolling token counters kept for every user and for the whole site, in the
+# rate limiter's sliding-window storage (RATE_LIMIT_BACKEND).
+WINDOWS: Tuple[Tuple[str, int], ...] = (("minute", 60), ("day", 86400))
+GLOBAL = "global"
+
+
+def _key(scope: str, window: int) -> str:
+    return f"tok:{scope}:{window}"
+
+
+def _scopes(user_id: Optional[int]) -> Tuple[str, ...]:
+    return (GLOBAL,) + ((f"u{user_id}",) if user_id else ())
+
+
+def record(user_id: Optional[int], tokens_in: Optional[int], tokens_out: Optional[int]) -> int:
+    """Add one upstream call's tokens to the user's and the global counters."""
+    total = int(tokens_in or 0) + int(tokens_out or 0)
+    if total <= 0:
+        return 0
+    for scope in _scopes(user_id):
+        for _, window in WINDOWS:
+            ratelimit.consume(_key(scope, window), total, window)
+    return total
+
+
+def record_turn(user_id: Optional[int], info: Dict[str, Any]) -> int:
+    """
+    Count the tokens of a chat turn from its ``metrics`` info. Only turns
+    that went upstream themselves count: cache hits, coalesced replies and
+    intent answers used no model time.
+    """
+    if info.get("cache") != "miss":
+        return 0
+    return record(user_id, info.get("tokens_in"), info.get("tokens_out"))
+
+
+def _quotas(user_id: Optional[int]) -> List[Tuple[str, str, int, int]]:
+    """(name, counter key, limit, window) for every configured quota; 0 disables one."""
+    configured = [
+        ("user_minute", f"u{user_id}", getattr(settings, "AI_TOKENS_PER_MIN", 0), 60),
+        ("user_day", f"u{user_id}", getattr(settings, "AI_TOKENS_PER_DAY", 0), 86400),
+        ("global_minute", GLOBAL, getattr(settings, "AI_GLOBAL_TOKENS_PER_MIN", 0), 60),
+        ("global_day", GLOBAL, getattr(settings, "AI_GLOBAL_TOKENS_PER_DAY", 0), 86400),
+    ]
+    return [
+        (name, _key(scope, window), limit, window)
+        for name, scope, limit, window in configured
+        if limit and (user_id or scope == GLOBAL)
+    ]
+
+
+def check(user_id: Optional[int]) -> Optional[Tuple[str, ratelimit.RateLimitResult]]:
+    """The first exhausted token quota for this user, or None. Nothing is counted."""
+    for name, key, limit, window in _quotas(user_id):
+        result = ratelimit.peek(key, limit, window)
+        if not result.allowed:
+            return name, result
+    return None
+
+
+def snapshot(user_id: Optional[int]) -> Dict[str, Dict[str, int]]:
+    """Tokens used over the last minute and day, per scope (``global`` and ``u<id>``)."""
+    now = time.time()
+    out: Dict[str, Dict[str, int]] = {}
+    backend = ratelimit.get_backend()
+    for scope in _scopes(user_id):
+        out[scope] = {}
+        for name, window in WINDOWS:
+            window_start = int(now // window) * window
+            hits, prev = backend.peek(_key(scope, window), window_start, window)
+            out[scope][name] = int(prev * (1 - (now - window_start) / window) + hits)
+    return out
+
+
+def _exceeded_response(name: str, result: ratelimit.RateLimitResult) -> JsonResponse:
+    # A user's own quota is a 429; the site-wide budget running out is on us.
+    status = 503 if name.startswith(GLOBAL) else 429
+    response = JsonResponse(
+        {"error": "AI token quota exceeded. Please try again later.", "quota": name, "retry_after": result.retry_after},
+        status=status,
+    )
+    response["Retry-After"] = str(result.retry_after)
+    return response
+
+
+def _user_id(request) -> Optional[int]:
+    user = getattr(request, "user", None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def _record_after(content: Iterator[bytes], user_id: Optional[int], timings: metrics.Timings) -> Iterator[bytes]:
+    try:
+        yield from content
+    finally:
+        record_turn(user_id, timings.info)
+
+
+def _finish(response: Any, user_id: Optional[int], timings: Optional[metrics.Timings]) -> Any:
+    if timings is None:
+        return response
+    if getattr(response, "streaming", False):
+        # The tokens of a stream are known once its body is done.
+        response.streaming_content = _record_after(response.streaming_content, user_id, timings)
+    else:
+        record_turn(user_id, timings.info)
+    return response
+
+
+def token_quota(view):
+    """
+    View decorator: reject the request while the user's (or the site's)
+    token quota is used up, and count the tokens the view's upstream call
+    used once its response is done. Place it under ``metrics.instrument``,
+    which collects those token counts.
+    """
+    if asyncio.iscoroutinefunction(view):
+
+        @wraps(view)
+        async def _async_wrapped(request, *args, **kwargs):
+            if request.method != "POST":
+                return await view(request, *args, **kwargs)
+            user_id = await sync_to_async(_user_id)(request)
+            exceeded = await sync_to_async(check)(user_id)
+            if exceeded:
+                return _exceeded_response(*exceeded)
+            timings = metrics.current()
+            response = await view(request, *args, **kwargs)
+            return await sync_to_async(_finish)(response, user_id, timings)
+
+        return _async_wrapped
+
+    @wraps(view)
+    def _wrapped(request, *args, **kwargs):
+        if request.method != "POST":
+            return view(request, *args, **kwargs)
+        user_id = _user_id(request)
+        with metrics.phase("quota"):
+            exceeded = check(user_id)
+        if exceeded:
+            return _exceeded_response(*exceeded)
+        timings = metrics.current()
+        return _finish(view(request, *args, **kwargs), user_id, timings)
+
+    return _wrapped
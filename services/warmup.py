@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+_thread: Optional[threading.Thread] = None
+_thread_lock = threading.Lock()
+
+
+def interval() -> int:
+    return int(getattr(settings, "OLLAMA_WARMUP_SECONDS", 600) or 0)
+
+
+def warm_up() -> Optional[bool]:
+    """
+    Ask the configured provider to load its model with the shared prompt
+    prefix. Returns True when a model was warmed, False when the provider
+    chain has nothing to warm (no Ollama), and None when the call failed;
+    failures are logged, never raised, since a cold model only costs latency.
+    """
+    from services.ai_service import LLMService
+
+    try:
+        return LLMService().warm_up()
+    except Exception as e:
+        logger.warning("AI warm-up failed error=%r", e)
+        return None
+    finally:
+        close_old_connections()
+
+
+def _loop(every: int, delay: bool) -> None:
+    if delay:
+        time.sleep(every)
+    while True:
+        started = time.monotonic()
+        if warm_up() is False:
+            return
+        time.sleep(max(1.0, every - (time.monotonic() - started)))
+
+
+def start_warmup_thread(delay: bool = False) -> bool:
+    """
+    Warm the model now (or after one interval with ``delay``) and then every
+    ``OLLAMA_WARMUP_SECONDS`` (keep it below ``OLLAMA_KEEP_ALIVE``) from a
+    daemon thread; at most one per process. Web processes start it from
+    ``AppConfig.ready()`` when ``AI_WARMUP_ON_START`` is set; a server that
+    loads the app before forking must call it from its post-fork hook
+    instead, since the thread does not survive the fork.
+    """
+    global _thread
+
+    every = interval()
+    if every <= 0:
+        return False
+
+    with _thread_lock:
+        if _thread is not None:
+            return False
+        _thread = threading.Thread(target=_loop, args=(every, delay), name="ai-warmup", daemon=True)
+        _thread.start()
+    return True